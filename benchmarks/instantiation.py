@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Measure the number of instances of a model with 30 fields that can be created
+per second, when none, one, or all of their fields are used.
+
+The fields of an instance are created only when accessed, so the "all fields"
+case is the cost of creating an instance when all the fields were copied in
+the constructor.
+
+No command is sent to redis.
+
+Usage: python benchmarks/instantiation.py [--number NUMBER]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from limpyd import fields  # noqa: E402
+from limpyd.database import RedisDatabase  # noqa: E402
+from limpyd.model import RedisModel  # noqa: E402
+
+
+database = RedisDatabase(db=15)
+
+attrs = {'database': database, 'namespace': 'benchmarks'}
+for num in range(10):
+    attrs['string%d' % num] = fields.StringField()
+    attrs['indexed%d' % num] = fields.StringField(indexable=True)
+    attrs['hash%d' % num] = fields.InstanceHashField()
+ThirtyFields = type(str('ThirtyFields'), (RedisModel, ), attrs)
+
+
+def no_field():
+    ThirtyFields.lazy_connect(1)
+
+
+def one_field():
+    ThirtyFields.lazy_connect(1).hash0
+
+
+def all_fields():
+    instance = ThirtyFields.lazy_connect(1)
+    for field_name in ThirtyFields._fields:
+        instance.get_field(field_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=10000,
+                        help='Number of instances to create for each case.')
+    args = parser.parse_args()
+
+    reference = None
+    for func in (all_fields, one_field, no_field):
+        duration = min(timeit.repeat(func, number=args.number, repeat=3))
+        rate = args.number / duration
+        if reference is None:
+            reference = rate
+        print('%-10s %10d instances/s  (x%.1f)' % (func.__name__, rate, rate / reference))
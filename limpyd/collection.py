@@ -7,10 +7,13 @@ from collections import namedtuple
 from copy import copy
 from itertools import product
 from operator import itemgetter
+import json
+import uuid
 
-from limpyd.utils import make_key, unique_key
+from limpyd.utils import make_key, unique_key, normalize, NotProvided, TMP_KEY_TTL
 from limpyd.exceptions import *
 from limpyd.fields import SingleValueField
+from limpyd.indexes import BaseRangeIndex
 
 ParsedFilter = namedtuple('ParsedFilter', ['index', 'suffix', 'extra_field_parts', 'value', 'related_filters'])
 
@@ -125,6 +128,305 @@ class CollectionManager(object):
     # time between a first call to __len__ followed by a collection retrieval
     FINAL_SET_TTL = 300
 
+    # number of pks to check for existence in one call to redis when instances are asked
+    INSTANCES_CHUNK_SIZE = 1000
+
+    # if True, collections are computed by one lua script, in one call to redis, when possible
+    SINGLE_CALL = False
+
+    # default time to live, in seconds, of the final sets cached by `cache`
+    CACHE_TTL = 60
+
+    # max number of members of a text index read in one call to redis by `keyset` when filtering
+    KEYSET_SCAN_SIZE = 1000
+
+    cache_key_script = {
+        # compute the key of the cached final set for a filters signature, using the
+        # versions of the indexes read by the filters (and the one of the whole
+        # model, the empty entry), and tell if this cached set is available (its "done"
+        # flag exists and will not expire too soon)
+        # KEYS: the hash of the versions, ARGV: the prefix of the key, the signature,
+        # then the entries of the versions of the indexes
+        'lua': """
+            local versions_key, prefix, signature = KEYS[1], ARGV[1], ARGV[2]
+            local entries = {''}
+            for i = 3, #ARGV do
+                entries[#entries + 1] = ARGV[i]
+            end
+            local versions = redis.call('hmget', versions_key, unpack(entries))
+            local parts = {signature}
+            for i = 1, #entries do
+                parts[#parts + 1] = versions[i] or '0'
+            end
+            local cache_key = prefix .. ':' .. redis.sha1hex(table.concat(parts, '\\n'))
+            local cached = 0
+            if redis.call('pttl', cache_key .. ':done') > 1000 then
+                cached = 1
+            end
+            return {cache_key, cached}
+        """
+    }
+
+    single_call_script = {
+        # compute the pks matching each filter (reading the index sets and sorted sets),
+        # intersect them, then count, sort and slice the result, and tell, for each pk,
+        # if it exists, all in one call, deleting the temporary keys at the end.
+        # ARGV: pk (or ""), "1" to only count, "1" to check the existence of the pks,
+        # the number of SORT arguments (-1 to not sort) followed by them, the number
+        # of filters followed, for each, by its number of sources and, for each source,
+        # 6 values: kind, position of its key in KEYS, start, end, exclude and extra
+        'lua': """
+            local collection_key, tmp_base = KEYS[1], KEYS[2]
+            local pk, count_only, check_existence = ARGV[1], ARGV[2] == '1', ARGV[3] == '1'
+            local pos, block_size = 4, 100
+            local tmp_keys, sets = {}, {}
+
+            -- the blocks are read without skipping an offset: by rank for a number index
+            -- (from the rank of the first score in the range), and after the last member
+            -- of the previous block for a text one
+            local function add_range(dest, kind, key, range_start, range_end, exclude, separator)
+                local rank, last_rank = 0, 0
+                if kind == 'number' then
+                    if range_start:sub(1, 1) == '(' then
+                        rank = redis.call('zcount', key, '-inf', range_start:sub(2))
+                    elseif range_start ~= '-inf' then
+                        rank = redis.call('zcount', key, '-inf', '(' .. range_start)
+                    end
+                    last_rank = rank + redis.call('zcount', key, range_start, range_end) - 1
+                end
+                while true do
+                    local members
+                    if kind == 'number' then
+                        if rank > last_rank then
+                            break
+                        end
+                        members = redis.call('zrange', key, rank, math.min(rank + block_size - 1, last_rank))
+                        rank = rank + block_size
+                    else
+                        members = redis.call('zrangebylex', key, range_start, range_end, 'limit', 0, block_size)
+                    end
+                    if members[1] == nil then
+                        break
+                    end
+                    local result, nb_results = {}, 0
+                    for i, member in ipairs(members) do
+                        if kind == 'number' then
+                            nb_results = nb_results + 1
+                            result[nb_results] = member
+                        else
+                            -- split on the last separator to get the value and the pk
+                            local first_pos, last_pos = member:reverse():find(separator:reverse(), 1, true)
+                            first_pos = member:len() - last_pos
+                            if exclude == '' or member:sub(1, first_pos) ~= exclude then
+                                nb_results = nb_results + 1
+                                result[nb_results] = member:sub(first_pos + separator:len() + 1)
+                            end
+                        end
+                    end
+                    if nb_results > 0 then
+                        redis.call('sadd', dest, unpack(result))
+                    end
+                    if members[block_size] == nil then
+                        break
+                    end
+                    if kind ~= 'number' then
+                        range_start = '(' .. members[block_size]
+                    end
+                end
+            end
+
+            if pk ~= '' then
+                if redis.call('sismember', collection_key, pk) == 0 then
+                    return {0, {}, {}}
+                end
+                local pk_key = tmp_base .. ':pk'
+                redis.call('sadd', pk_key, pk)
+                table.insert(tmp_keys, pk_key)
+                table.insert(sets, pk_key)
+            end
+
+            local nb_sort_args = tonumber(ARGV[pos])
+            local sort_args = {}
+            pos = pos + 1
+            for i = 1, nb_sort_args do
+                sort_args[i] = ARGV[pos]
+                pos = pos + 1
+            end
+
+            local nb_filters = tonumber(ARGV[pos])
+            pos = pos + 1
+            for filter_num = 1, nb_filters do
+                local nb_sources = tonumber(ARGV[pos])
+                pos = pos + 1
+                if nb_sources == 1 and ARGV[pos] == 'set' then
+                    -- a simple set, no need to copy it
+                    table.insert(sets, KEYS[tonumber(ARGV[pos + 1])])
+                    pos = pos + 6
+                elseif nb_sources > 0 then
+                    local dest = tmp_base .. ':' .. filter_num
+                    for source_num = 1, nb_sources do
+                        local kind, key = ARGV[pos], KEYS[tonumber(ARGV[pos + 1])]
+                        if kind == 'set' then
+                            redis.call('sunionstore', dest, dest, key)
+                        else
+                            add_range(dest, kind, key, ARGV[pos + 2], ARGV[pos + 3], ARGV[pos + 4], ARGV[pos + 5])
+                        end
+                        pos = pos + 6
+                    end
+                    table.insert(tmp_keys, dest)
+                    table.insert(sets, dest)
+                end
+            end
+
+            local final_set
+            if sets[1] == nil then
+                final_set = collection_key
+            elseif sets[2] == nil then
+                final_set = sets[1]
+            else
+                final_set = tmp_base
+                redis.call('sinterstore', final_set, unpack(sets))
+                table.insert(tmp_keys, final_set)
+            end
+
+            local count = redis.call('scard', final_set)
+            local results, existing = {}, {}
+            if not count_only and count > 0 then
+                if nb_sort_args >= 0 then
+                    results = redis.call('sort', final_set, unpack(sort_args))
+                else
+                    results = redis.call('smembers', final_set)
+                end
+                if check_existence then
+                    for i, member in ipairs(results) do
+                        existing[i] = redis.call('sismember', collection_key, member)
+                    end
+                end
+            end
+
+            if tmp_keys[1] ~= nil then
+                redis.call('del', unpack(tmp_keys))
+            end
+            return {count, results, existing}
+        """
+    }
+
+    keyset_script = {
+        # read the sorted set of a range index of the sort field, in the sort order,
+        # starting after the cursor (a value and a pk), and return the pks that are
+        # in the final set (if given, else all are kept), until `limit` are found (all
+        # if 0).
+        # For a number index, the members are the pks, so if there is a final set, its
+        # intersection with the index is stored in the temporary key (with the scores
+        # of the index) and this key is read instead, without having to check each
+        # member. If the cursor pk is still in the sorted set with the cursor value, we
+        # start directly at its rank, else at the rank of the first member with the
+        # cursor value, skipping those before the cursor pk (for equal scores, members
+        # are ordered lexicographically).
+        # For a text index, the members are "value<separator>pk" so we can use
+        # zrangebylex, starting each block after the last member of the previous one.
+        # As each member must be checked against the final set, at most `max_scan`
+        # members are read (all if 0), and if it's not enough to have `limit` pks, the
+        # last member read is returned, as a new cursor to continue.
+        # Returns the pks and this continuation member (empty if nothing to continue)
+        'lua': """
+            local index_key, final_set, tmp_key = KEYS[1], KEYS[2], KEYS[3]
+            local kind, desc, limit = ARGV[1], ARGV[2] == '1', tonumber(ARGV[3])
+            local has_cursor, cursor_value, cursor_pk, separator = ARGV[4] == '1', ARGV[5], ARGV[6], ARGV[7]
+            local max_scan = tonumber(ARGV[8])
+            local block_size = (max_scan > 0 and max_scan < 100) and max_scan or 100
+            local results, nb_results, continuation = {}, 0, ''
+            local check_members = final_set ~= ''
+
+            if kind == 'number' and check_members then
+                redis.call('zinterstore', tmp_key, 2, final_set, index_key, 'weights', 0, 1)
+                index_key, check_members = tmp_key, false
+            end
+
+            -- add the pk to the results if in the final set, return true if we have enough
+            local function add(pk)
+                if not check_members or redis.call('sismember', final_set, pk) == 1 then
+                    nb_results = nb_results + 1
+                    results[nb_results] = pk
+                end
+                return limit > 0 and nb_results >= limit
+            end
+
+            if kind == 'number' then
+                local start, skip_ties, value = 0, false, tonumber(cursor_value)
+                if has_cursor then
+                    local score = redis.call('zscore', index_key, cursor_pk)
+                    if score and tonumber(score) == value then
+                        start = redis.call(desc and 'zrevrank' or 'zrank', index_key, cursor_pk) + 1
+                    elseif desc then
+                        start, skip_ties = redis.call('zcount', index_key, '(' .. cursor_value, '+inf'), true
+                    else
+                        start, skip_ties = redis.call('zcount', index_key, '-inf', '(' .. cursor_value), true
+                    end
+                end
+                local done = false
+                while not done do
+                    local members = redis.call(desc and 'zrevrange' or 'zrange', index_key,
+                                               start, start + block_size - 1, 'withscores')
+                    for i = 1, #members, 2 do
+                        local member, score = members[i], tonumber(members[i + 1])
+                        if skip_ties and score == value and
+                                ((desc and member >= cursor_pk) or (not desc and member <= cursor_pk)) then
+                            -- before the cursor
+                        else
+                            skip_ties = false
+                            if add(member) then
+                                done = true
+                                break
+                            end
+                        end
+                    end
+                    if #members < 2 * block_size then
+                        break
+                    end
+                    start = start + block_size
+                end
+                if index_key == tmp_key then
+                    redis.call('del', tmp_key)
+                end
+            else
+                local bound = desc and '+' or '-'
+                if has_cursor then
+                    bound = '(' .. cursor_value .. separator .. cursor_pk
+                end
+                local done, nb_scanned = false, 0
+                while not done do
+                    local members
+                    if desc then
+                        members = redis.call('zrevrangebylex', index_key, bound, '-', 'limit', 0, block_size)
+                    else
+                        members = redis.call('zrangebylex', index_key, bound, '+', 'limit', 0, block_size)
+                    end
+                    for i, member in ipairs(members) do
+                        -- split on the last separator to get the pk
+                        local first_pos, last_pos = member:reverse():find(separator:reverse(), 1, true)
+                        first_pos = member:len() - last_pos
+                        if add(member:sub(first_pos + separator:len() + 1)) then
+                            done = true
+                            break
+                        end
+                    end
+                    if done or #members < block_size then
+                        break
+                    end
+                    nb_scanned = nb_scanned + #members
+                    if max_scan > 0 and nb_scanned >= max_scan then
+                        continuation = members[#members]
+                        break
+                    end
+                    bound = '(' .. members[#members]
+                end
+            end
+
+            return {results, continuation}
+        """
+    }
+
     def __init__(self, model):
         self.model = model
         self._lazy_collection = {  # Store infos to make the requested collection
@@ -135,6 +437,8 @@ class CollectionManager(object):
                                  # instead of raw pks
         self._lazy_instances = False  # If True will return instances
                                       # without testing if pk exist
+        self._existing_pks = None  # When non-lazy instances are asked, the set of
+                                   # pks of the results that exist in redis
         self._sort = None  # Will store sorting parameters
         self._sort_limits = None  # Will store slice parameters (start and num)
         self._len = None  # Store the result of the final collection, to avoid
@@ -157,6 +461,12 @@ class CollectionManager(object):
                                            # applied, and deleted after the collection retrieval is
                                            # done
 
+        self._single_call = self.SINGLE_CALL  # if the collection must be computed in one call to redis
+        self._keyset = None  # cursor ("after") and "limit" for keyset pagination
+        self._cache_ttl = None  # time to live of the cached final set, if `cache` is used
+        self._prefetch = None  # names of the InstanceHashField to read with the instances
+        self._prefetched_values = None  # values read for `prefetch`, by pk
+
     @property
     def connection(self):
         return self.model.get_connection()
@@ -172,8 +482,14 @@ class CollectionManager(object):
         new._len_mode = self._len_mode
         new._collection_cache = None
         new._cache_iterator_function = None
+        new._existing_pks = None
         new._final_set = None
         new._final_set_deletable = False
+        new._single_call = self._single_call
+        new._keyset = self._keyset.copy() if self._keyset is not None else None
+        new._cache_ttl = self._cache_ttl
+        new._prefetch = self._prefetch
+        new._prefetched_values = None
         return new
 
     def _get_from_results_cache(self, apply_slice=None):
@@ -264,6 +580,12 @@ class CollectionManager(object):
         if self._collection_cache is not None:
             return self._get_from_results_cache(apply_slice=arg)
 
+        if self._keyset is not None:
+            # the page is retrieved, then sliced
+            self._len_mode = False
+            self._fetch_collection()
+            return self._get_from_results_cache(apply_slice=arg)
+
         self._len_mode = False
         self._sort_limits = {}
         if isinstance(arg, slice):
@@ -383,6 +705,16 @@ class CollectionManager(object):
         if self._collection_cache is not None:
             return
 
+        if self._keyset is not None:
+            self._fetch_keyset_page(apply_slice=apply_slice)
+            return
+
+        if self._single_call:
+            script_filters = self._get_script_filters()
+            if script_filters is not None:
+                self._fetch_collection_in_one_call(script_filters, apply_slice=apply_slice)
+                return
+
         conn = self.connection
         self._len = 0
 
@@ -443,6 +775,105 @@ class CollectionManager(object):
         self._collection_cache, self._cache_iterator_function = self._prepare_results(collection, apply_slice=apply_slice)
         self._len = len(self._collection_cache)
 
+    def _get_script_filters(self):
+        """
+        Return, for each filter, the list of sources of the pks matching it, as
+        returned by ``BaseIndex.get_script_filter_sources``, or None if at least
+        one filter cannot be applied by the single-call script.
+        """
+        script_filters = []
+        for set_ in self._reduce_related_filters(self._lazy_collection['sets']):
+            if not isinstance(set_, ParsedFilter) or set_.related_filters:
+                return None
+            sources = set_.index.get_script_filter_sources(
+                set_.suffix,
+                *(set_.extra_field_parts + [set_.value])
+            )
+            if sources is None:
+                return None
+            script_filters.append(sources)
+        return script_filters
+
+    @staticmethod
+    def _get_sort_command_args(sort_options):
+        """
+        Convert the sort options, as prepared by ``_prepare_sort_options``, to
+        the arguments of the redis SORT command (without the key).
+        """
+        args = []
+        if sort_options.get('by'):
+            args.extend(['BY', sort_options['by']])
+        if sort_options.get('start') is not None and sort_options.get('num') is not None:
+            args.extend(['LIMIT', sort_options['start'], sort_options['num']])
+        get = sort_options.get('get')
+        if get:
+            for pattern in ([get] if isinstance(get, str) else get):
+                args.extend(['GET', pattern])
+        if sort_options.get('desc'):
+            args.append('DESC')
+        if sort_options.get('alpha'):
+            args.append('ALPHA')
+        return args
+
+    def _fetch_collection_in_one_call(self, script_filters, apply_slice=None):
+        """
+        Retrieve data according to lazy_collection, with only one call to redis:
+        the filters, the intersection, the count, the sort, the slice, and the
+        check of the existence of the instances are done in one lua script.
+        """
+        try:
+            pk = self._get_pk()
+        except ValueError:
+            self._cache_empty_collection()
+            return
+
+        if any(not sources for sources in script_filters):
+            # a filter matching nothing (like an empty `__in`)
+            self._cache_empty_collection()
+            return
+
+        sort_options = self._prepare_sort_options(bool(pk))
+        check_existence = self._instances and not self._lazy_instances and not self._len_mode
+
+        # temporary keys are created, and deleted, by the script, so no need to check they don't exist
+        keys = [
+            self.model.get_field('pk').collection_key,
+            make_key(self.model._name, '__collection__', 'single-call', uuid.uuid4().hex),
+        ]
+        args = [pk or '', 1 if self._len_mode else 0, 1 if check_existence else 0]
+        if sort_options is None:
+            args.append(-1)
+        else:
+            sort_args = self._get_sort_command_args(sort_options)
+            args.append(len(sort_args))
+            args.extend(sort_args)
+        args.append(len(script_filters))
+        for sources in script_filters:
+            args.append(len(sources))
+            for kind, key, start, end, exclude, extra in sources:
+                keys.append(key)
+                args.extend([kind, len(keys), start, end, exclude, extra])
+
+        count, results, existing = self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=CollectionManager.single_call_script,
+            keys=keys,
+            args=args,
+        )
+
+        if self._len_mode:
+            self._len = count
+            return
+
+        existing_pks = None
+        if check_existence:
+            existing_pks = set(result for result, exists in zip(results, existing) if exists)
+
+        self._collection_cache, self._cache_iterator_function = self._prepare_results(
+            results, apply_slice=apply_slice, existing_pks=existing_pks)
+        self._len = len(self._collection_cache)
+
     def _final_redis_call(self, final_set, sort_options):
         """
         The final redis call to obtain the values to return from the "final_set"
@@ -451,12 +882,62 @@ class CollectionManager(object):
 
         conn = self.connection
         if sort_options is not None:
+            sort_key = self._get_sort_storage_key(sort_options)
+            if sort_key is not None:
+                # sort on a field having a sorted index, use its sorted set
+                return self._sorted_index_redis_call(final_set, sort_key, sort_options)
             # a sort, or values, call the SORT command on the set
             return conn.sort(final_set, **sort_options)
         else:
             # no sort, nor values, simply return the full set
             return conn.smembers(final_set)
 
+    def _get_sort_storage_key(self, sort_options):
+        """
+        Return the key of the sorted set of the index to use to sort the
+        collection (see ``BaseIndex.get_sort_storage_key``), or None if the
+        SORT command must be used (no sort by a field with a sortable index, or
+        values to retrieve).
+        """
+        by = sort_options.get('by')
+        if not by or sort_options.get('get') or sort_options.get('store'):
+            return None
+        for field_name in self.model._fields:
+            field = self.model.get_field(field_name)
+            if field.indexable and field.sort_wildcard == by:
+                for index in field._indexes:
+                    sort_key = index.get_sort_storage_key()
+                    if sort_key is not None:
+                        return sort_key
+                break
+        return None
+
+    def _sorted_index_redis_call(self, final_set, sort_key, sort_options):
+        """
+        Order and slice the final set with the sorted set of a sortable index:
+        the pks of the final set are intersected with this sorted set (with a
+        weight of 0 for the final set, so the scores are the ones of the index)
+        and the asked part is read with ZRANGE. If the final set is the whole
+        collection, ZRANGE is directly called on the index.
+        """
+        start, num = sort_options.get('start'), sort_options.get('num')
+        if start is None or num is None:
+            start, num = 0, -1
+        if num == 0:
+            return []
+        end = start + num - 1 if num > 0 else -1
+        desc = bool(sort_options.get('desc'))
+
+        if final_set == self.model.get_field('pk').collection_key:
+            return self.connection.zrange(sort_key, start, end, desc=desc)
+
+        tmp_key = self._unique_key('sort')
+        with self.connection.pipeline(transaction=True) as pipe:
+            pipe.zinterstore(tmp_key, {final_set: 0, sort_key: 1})
+            pipe.zrange(tmp_key, start, end, desc=desc)
+            pipe.delete(tmp_key)
+            return pipe.execute()[1]
+
     def _collection_length(self, final_set):
         """
         Return the length of the final collection, directly asking redis for the
@@ -465,13 +946,69 @@ class CollectionManager(object):
         return self.connection.scard(final_set)
 
     def _to_instance(self, pk):
-        meth = self.model.lazy_connect if self._lazy_instances else self.model
-        return meth(pk)
+        if self._lazy_instances:
+            instance = self.model.lazy_connect(pk)
+        elif self._existing_pks is None:
+            instance = self.model(pk)
+        else:
+            # existence already checked in `_prepare_results`
+            if pk not in self._existing_pks:
+                raise DoesNotExist("No %s found with pk %s" % (self.model.__name__, pk))
+            instance = self.model.lazy_connect(pk)
+            instance._connected = True
+        if self._prefetched_values and pk in self._prefetched_values:
+            instance._prefetched = dict(self._prefetched_values[pk])
+        return instance
+
+    def _check_existing_pks(self, pks):
+        """
+        Fill ``self._existing_pks`` with the given pks that exist in redis,
+        checked by chunks of ``INSTANCES_CHUNK_SIZE`` pks to do only one call to
+        redis for each chunk.
+        """
+        pk_field = self.model.get_field('pk')
+        self._existing_pks = set()
+        for start in range(0, len(pks), self.INSTANCES_CHUNK_SIZE):
+            chunk = pks[start:start + self.INSTANCES_CHUNK_SIZE]
+            self._existing_pks.update(
+                pk for pk, exists in zip(chunk, pk_field.exists_many(chunk)) if exists
+            )
+
+    def _prepare_instances(self, pks):
+        """
+        Called with the pks of the instances to be returned, once their
+        existence is checked, to read in bulk what will be set on them by
+        ``_to_instance`` (the values asked with ``prefetch``).
+        """
+        if self._existing_pks is not None:
+            pks = [pk for pk in pks if pk in self._existing_pks]
+        if self._prefetch:
+            self._prefetch_values(pks)
 
-    def _prepare_results(self, results, _len_hint=None, apply_slice=None):
+    def _prefetch_values(self, pks):
+        """
+        Fill ``self._prefetched_values`` with the values of the fields asked
+        with ``prefetch`` for the given pks, read by chunks of
+        ``INSTANCES_CHUNK_SIZE`` pks with a pipeline of HMGET for each chunk.
+        """
+        self._prefetched_values = {}
+        if not self._prefetch:
+            return
+        names = list(self._prefetch)
+        for start in range(0, len(pks), self.INSTANCES_CHUNK_SIZE):
+            chunk = pks[start:start + self.INSTANCES_CHUNK_SIZE]
+            with self.connection.pipeline(transaction=False) as pipeline:
+                for pk in chunk:
+                    pipeline.hmget(self.model.get_hash_key(pk), names)
+                for pk, values in zip(chunk, pipeline.execute()):
+                    self._prefetched_values[pk] = dict(zip(names, values))
+
+    def _prepare_results(self, results, _len_hint=None, apply_slice=None, existing_pks=None):
         """
         Called in _collection to prepare results from redis before returning
-        them.
+        them. If `existing_pks` is given, it's the set of pks of the results
+        that are known to exist, so their existence is not checked again when
+        instances are asked.
         """
 
         # cache the len for future use
@@ -482,6 +1019,17 @@ class CollectionManager(object):
         if apply_slice is not None:
             results = results[apply_slice]
 
+        if self._instances and not self._lazy_instances:
+            if existing_pks is None:
+                self._check_existing_pks(results)
+            else:
+                self._existing_pks = existing_pks
+        else:
+            self._existing_pks = None
+
+        if self._instances:
+            self._prepare_instances(results)
+
         return results, (self._to_instance if self._instances else None)
 
     def _prepare_parsed_filter(self, parsed_filter):
@@ -632,6 +1180,12 @@ class CollectionManager(object):
         all_sets = set()
         tmp_keys = set()
 
+        cache_key = None
+        if self._cache_ttl and pk is None and sets:
+            cache_key, cached = self._get_cache_key()
+            if cached:
+                return cache_key, False
+
         if pk is not None and not sets and not (sort_options and sort_options.get('get')):
             # no final set if only a pk without values to retrieve
             return None, False
@@ -645,7 +1199,7 @@ class CollectionManager(object):
                 # create a set with the pk to do intersection (and to pass it to
                 # the store command to retrieve values if needed)
                 tmp_key = self._unique_key('tmp')
-                conn.sadd(tmp_key, pk)
+                self._store_tmp_key('sadd', tmp_key, pk)
                 all_sets.add(tmp_key)
                 tmp_keys.add(tmp_key)
 
@@ -670,7 +1224,12 @@ class CollectionManager(object):
             # more than one set, do an intersection on all of them in a new key
             # that will must be deleted once the collection is called.
             delete_set_later = True
-            final_set = self._combine_sets(all_sets, self._unique_key('final'))
+            final_set = self._combine_sets(all_sets, cache_key or self._unique_key('final'))
+
+        if cache_key is not None and delete_set_later:
+            # keep the computed set in the cache, so it must not be deleted
+            self._cache_final_set(final_set, cache_key)
+            final_set, delete_set_later = cache_key, False
 
         if tmp_keys:
             conn.delete(*tmp_keys)
@@ -678,14 +1237,72 @@ class CollectionManager(object):
         # return the final set to work on, and a flag if we later need to delete it
         return final_set, delete_set_later
 
+    def _get_cache_key(self):
+        """
+        Return the key of the cached final set for the filters of the
+        collection, depending on the current versions of the indexes they read
+        (see ``BaseIndex.get_version_entry``), and if this cached set is
+        available. The key is None if the
+        filters cannot be cached (they use an index not handled by
+        ``BaseIndex.get_script_filter_sources``), or if there is nothing to
+        compute (only one filter reading directly an index set).
+        """
+        script_filters = self._get_script_filters()
+        if not script_filters or not all(script_filters):
+            return None, False
+        if len(script_filters) == 1 and len(script_filters[0]) == 1 and script_filters[0][0][0] == 'set':
+            return None, False
+
+        signature = '\n'.join(sorted(json.dumps(sources) for sources in script_filters))
+        parsed_filters = self._reduce_related_filters(self._lazy_collection['sets'])
+        version_entries = sorted({
+            parsed_filter.index.get_version_entry(source[1], parsed_filter.suffix)
+            for parsed_filter, sources in zip(parsed_filters, script_filters)
+            for source in sources
+        })
+        cache_key, cached = self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=CollectionManager.cache_key_script,
+            keys=[self.model._index_versions_key()],
+            args=[make_key(self.model._name, '__collection__', 'cache'), signature] + version_entries,
+        )
+        return normalize(cache_key), bool(cached)
+
+    def _cache_final_set(self, final_set, cache_key):
+        """
+        Save the computed final set at the given cache key (if it was not
+        computed there), with the time to live asked in ``cache``, and set the
+        flag telling the cached set is available (the set itself doesn't exist
+        if empty).
+        """
+        with self.connection.pipeline(transaction=False) as pipeline:
+            if final_set != cache_key:
+                pipeline.sunionstore(cache_key, [final_set])
+                pipeline.delete(final_set)
+            pipeline.expire(cache_key, self._cache_ttl)
+            pipeline.set(make_key(cache_key, 'done'), 1, ex=self._cache_ttl)
+            pipeline.execute()
+
     def _combine_sets(self, sets, final_set):
         """
         Given a list of set, combine them to create the final set that will be
         used to make the final redis call.
         """
-        self.connection.sinterstore(final_set, list(sets))
+        self._store_tmp_key('sinterstore', final_set, list(sets))
         return final_set
 
+    def _store_tmp_key(self, command, key, *args):
+        """
+        Call the given redis command to create the temporary `key`, with a
+        time to live set in the same pipeline, so the key cannot stay in
+        redis forever if it's never deleted. Return the result of the command.
+        """
+        with self.connection.pipeline(transaction=False) as pipeline:
+            getattr(pipeline, command)(key, *args)
+            pipeline.expire(key, TMP_KEY_TTL)
+            return pipeline.execute()[0]
+
     def __call__(self, **filters):
         return self.clone()._add_filters(**filters)
 
@@ -796,6 +1413,23 @@ class CollectionManager(object):
         clone._lazy_instances = lazy
         return clone
 
+    def prefetch(self, *field_names):
+        """
+        Ask the collection to read, with the instances, the values of the given
+        InstanceHashField (all of them if no names are given), with one call to
+        redis for each chunk of ``INSTANCES_CHUNK_SIZE`` instances. The `hget`
+        calls on these fields then return the values already read, without
+        calling redis (until another command is called on the field).
+        Only used when instances are returned (see ``instances``).
+        """
+        if not field_names:
+            field_names = self.model._instancehash_fields
+        elif not all(name in self.model._instancehash_fields for name in field_names):
+            raise ValueError("Only InstanceHashField can be used here.")
+        clone = self.clone()
+        clone._prefetch = tuple(field_names)
+        return clone
+
     def _get_simple_fields(self):
         """
         Return a list of the names of all fields that handle simple values
@@ -854,6 +1488,315 @@ class CollectionManager(object):
     def sort(self, **parameters):
         return self.clone()._apply_sort(**parameters)
 
+    def iterator(self, chunk_size=1000):
+        """
+        Return a generator on the results of the collection (pks, or instances
+        if ``instances`` was called), retrieved from redis by chunks of about
+        `chunk_size` entries using SSCAN, so the memory used stays constant and
+        the first results come quickly, even for huge collections.
+        As for SSCAN, a result may be returned more than once if the collection
+        is updated during the iteration.
+        Cannot be used on a sorted (except with ``by='nosort'``) or sliced
+        collection.
+        """
+        if (self._sort is not None and self._sort.get('by') != 'nosort') or self._sort_limits:
+            raise ImplementationError('Cannot use `iterator` on a sorted or sliced collection')
+        # work on a clone to not mess with the results cache of the collection
+        return self.clone()._iterate(chunk_size)
+
+    def delete(self, chunk_size=1000):
+        """
+        Delete all the instances matching the collection, by chunks of about
+        `chunk_size` pks read from the final set with SSCAN (see ``iterator``).
+        The `delete` method of the instances is not called: for each chunk, the
+        values to deindex are read in one call to redis, then the indexes are
+        updated, and the keys deleted, in another one (see
+        ``RedisModel._bulk_delete``).
+        Return the number of deleted instances.
+        Cannot be used on a sorted (except with ``by='nosort'``) or sliced
+        collection.
+        """
+        if (self._sort is not None and self._sort.get('by') != 'nosort') or self._sort_limits:
+            raise ImplementationError('Cannot use `delete` on a sorted or sliced collection')
+        count = 0
+        for pks in self.clone()._iterate_chunks(chunk_size):
+            count += self.model._bulk_delete(pks)
+        return count
+
+    def update(self, chunk_size=1000, lua=False, **values):
+        """
+        Set the given values (field names as keys) on all the instances
+        matching the collection, by chunks of about `chunk_size` pks read from
+        the final set with SSCAN (see ``iterator``), without locking each field
+        of each instance: for each chunk, the updated fields are locked (one
+        lock by field), the current values to deindex are read in one call to
+        redis, then the indexes are updated, and the values written, in another
+        one (see ``RedisModel._bulk_update``).
+        With `lua` set to True, only InstanceHashField can be updated, and
+        each chunk is updated by only one lua script.
+        Only fields holding a single value can be updated, and not unique ones,
+        as many instances would share the same value. None is not accepted.
+        Return the number of updated instances.
+        Cannot be used on a sorted (except with ``by='nosort'``) or sliced
+        collection.
+        """
+        if (self._sort is not None and self._sort.get('by') != 'nosort') or self._sort_limits:
+            raise ImplementationError('Cannot use `update` on a sorted or sliced collection')
+        if not values:
+            raise ValueError('`update` requires at least one field value.')
+        for field_name in values:
+            if self.model._field_is_pk(field_name):
+                raise ValueError('The pk cannot be updated.')
+            field = self.model.get_class_field(field_name)
+            if not isinstance(field, SingleValueField):
+                raise ValueError('Only fields holding a single value can be updated.')
+            if field.unique:
+                raise ValueError('The unique field "%s" cannot be updated.' % field_name)
+            if lua and field_name not in self.model._instancehash_fields:
+                raise ValueError("Only InstanceHashField can be used here.")
+            if values[field_name] is None:
+                raise ValueError('The field "%s" cannot be updated to None.' % field_name)
+            # convert the values once for all (like instances for related fields)
+            values[field_name] = field.from_python(values[field_name])
+
+        bulk_update = self.model._bulk_update_lua if lua else self.model._bulk_update
+        count = 0
+        for pks in self.clone()._iterate_chunks(chunk_size):
+            count += bulk_update(pks, values)
+        return count
+
+    def _iterate(self, chunk_size):
+        """
+        The generator returned by ``iterator``: yield the results of each chunk
+        of pks got by ``_iterate_chunks``.
+        """
+        for pks in self._iterate_chunks(chunk_size):
+            for result in self._iterate_chunk(pks):
+                yield result
+
+    def _iterate_chunks(self, chunk_size):
+        """
+        Scan the final set and yield the pks by chunks of about `chunk_size`,
+        deleting the final set at the end if temporary.
+        """
+        try:
+            pk = self._get_pk()
+        except ValueError:
+            return
+        if pk is not None and not self.model.get_field('pk').exists(pk):
+            return
+
+        sort_options = self._prepare_sort_options(bool(pk))
+        final_set, delete_set_later = self._get_final_set(self._lazy_collection['sets'], pk, sort_options)
+
+        if final_set is None:
+            if pk is not None and not self._lazy_collection['sets']:
+                yield [pk]
+            return
+
+        try:
+            cursor = 0
+            while True:
+                # keep the temporary final set alive while iterating
+                cursor, members = self._scan_final_set(
+                    final_set, cursor, chunk_size, self.FINAL_SET_TTL if delete_set_later else None)
+                if members:
+                    yield members
+                if not int(cursor):
+                    break
+        finally:
+            if delete_set_later:
+                self.connection.delete(final_set)
+
+    def _scan_final_set(self, final_set, cursor, count, ttl=None):
+        """
+        Return the next cursor and the members of the final set, as returned by
+        SSCAN for the given `cursor` and `count`. If `ttl` is given, the final
+        set will expire in `ttl` seconds (set in the same call to redis).
+        """
+        with self.connection.pipeline(transaction=False) as pipeline:
+            pipeline.sscan(final_set, cursor, count=count)
+            if ttl:
+                pipeline.expire(final_set, ttl)
+            return pipeline.execute()[0]
+
+    def _iterate_chunk(self, pks):
+        """
+        Yield the results for the given chunk of pks got by ``iterator``:
+        the pks, or the instances if asked (checking the existence of all the
+        pks of the chunk in one call if not lazy).
+        """
+        if not self._instances:
+            for pk in pks:
+                yield pk
+            return
+
+        if not self._lazy_instances:
+            self._check_existing_pks(pks)
+        self._prepare_instances(pks)
+        for pk in pks:
+            try:
+                yield self._to_instance(pk)
+            except DoesNotExist:
+                continue
+
+    def _apply_keyset(self, **keyset):
+        if self._keyset is None:
+            self._keyset = {'after': NotProvided, 'limit': None}
+        self._keyset.update(keyset)
+        return self
+
+    def after(self, cursor):
+        """
+        Ask the collection, that must be sorted by a field having a range index
+        (``NumberRangeIndex`` or ``TextRangeIndex``), to return only results
+        after the given cursor: the pk of the last result of the previous page,
+        or a tuple with the value of the field and the pk (useful if this
+        instance was deleted or updated).
+        The results are read directly from the sorted set of the index, so a
+        page costs O(log(N) + n) instead of a full SORT. Use ``limit`` to set
+        the size of the page.
+        Instances without value for the field are not returned.
+        For a ``TextRangeIndex``, the results are in the order of the members
+        of the index (``value<separator>pk``), which can differ from the one of
+        ``SORT ALPHA`` when a value is the start of another one followed by
+        characters sorting below the separator (``10`` is before ``1``).
+        """
+        return self.clone()._apply_keyset(after=cursor)
+
+    def limit(self, num):
+        """
+        Set the maximum number of results to return when using keyset pagination
+        (see ``after``). Can be used without ``after`` to get the first page.
+        """
+        return self.clone()._apply_keyset(limit=num)
+
+    def _get_keyset_index(self):
+        """
+        Return the range index of the field used to sort the collection, to be
+        used for keyset pagination, and if the sort is descending.
+        """
+        by = (self._sort or {}).get('by')
+        for field_name in self.model._fields:
+            field = self.model.get_field(field_name)
+            if by and field.indexable and field._field_parts == 1 and field.sort_wildcard == by:
+                indexes = [index for index in field._indexes
+                           if isinstance(index, BaseRangeIndex) and index.script_kind]
+                # prefer an index storing the full value
+                indexes.sort(key=lambda index: bool(index.prefix))
+                if indexes:
+                    return indexes[0], bool(self._sort.get('desc'))
+                break
+        raise ImplementationError('Keyset pagination needs a collection sorted by a field '
+                                  'with a NumberRangeIndex or a TextRangeIndex')
+
+    def _fetch_keyset_page(self, apply_slice=None):
+        """
+        Retrieve the page of results asked by ``after`` and/or ``limit``, by
+        reading the sorted set of the index of the sort field, in a lua script,
+        keeping only the pks that are in the final set.
+        """
+        index, desc = self._get_keyset_index()
+        if self._lazy_collection['pks']:
+            raise ImplementationError('Keyset pagination cannot be used with a filter on the pk')
+
+        index_key = index.get_storage_key(None)
+        cursor = self._keyset['after']
+        cursor_value = cursor_pk = ''
+        if cursor is not NotProvided:
+            if isinstance(cursor, tuple):
+                cursor_value, cursor_pk = cursor
+                cursor_value = index.normalize_value(cursor_value)
+            else:
+                cursor_pk = self.model.get_field('pk').normalize(cursor)
+                if index.script_kind == 'number':
+                    cursor_value = self.connection.zscore(index_key, cursor_pk)
+                else:
+                    cursor_value = index.field.get_for_instance(cursor_pk).proxy_get()
+                    if cursor_value is not None:
+                        cursor_value = index.normalize_value(cursor_value)
+                if cursor_value is None:
+                    raise ValueError('No value found in the index of the field %s for the pk %s, '
+                                     'pass the cursor as a (value, pk) tuple' % (
+                                         index.field.name, cursor_pk))
+            if index.script_kind == 'number':
+                cursor_value = repr(float(cursor_value))
+
+        final_set, delete_set_later = self._get_final_set(self._lazy_collection['sets'], None, None)
+        if final_set is None:
+            # a filter without result (like an empty `__in`)
+            self._cache_empty_collection()
+            return
+        limit = self._keyset['limit'] or 0
+        has_cursor = cursor is not NotProvided
+        results = []
+        try:
+            while True:
+                # all the members of the index are in the whole collection, no need to check them
+                check_set = '' if final_set == self.model.get_field('pk').collection_key else final_set
+                page, continuation = self.model.database.call_script(
+                    # be sure to use the script dict at the class level
+                    # to avoid registering it many times
+                    script_dict=CollectionManager.keyset_script,
+                    keys=[index_key, check_set, self._unique_key('keyset')],
+                    args=[
+                        index.script_kind,
+                        1 if desc else 0,
+                        limit - len(results) if limit else 0,
+                        1 if has_cursor else 0,
+                        cursor_value,
+                        cursor_pk,
+                        index.script_extra,
+                        self.KEYSET_SCAN_SIZE,
+                    ],
+                )
+                results.extend(page)
+                if not continuation or (limit and len(results) >= limit):
+                    break
+                # not enough results in the members read by the script, continue after the last one
+                has_cursor = True
+                cursor_value, cursor_pk = index._extract_value_from_storage(normalize(continuation))
+        finally:
+            if delete_set_later:
+                self.connection.delete(final_set)
+
+        self._len_mode = False
+        self._collection_cache, self._cache_iterator_function = self._prepare_results(
+            results, apply_slice=apply_slice)
+        self._len = len(self._collection_cache)
+
+    def cache(self, enabled=True, ttl=None):
+        """
+        Ask the collection to keep the final set computed for its filters (the
+        intersection of the index sets) in redis, for ``ttl`` seconds (default
+        to the ``CACHE_TTL`` class attribute), to be reused by the next
+        collections with the same filters, instead of computing it again.
+        The model must have ``cache_collections`` set to True: each write in an
+        index key then increments its version, and a cached set depending on an
+        updated key is not used anymore.
+        Only filters on the indexes handled by the single-call script (see
+        ``single_call``) can be cached.
+        """
+        if enabled and not self.model.cache_collections:
+            raise ImplementationError('The model %s must have `cache_collections` set to True '
+                                      'to cache its collections' % self.model.__name__)
+        clone = self.clone()
+        clone._cache_ttl = (ttl or self.CACHE_TTL) if enabled else None
+        return clone
+
+    def single_call(self, enabled=True):
+        """
+        Ask the collection to be computed in only one call to redis, by a lua
+        script doing all the work (filters, intersection, sort, slice...),
+        instead of one call for each step. If a filter cannot be applied by
+        this script (see ``BaseIndex.get_script_filter_sources``), the
+        collection is computed the normal way.
+        The default is defined by the ``SINGLE_CALL`` class attribute.
+        """
+        clone = self.clone()
+        clone._single_call = enabled
+        return clone
+
     def _unique_key(self, prefix=None):
         """
         Create a unique key.
@@ -861,7 +1804,4 @@ class CollectionManager(object):
         prefix_parts = [self.model._name, '__collection__']
         if prefix:
             prefix_parts.append(prefix)
-        return unique_key(
-            self.connection,
-            prefix=make_key(*prefix_parts)
-        )
+        return unique_key(prefix=make_key(*prefix_parts))
@@ -12,9 +12,9 @@ from limpyd.model import RedisModel
 from limpyd.collection import CollectionManager, ParsedFilter
 from limpyd.fields import (SetField, ListField, SortedSetField, MultiValuesField,
                            RedisField, SingleValueField)
-from limpyd.exceptions import DoesNotExist
+from limpyd.exceptions import DoesNotExist, ImplementationError
 from limpyd.contrib.database import PipelineDatabase
-from limpyd.utils import make_key
+from limpyd.utils import make_key, TMP_KEY_TTL
 
 SORTED_SCORE = 'sorted_score'
 DEFAULT_STORE_TTL = 60
@@ -35,6 +35,7 @@ class ExtendedCollectionManager(CollectionManager):
                 for i, member in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
                     redis.call('sadd', KEYS[2], member)
                 end
+                redis.call('expire', KEYS[2], ARGV[1])
                 return 1
             """,
         },
@@ -74,7 +75,8 @@ class ExtendedCollectionManager(CollectionManager):
             # be sure to use the script dict at the class level
             # to avoid registering it many times
             script_dict=self.__class__.scripts['list_to_set'],
-            keys=[list_key, set_key]
+            keys=[list_key, set_key],
+            args=[TMP_KEY_TTL]
         )
 
     def _fetch_collection(self, apply_slice=None):
@@ -94,6 +96,14 @@ class ExtendedCollectionManager(CollectionManager):
 
         super(ExtendedCollectionManager, self)._fetch_collection(apply_slice=apply_slice)
 
+    def _get_script_filters(self):
+        """
+        The single-call script doesn't handle the features of this collection
+        manager (sorted sets, lists, values, stored collections...), so the
+        collection is always computed the normal way.
+        """
+        return None
+
     def _prepare_sets(self, sets):
         """
         The original "_prepare_sets" method simply return the list of sets in
@@ -166,7 +176,7 @@ class ExtendedCollectionManager(CollectionManager):
             elif isinstance(set_, tuple) and len(set_):
                 # if we got a list or set, create a redis set to hold its values
                 tmp_key = self._unique_key('tmp')
-                conn.sadd(tmp_key, *set_)
+                self._store_tmp_key('sadd', tmp_key, *set_)
                 add_key(tmp_key, 'set', True)
             else:
                 raise ValueError('Invalid filter type')
@@ -237,7 +247,7 @@ class ExtendedCollectionManager(CollectionManager):
         If we have a least a sorted set, use zinterstore insted of sunionstore
         """
         if self._has_sortedsets:
-            self.connection.zinterstore(final_set, list(sets))
+            self._store_tmp_key('zinterstore', final_set, list(sets))
         else:
             final_set = super(ExtendedCollectionManager, self)._combine_sets(sets, final_set)
         return final_set
@@ -303,6 +313,70 @@ class ExtendedCollectionManager(CollectionManager):
         # normal call
         return super(ExtendedCollectionManager, self)._collection_length(final_set)
 
+    def iterator(self, chunk_size=1000):
+        """
+        In addition to the default checks, a collection sorted by score cannot
+        be iterated this way.
+        Values asked via ``values`` or ``values_list`` are retrieved for each
+        chunk in one call to redis.
+        """
+        if self._sort_by_sortedset:
+            raise ImplementationError('Cannot use `iterator` on a collection sorted by score')
+        return super(ExtendedCollectionManager, self).iterator(chunk_size)
+
+    def _fetch_keyset_page(self, apply_slice=None):
+        """
+        Keyset pagination (``after`` and ``limit``) only works on sets of pks,
+        so it cannot be used with sorted sets, nor to retrieve values.
+        """
+        if self._sort_by_sortedset or self._has_sortedsets:
+            raise ImplementationError('Cannot use keyset pagination with sorted sets')
+        if self._values:
+            raise ImplementationError('Cannot use keyset pagination with `values` or `values_list`')
+        return super(ExtendedCollectionManager, self)._fetch_keyset_page(apply_slice=apply_slice)
+
+    def _scan_final_set(self, final_set, cursor, count, ttl=None):
+        """
+        Use ZSCAN if the final set is a sorted set, or LRANGE (the cursor being
+        the position in the list) for a stored collection without other filter.
+        """
+        if self.stored_key and not self._lazy_collection['sets']\
+                and len(self._lazy_collection['intersects']) == 1:
+            members = self.connection.lrange(final_set, cursor, cursor + count - 1)
+            return (cursor + count if len(members) == count else 0), members
+
+        if not self._has_sortedsets:
+            return super(ExtendedCollectionManager, self)._scan_final_set(final_set, cursor, count, ttl)
+
+        with self.connection.pipeline(transaction=False) as pipeline:
+            pipeline.zscan(final_set, cursor, count=count)
+            if ttl:
+                pipeline.expire(final_set, ttl)
+            cursor, members = pipeline.execute()[0]
+        return cursor, [member for member, score in members]
+
+    def _iterate_chunk(self, pks):
+        """
+        If values are asked, retrieve them for all the given pks at once, with a
+        SORT command on a temporary set holding these pks.
+        """
+        if not self._values:
+            for result in super(ExtendedCollectionManager, self)._iterate_chunk(pks):
+                yield result
+            return
+
+        tmp_key = self._unique_key('tmp')
+        with self.connection.pipeline(transaction=True) as pipeline:
+            pipeline.sadd(tmp_key, *pks)
+            pipeline.sort(tmp_key, by='nosort', get=self._values['fields']['keys'])
+            pipeline.delete(tmp_key)
+            results = pipeline.execute()[1]
+
+        if self._values['mode'] != 'flat':
+            results = zip(*([iter(results)] * len(self._values['fields']['names'])))
+        for result in results:
+            yield self._to_values_dict(result) if self._values['mode'] == 'dicts' else result
+
     def _apply_sort(self, **parameters):
         """
         Enhance the default sort method to accept a new parameter "by_score", to
@@ -388,7 +462,6 @@ class ExtendedCollectionManager(CollectionManager):
 
         # create a temporary key for each (value,score) tuple
         base_tmp_key = self._unique_key('tmp')
-        conn.set(base_tmp_key, 'working...')  # only to "reserve" the main tmp key
         tmp_keys = set()
         # use a mapping dict (tmp_key_with_value=>score) to use in mset
         mapping = {}
@@ -396,8 +469,14 @@ class ExtendedCollectionManager(CollectionManager):
             tmp_key = make_key(base_tmp_key, value)
             tmp_keys.add(tmp_key)
             mapping[tmp_key] = score
-        # set all keys in one call
-        conn.mset(mapping)
+        # set all keys in one call, each with a time to live
+        with conn.pipeline(transaction=False) as pipeline:
+            pipeline.set(base_tmp_key, 'working...', ex=TMP_KEY_TTL)  # only to "reserve" the main tmp key
+            if mapping:
+                pipeline.mset(mapping)
+                for tmp_key in tmp_keys:
+                    pipeline.expire(tmp_key, TMP_KEY_TTL)
+            pipeline.execute()
 
         return base_tmp_key, tmp_keys
 
@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+from future.builtins import object
+
+import time
+
+
+class DeferredIndexingWorker(object):
+    """
+    A worker to process the deferred indexing queues of some models (models
+    with `deferred_indexing` set to True), to be run in a background thread or
+    process.
+
+    >>> worker = DeferredIndexingWorker([MyModel, MyOtherModel])
+    >>> worker.run()  # loop until `worker.stop()` is called
+
+    """
+
+    def __init__(self, models, batch_size=1000, interval=0.1, timeout=300):
+        """
+        `models` is the list of models to process, `batch_size` the maximum
+        number of events to process at once for a model, `interval` the
+        number of seconds to wait when the queues are empty, and `timeout` the
+        number of seconds after which the events of a batch not processed (for
+        example if the worker was killed) are put back in the queue.
+        """
+        self.models = list(models)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self._stopped = False
+
+    def run_once(self):
+        """
+        Process one batch of events for each model, and return the total
+        number of events processed.
+        """
+        return sum(model.process_deferred_indexing(batch_size=self.batch_size, timeout=self.timeout)
+                   for model in self.models)
+
+    def run(self, stop_when_empty=False):
+        """
+        Process the queues until `stop` is called, or, if `stop_when_empty` is
+        True, until all the queues are empty.
+        """
+        self._stopped = False
+        while not self._stopped:
+            if not self.run_once():
+                if stop_when_empty:
+                    break
+                time.sleep(self.interval)
+
+    def stop(self):
+        """
+        Ask the worker to stop after its current batch.
+        """
+        self._stopped = True
@@ -7,7 +7,7 @@ from itertools import chain, product
 from logging import getLogger
 
 from limpyd.contrib.collection import ExtendedCollectionManager
-from limpyd.exceptions import ImplementationError
+from limpyd.exceptions import ImplementationError, UniquenessError
 from limpyd.fields import SingleValueField, HashField, MultiValuesField
 from limpyd.indexes import BaseIndex, NumberRangeIndex, TextRangeIndex, EqualIndex, _MultiFieldsIndexMixin
 from limpyd.utils import cached_property, unique_key
@@ -179,6 +179,17 @@ class MultiIndexes(BaseIndex):
         """
         self.get_unique_index().check_uniqueness(pk, *self.prepare_args(args, transform=False))
 
+    def check_uniqueness_many(self, entries):
+        """For a unique index, check that many values are not used twice
+
+        For the parameters, seen BaseIndex.check_uniqueness_many
+
+        """
+        self.get_unique_index().check_uniqueness_many([
+            (pk, self.prepare_args(args, transform=False))
+            for pk, args in entries
+        ])
+
     def add(self, pk, *args, **kwargs):
         """Add the instance tied to the field to all the indexes
 
@@ -206,6 +217,41 @@ class MultiIndexes(BaseIndex):
         for index in self._indexes:
             index.remove(pk, *args, **kwargs)
 
+    def get_entries(self, pk, *args, **kwargs):
+        """Get the entries that all the indexes store
+
+        For the parameters, see BaseIndex.get_entries
+
+        """
+        args = self.prepare_args(args)
+
+        entries = []
+        for index in self._indexes:
+            entries.extend(index.get_entries(pk, *args, **kwargs))
+        return entries
+
+    def get_entries_other_fields(self):
+        """Get the other fields whose values are needed by the indexes
+
+        For the parameters, see BaseIndex.get_entries_other_fields
+
+        """
+        fields = []
+        for index in self._indexes:
+            fields.extend(field for field in index.get_entries_other_fields() if field not in fields)
+        return fields
+
+    def get_storing_indexes(self):
+        """Get the indexes storing the entries, ie all the managed ones
+
+        For the parameters, see BaseIndex.get_storing_indexes
+
+        """
+        indexes = []
+        for index in self._indexes:
+            indexes.extend(index.get_storing_indexes())
+        return indexes
+
     def get_filtered_keys(self, suffix, *args, **kwargs):
         """Returns the index keys to be used by the collection for the given args
 
@@ -219,6 +265,42 @@ class MultiIndexes(BaseIndex):
             if index.can_handle_suffix(suffix):
                 return index.get_filtered_keys(suffix, *args, **kwargs)
 
+    def get_script_filter_sources(self, suffix, *args, **kwargs):
+        """Returns the sources of pks to be used by the single-call collection script
+
+        For the parameters, see BaseIndex.get_script_filter_sources
+
+        """
+
+        args = self.prepare_args(args, transform=False)
+
+        for index in self._indexes:
+            if index.can_handle_suffix(suffix):
+                return index.get_script_filter_sources(suffix, *args, **kwargs)
+
+    def get_version_entry(self, key, suffix=None):
+        """Get the entry of the hash of the index versions from the index handling the suffix
+
+        For the parameters, see BaseIndex.get_version_entry
+
+        """
+        for index in self._indexes:
+            if index.can_handle_suffix(suffix):
+                return index.get_version_entry(key, suffix)
+        return key
+
+    def get_sort_storage_key(self):
+        """Returns the key of the first managed index that can be used to sort
+
+        For the parameters, see BaseIndex.get_sort_storage_key
+
+        """
+        for index in self._indexes:
+            key = index.get_sort_storage_key()
+            if key is not None:
+                return key
+        return None
+
     def get_all_storage_keys(self):
         """Returns the keys to be removed by `clear` in aggressive mode
 
@@ -346,6 +428,14 @@ class _BaseRelatedIndex(BaseIndex):
         attrs['related_index_class'] = related_index_class
         return name, attrs, kwargs
 
+    def get_entries(self, pk, *args, **kwargs):
+        """Nothing is stored by this index, the entries are the ones of the related index"""
+        return []
+
+    def get_storing_indexes(self):
+        """Nothing is stored by this index, the entries are the ones of the related index"""
+        return []
+
 
 class _ScoredEqualIndex_RelatedIndex(_BaseRelatedIndex):
     """Index attached to the "score field" of ``ScoredEqualIndex``
@@ -389,6 +479,7 @@ class ScoredEqualIndex(EqualIndex):
 
     key = 'equal-scored'
     supported_key_types = {'zset'}
+    storage_key_type = 'zset'
 
     score_field = None
     configurable_attrs = EqualIndex.configurable_attrs | {'score_field'}
@@ -502,12 +593,47 @@ class ScoredEqualIndex(EqualIndex):
     def get_uniqueness_key(self, base_key):
         return self.field.make_key(base_key, '__uniqueness__')
 
-    def get_uniqueness_members(self, key):
-        """Get from redis all the members of the given index `key` used to check for uniqueness.
+    def get_lockfree_write_args(self, value, unique=False):
+        """This index cannot be updated by the lock-free write script of a field
+
+        For the parameters, see ``BaseIndex.get_lockfree_write_args``
+        """
+        return BaseIndex.get_lockfree_write_args(self, value, unique)
+
+    def get_script_filter_sources(self, suffix, *args, **kwargs):
+        """This index returns sorted sets, that cannot be used by the single-call collection script
 
-        For the parameters, see ``EqualIndex.get_uniqueness_members``
+        For the parameters, see ``BaseIndex.get_script_filter_sources``
         """
-        return super(ScoredEqualIndex, self).get_uniqueness_members(self.get_uniqueness_key(key))
+        return None
+
+    def get_entries(self, pk, *args, **kwargs):
+        """Get the entries that ``add`` stores: the pk in the sorted set of the value, with the
+        score read from the score field, and the pk in the uniqueness set if the field is unique
+
+        For the parameters, see ``BaseIndex.get_entries``
+
+        """
+        key = self.get_storage_key(*args)
+        entries = []
+        if self.handle_uniqueness and self.field.unique:
+            entries.append((self.get_uniqueness_key(key), str(pk), None))
+        other_values = kwargs.get('other_values') or {}
+        if self.score_field.name in other_values:
+            score = other_values[self.score_field.name]
+        else:
+            score = self.score_field.get_for_instance(pk).proxy_get()
+        if score is not None:
+            entries.append((key, str(pk), float(score)))
+        return entries
+
+    def get_entries_other_fields(self):
+        """The score field is needed to get the entries
+
+        For the parameters, see ``BaseIndex.get_entries_other_fields``
+
+        """
+        return [self.score_field]
 
     def store(self, key, pk, **kwargs):
         """Store data in the index in redis
@@ -526,10 +652,11 @@ class ScoredEqualIndex(EqualIndex):
         """
         score = kwargs.get('score') if 'score' in kwargs else self.score_field.get_for_instance(pk).proxy_get()
         if self.handle_uniqueness and self.field.unique:
-            self.connection.sadd(self.get_uniqueness_key(key), pk)
+            self.write_connection.sadd(self.get_uniqueness_key(key), pk)
         if score is None:
             return False
-        self.connection.zadd(key, {pk: score})
+        self.write_connection.zadd(key, {pk: score})
+        self.bump_version(key)
         return True
 
     def unstore(self, key, pk, **kwargs):
@@ -538,8 +665,9 @@ class ScoredEqualIndex(EqualIndex):
         For the parameters, see ``EqualIndex.unstore``
         """
         if self.handle_uniqueness and self.field.unique:
-            self.connection.sadd(self.get_uniqueness_key(key), pk)
-        self.connection.zrem(key, pk)
+            self.write_connection.sadd(self.get_uniqueness_key(key), pk)
+        self.write_connection.zrem(key, pk)
+        self.bump_version(key)
         return True
 
     def score_updated(self, pk, new_score):
@@ -558,9 +686,9 @@ class ScoredEqualIndex(EqualIndex):
             if parts[-1] is None:
                 continue
             if new_score is None:
-                self.remove(pk, *parts, score=new_score)
+                self._for_each_version(self.remove, pk, *parts, score=new_score)
             else:
-                self.add(pk, *parts, score=new_score, check_uniqueness=False)
+                self._for_each_version(self.add, pk, *parts, score=new_score, check_uniqueness=False)
 
         self._reset_rollback_cache(pk)
 
@@ -913,7 +1041,7 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
                 ])
 
             get_unique_value = get_unique_value_func(key_entry) if self.unique else None
-            keys.append((self.field.make_key(*parts), get_unique_value))
+            keys.append((self.make_key(*parts), get_unique_value))
 
         return keys
 
@@ -933,6 +1061,42 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
 
         if not self.unique:
             return
+        self._check_uniqueness_in_keys(None, self._get_storage_keys_at_init(values))
+
+    def check_uniqueness_at_init_many(self, values_list):
+        """Check uniqueness of the values of many instances at once, with one round trip to redis
+
+        For the parameters, see ``_MultiFieldsIndexMixin.check_uniqueness_at_init_many``
+        """
+        if not self.unique:
+            return
+
+        keys = list(chain.from_iterable(
+            [(num, key, get_unique_value) for key, get_unique_value in self._get_storage_keys_at_init(values)]
+            for num, values in enumerate(values_list)
+        ))
+
+        seen = {}
+        for num, key, get_unique_value in keys:
+            if seen.setdefault(key, num) != num:
+                raise UniquenessError(
+                    'Value "%s" used many times for %s' % (get_unique_value(), self.unique_index_name)
+                )
+
+        with self.connection.pipeline(transaction=False) as pipe:
+            for __, key, __ in keys:
+                pipe.smembers(self.get_uniqueness_key(key))
+            all_pks = pipe.execute()
+
+        for (__, __, get_unique_value), pks in zip(keys, all_pks):
+            self.assert_pks_uniqueness(pks, None, get_unique_value)
+
+    def _get_storage_keys_at_init(self, values):
+        """Get the storage keys, as returned by ``get_storage_keys``, for the `values` of a new instance
+
+        For the parameters, see ``_MultiFieldsIndexMixin.check_uniqueness_at_init``
+        """
+        values = dict(values)
         args = [values.pop(self.field.name)]
         other_args = {
             field.name: [
@@ -941,8 +1105,7 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
             else [(values[field.name], )]
             for field in self.other_fields
         }
-        keys = self.get_storage_keys(None, *args, other_args=other_args)
-        self._check_uniqueness_in_keys(None, keys)
+        return self.get_storage_keys(None, *args, other_args=other_args)
 
     def _check_uniqueness_in_keys(self, pk, keys):
         """Check uniqueness of pks in the given keys
@@ -1008,6 +1171,32 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
             if self.unstore(key, pk):
                 self._get_rollback_cache(pk)['deindexed_values'].add(tuple(args))  # TODO
 
+    def get_entries(self, pk, *args, **kwargs):
+        """Get the entries that ``add`` stores: the pk in each set of the values of all the fields
+
+        For the parameters, see ``BaseIndex.get_entries``
+
+        """
+        other_values = kwargs.get('other_values') or {}
+        other_args = {
+            field.name: field.get_for_instance(pk)._prepare_bulk_index_data(pk, other_values[field.name])
+            for field in self.other_fields
+            if field.name in other_values
+        }
+        if any(all(field_args[-1] is None for field_args in field_other_args)
+               for field_other_args in other_args.values()):
+            # no data for a field, so no entries
+            return []
+        return [(key, str(pk), None) for key, __ in self.get_storage_keys(pk, *args, other_args=other_args)]
+
+    def get_entries_other_fields(self):
+        """The other fields are needed to get the entries
+
+        For the parameters, see ``BaseIndex.get_entries_other_fields``
+
+        """
+        return list(self.other_fields)
+
     def other_add(self, pk, field_name, *args):
         """Called by the related index on a related field to update the index when changed
 
@@ -1026,7 +1215,7 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
         for parts in self.field._prepare_index_data(pk):
             if parts[-1] is None:
                 continue
-            self.add(pk, *parts, other_args={field_name:[args]})
+            self._for_each_version(self.add, pk, *parts, other_args={field_name: [args]})
 
         self._reset_rollback_cache(pk)
 
@@ -1048,6 +1237,6 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
         for parts in self.field._prepare_index_data(pk):
             if parts[-1] is None:
                 continue
-            self.remove(pk, *parts, other_args={field_name: [args]})
+            self._for_each_version(self.remove, pk, *parts, other_args={field_name: [args]})
 
         self._reset_rollback_cache(pk)
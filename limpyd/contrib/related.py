@@ -3,13 +3,14 @@ from __future__ import unicode_literals
 from future.builtins import map
 from future.builtins import str
 from future.builtins import object
-from future.utils import with_metaclass
+from future.utils import iteritems, with_metaclass
 
 import re
 from copy import copy
 
 from limpyd import model, fields
 from limpyd.exceptions import *
+from limpyd.utils import normalize
 from limpyd.contrib.collection import ExtendedCollectionManager
 
 # used to validate a related_name
@@ -68,31 +69,186 @@ class RelatedCollection(object):
         filters[self.related_field.name] = self.instance._pk
         return self.related_field._model.collection(**filters)
 
+    # number of related instances updated at once by `remove_instance`
+    REMOVE_CHUNK_SIZE = 1000
+
     def remove_instance(self):
         """
         Remove the instance from the related fields (delete the field if it's
         a simple one, or remove the instance from the field if it's a set/list/
-        sorted_set)
+        sorted_set).
+        See `remove_instances`.
         """
-        with fields.FieldLock(self.related_field):
-            related_pks = self()
-            for pk in related_pks:
-
-                # get the real related field
-                related_instance = self.related_field._model(pk)
-                related_field = getattr(related_instance, self.related_field.name)
+        self.remove_instances(self.related_field, [self.instance._pk])
 
-                # check if we have a dedicated remove method
-                remover = getattr(related_field, '_related_remover', None)
+    @classmethod
+    def remove_instances(cls, related_field, values):
+        """
+        Remove the given pks from the given related field of all the instances
+        of its model linked to one of them (delete the field if it's a simple
+        one, or remove the pks from the field if it's a set/list/sorted_set).
+        The related instances are found with one collection for all the pks,
+        then updated by chunks of REMOVE_CHUNK_SIZE: for each chunk, the
+        current values of the field are read in one pipeline to know which
+        ones to remove (they may have changed since the collection was read),
+        then the writes in the fields and in their indexes are sent in another
+        one, under a lock held only for this chunk.
+        """
+        related_model = related_field._model
+        field_name = related_field.name
+        database = related_model.database
+        values = [normalize(value) for value in values]
+
+        if len(values) == 1:
+            related_pks = list(related_model.collection(**{field_name: values[0]}))
+        else:
+            related_pks = list(related_model.collection(**{'%s__in' % field_name: values}))
+
+        for start in range(0, len(related_pks), cls.REMOVE_CHUNK_SIZE):
+            chunk = related_pks[start:start + cls.REMOVE_CHUNK_SIZE]
+            related_fields = [related_model.lazy_connect(pk).get_field(field_name) for pk in chunk]
+            deferred = []
+
+            with fields.FieldLock(related_field):
+                # the values may have changed since the collection was read
+                with related_model.get_connection().pipeline(transaction=False) as pipeline:
+                    for field in related_fields:
+                        field._bulk_get(pipeline)
+                    currents = pipeline.execute()
+                to_remove = []
+                for field, current in zip(related_fields, currents):
+                    if isinstance(field, fields.SingleValueField):
+                        current = [current]
+                    current = set(normalize(value) for value in current or [])
+                    to_remove.append([value for value in values if value in current])
+                try:
+                    with database.index_pipeline():
+                        pipeline = database.index_write_connection
+                        for pk, field, field_values in zip(chunk, related_fields, to_remove):
+                            for value in field_values:
+                                field._bulk_remove_related(pipeline, value)
+                            if field.deferred_indexing:
+                                deferred.append((pk, field_name))
+                finally:
+                    for pk, field in zip(chunk, related_fields):
+                        field._reset_indexes_rollback_caches(pk)
+
+            if deferred:
+                related_model._defer_indexing(deferred)
+
+            identity_map = database.current_identity_map
+            if identity_map is not None:
+                for field in related_fields:
+                    identity_map.invalidate(field.key)
+
+
+class RelatedCollectionManager(ExtendedCollectionManager):
+    """
+    The collection manager of the RelatedModel, adding a `select_related`
+    method to get the related instances of the FK fields with the instances
+    returned by the collection:
+
+        for person in Person.collection().instances().select_related('group__owner'):
+            print(person.group.instance().owner.instance().name.get())
+
+    Here the values of the `group` field of all persons, the existence of the
+    distinct groups, the values of their `owner` field and the existence of the
+    distinct owners are read in bulk (by chunks of INSTANCES_CHUNK_SIZE pks,
+    with one call to redis for each chunk), instead of a few calls for each
+    person. Calling `instance()` on these fields then returns the instances
+    already created.
+    """
 
-                # then remove the instance from the related field
-                if remover is not None:
-                    # if we have a remover method, it wants the instance as argument
-                    # (the related field may be a set/list/sorted_set)
-                    getattr(related_field, remover)(self.instance._pk)
-                else:
-                    # no remover method, simple delete the field
-                    related_field.delete()
+    def __init__(self, model):
+        super(RelatedCollectionManager, self).__init__(model)
+        self._select_related = None  # tree of the FK fields names to follow
+        self._selected_related = None  # related instances read, by pk and field name
+
+    def clone(self):
+        new = super(RelatedCollectionManager, self).clone()
+        new._select_related = self._select_related
+        return new
+
+    def select_related(self, *fields_paths):
+        """
+        Ask the collection to get the related instances of the given FK fields
+        (FKStringField or FKInstanceHashField), with the instances it returns.
+        Relations of the related instances can be followed by separating the
+        names of the fields with `__`, like `group__owner`.
+        Only used when instances are returned (see `instances`).
+        """
+        tree = {}
+        for path in fields_paths:
+            node, related_model = tree, self.model
+            for field_name in path.split('__'):
+                if not related_model.has_field(field_name) or not isinstance(
+                        related_model.get_field(field_name), SimpleValueRelatedFieldMixin):
+                    raise ValueError('"%s" is not a FK field of the model "%s"' %
+                                     (field_name, related_model.__name__))
+                related_model = self.model.database._models[related_model.get_field(field_name).related_to]
+                node = node.setdefault(field_name, {})
+        clone = self.clone()
+        clone._select_related = tree
+        return clone
+
+    def _prepare_instances(self, pks):
+        """
+        Also get the related instances asked with `select_related`.
+        """
+        super(RelatedCollectionManager, self)._prepare_instances(pks)
+        if self._select_related:
+            if self._existing_pks is not None:
+                pks = [pk for pk in pks if pk in self._existing_pks]
+            self._selected_related = self._get_related_instances(self.model, pks, self._select_related)
+
+    def _get_related_instances(self, model, pks, tree):
+        """
+        Return, for each of the given pks of the given model, a dict with the
+        related instances of the FK fields in `tree` (a dict with, for each FK
+        field name, the same kind of dict for the relations of the related
+        model). The relations of the related instances are set on them.
+        """
+        selected = {pk: {} for pk in pks}
+        chunk_size = self.INSTANCES_CHUNK_SIZE
+        for field_name, subtree in iteritems(tree):
+            related_model = model.database._models[model.get_field(field_name).related_to]
+
+            # read the values of the field for all the pks
+            values = {}
+            for start in range(0, len(pks), chunk_size):
+                chunk = pks[start:start + chunk_size]
+                with model.get_connection().pipeline(transaction=False) as pipeline:
+                    for pk in chunk:
+                        model.lazy_connect(pk).get_field(field_name)._bulk_get(pipeline)
+                    values.update(zip(chunk, pipeline.execute()))
+
+            # create the instances of the distinct related pks that exist
+            related_pks = list(set(value for value in values.values() if value is not None))
+            related_pk_field = related_model.get_field('pk')
+            instances = {}
+            for start in range(0, len(related_pks), chunk_size):
+                chunk = related_pks[start:start + chunk_size]
+                for related_pk, exists in zip(chunk, related_pk_field.exists_many(chunk)):
+                    if exists:
+                        instance = instances[related_pk] = related_model.lazy_connect(related_pk)
+                        instance._connected = True
+
+            if subtree:
+                related_selected = self._get_related_instances(related_model, list(instances), subtree)
+                for related_pk, instance in iteritems(instances):
+                    instance._selected_related = related_selected[related_pk]
+
+            for pk, value in iteritems(values):
+                if value in instances:
+                    selected[pk][field_name] = instances[value]
+
+        return selected
+
+    def _to_instance(self, pk):
+        instance = super(RelatedCollectionManager, self)._to_instance(pk)
+        if self._selected_related and pk in self._selected_related:
+            instance._selected_related = dict(self._selected_related[pk])
+        return instance
 
 
 class RelatedModel(model.RedisModel):
@@ -103,13 +259,16 @@ class RelatedModel(model.RedisModel):
     """
 
     abstract = True
-    collection_manager = ExtendedCollectionManager
+    collection_manager = RelatedCollectionManager
 
     def __init__(self, *args, **kwargs):
         """
         Create the instance then add all related collections (link between this
         instance and related fields on other models)
         """
+        # related instances got by `RelatedCollectionManager.select_related`
+        self._selected_related = None
+
         super(RelatedModel, self).__init__(*args, **kwargs)
 
         # create the related collections
@@ -126,6 +285,28 @@ class RelatedModel(model.RedisModel):
             setattr(self, related_field.related_name, collection)
             self.related_collections.append(related_field.related_name)
 
+    @classmethod
+    def _bulk_delete(cls, pks):
+        """
+        Propagate the deletion to the related collections of all the instances
+        before deleting them, with all the pks at once for each related field.
+        """
+        if pks:
+            relations = getattr(cls.database, '_relations', {}).get(cls._name.lower(), [])
+            for model_name, field_name, _ in relations:
+                related_field = cls.database._models[model_name].get_field(field_name)
+                related_field.related_collection_class.remove_instances(related_field, pks)
+        return super(RelatedModel, cls)._bulk_delete(pks)
+
+    def _discard_prefetched(self, field_names):
+        """
+        Also forget the related instances of the given fields.
+        """
+        super(RelatedModel, self)._discard_prefetched(field_names)
+        if self._selected_related:
+            for field_name in field_names:
+                self._selected_related.pop(field_name, None)
+
     def delete(self):
         """
         When the instance is deleted, we propagate the deletion to the related
@@ -369,6 +550,15 @@ class RelatedFieldMixin(with_metaclass(RelatedFieldMetaclass)):
         """
         return list(map(self.from_python, values))
 
+    def _bulk_remove_related(self, pipeline, value):
+        """
+        Queue in the given pipeline the command to remove the given related pk
+        from the field, and deindex it (the index writes going to the pipeline
+        opened by `RedisDatabase.index_pipeline`), without reading anything.
+        Used by `RelatedCollection.remove_instance`.
+        """
+        raise NotImplementedError
+
     @classmethod
     def _make_command_method(cls, command_name, many=False):
         """
@@ -418,22 +608,47 @@ class SimpleValueRelatedFieldMixin(RelatedFieldMixin):
     """
     def instance(self, lazy=False):
         """
-        Returns the instance of the related object linked by the field.
+        Returns the instance of the related object linked by the field (the one
+        got by the `select_related` method of the collection, if any)
         """
+        selected = getattr(self._instance, '_selected_related', None)
+        if selected and self.name in selected:
+            return selected[self.name]
         model = self.database._models[self.related_to]
         meth = model.lazy_connect if lazy else model
         return meth(self.proxy_get())
 
+    def _call_command(self, name, *args, **kwargs):
+        """
+        Forget the related instance got by `select_related` when the field is
+        updated.
+        """
+        if name in self.available_modifiers:
+            selected = getattr(getattr(self, '_instance', None), '_selected_related', None)
+            if selected:
+                selected.pop(self.name, None)
+        return super(SimpleValueRelatedFieldMixin, self)._call_command(name, *args, **kwargs)
+
 
 class FKStringField(SimpleValueRelatedFieldMixin, fields.StringField):
     """ Related field based on a StringField, acting as a Foreign Key """
     _commands_with_single_value_from_python = ['set', 'setnx', 'getset', ]
 
+    def _bulk_remove_related(self, pipeline, value):
+        pipeline.delete(self.key)
+        if not self.deferred_indexing:
+            self.deindex(value)
+
 
 class FKInstanceHashField(SimpleValueRelatedFieldMixin, fields.InstanceHashField):
     """ Related field based on a InstanceHashField, acting as a Foreign Key """
     _commands_with_single_value_from_python = ['hset', 'hsetnx', ]
 
+    def _bulk_remove_related(self, pipeline, value):
+        pipeline.hdel(self.key, self.name)
+        if not self.deferred_indexing:
+            self.deindex(value)
+
 
 class MultiValuesRelatedFieldMixin(RelatedFieldMixin):
     """
@@ -482,14 +697,22 @@ class M2MSetField(MultiValuesRelatedFieldMixin, fields.SetField):
     """ Related field based on a SetField, acting as a M2M """
     _commands_with_single_value_from_python = ['sismember', ]
     _commands_with_many_values_from_python = ['sadd', 'srem', ]
-    _related_remover = 'srem'
+
+    def _bulk_remove_related(self, pipeline, value):
+        pipeline.srem(self.key, value)
+        if not self.deferred_indexing:
+            self.deindex([value])
 
 
 class M2MListField(MultiValuesRelatedFieldMixin, fields.ListField):
     """ Related field based on a ListField, acting as a sorted M2M """
     _commands_with_single_value_from_python = ['lpushx', 'rpushx', ]
     _commands_with_many_values_from_python = ['lpush', 'rpush', ]
-    _related_remover = 'lrem'
+
+    def _bulk_remove_related(self, pipeline, value):
+        pipeline.lrem(self.key, 0, value)
+        if not self.deferred_indexing:
+            self.deindex([value])
 
     def linsert(self, where, refvalue, value):
         value = self.from_python(value)
@@ -508,7 +731,11 @@ class M2MSortedSetField(MultiValuesRelatedFieldMixin, fields.SortedSetField):
     """ Related field based on a SortesSetField, acting as a M2M with scores """
     _commands_with_single_value_from_python = ['zscore', 'zrank', 'zrevrank']
     _commands_with_many_values_from_python = ['zrem']
-    _related_remover = 'zrem'
+
+    def _bulk_remove_related(self, pipeline, value):
+        pipeline.zrem(self.key, value)
+        if not self.deferred_indexing:
+            self.deindex([value])
 
     def zadd(self, *args, **kwargs):
         """
@@ -3,7 +3,12 @@ from __future__ import unicode_literals
 from future.builtins import str
 from future.builtins import object
 
+from contextlib import contextmanager
+from copy import copy
+import threading
+
 import redis
+from redis.client import Pipeline
 
 from limpyd.exceptions import *
 from limpyd.indexes import EqualIndex
@@ -19,6 +24,119 @@ DEFAULT_CONNECTION_SETTINGS = dict(
 )
 
 
+class IdentityMap(object):
+    """Instances and values read in redis during an ``identity_map`` scope
+
+    It holds one instance by model and pk, so asking many times for the same pk
+    returns the same instance, and the results of the getters called on the
+    fields and instances, by key, to not read them again. The results stored
+    for a key are discarded when a modifier is called on this key.
+
+    """
+
+    def __init__(self):
+        """Prepare the empty caches"""
+        self.instances = {}
+        self.values = {}
+
+    def get_instance(self, model, pk):
+        """Get the instance of the given `model` with the given `pk`, if any
+
+        Parameters
+        ----------
+        model : Type[RedisModel]
+            The model of the instance to return
+        pk : str
+            The normalized pk of the instance to return
+
+        Returns
+        -------
+        Union[RedisModel, None]
+            The instance if already in the map, else ``None``
+
+        """
+        return self.instances.get((model, pk))
+
+    def add_instance(self, instance):
+        """Add the given instance to the map, to be returned by ``get_instance``
+
+        Parameters
+        ----------
+        instance : RedisModel
+            The instance to add. It must have a pk.
+
+        """
+        self.instances[(instance.__class__, instance._pk)] = instance
+
+    def discard_instance(self, model, pk):
+        """Remove the instance of the given `model` with the given `pk` from the map
+
+        For the parameters, see ``get_instance``
+
+        """
+        self.instances.pop((model, pk), None)
+
+    def invalidate(self, key):
+        """Discard all the results of getters read for the given redis key
+
+        Parameters
+        ----------
+        key : str
+            The redis key that was updated
+
+        """
+        self.values.pop(key, None)
+
+    def call_command(self, proxy, meth, name, args, kwargs):
+        """Call a command of a field or instance, using the cached result for a getter
+
+        If the command is a modifier, the results stored for the key of `proxy` are
+        discarded. If it's a getter and its result for the same command key (see
+        ``RedisProxyCommand._get_identity_map_command_key``) was already read, a copy
+        of it is returned without calling redis.
+
+        Parameters
+        ----------
+        proxy : RedisProxyCommand
+            The field or instance on which the command is called
+        meth : Callable
+            The method to call to really run the command
+        name : str
+            The name of the command
+        args : tuple
+            The positional arguments of the command
+        kwargs : dict
+            The named arguments of the command
+
+        Returns
+        -------
+        Any
+            The result of the command
+
+        """
+        key = proxy.key
+        if name in proxy.available_modifiers:
+            self.invalidate(key)
+            try:
+                return meth(name, *args, **kwargs)
+            finally:
+                self.invalidate(key)
+
+        if name not in proxy.available_getters or isinstance(proxy.connection, Pipeline):
+            return meth(name, *args, **kwargs)
+
+        try:
+            command_key = proxy._get_identity_map_command_key(name, args, kwargs)
+            hash(command_key)
+        except TypeError:
+            return meth(name, *args, **kwargs)
+
+        values = self.values.setdefault(key, {})
+        if command_key not in values:
+            values[command_key] = meth(name, *args, **kwargs)
+        return copy(values[command_key])
+
+
 class RedisDatabase(object):
     """
     A RedisDatabase regroups some models and handles the connection to Redis for
@@ -35,6 +153,8 @@ class RedisDatabase(object):
 
     def __init__(self, **connection_settings):
         self._connection = None  # Instance level cache
+        self._index_pipelines = threading.local()  # Pipelines used to buffer index writes
+        self._identity_maps = threading.local()  # Identity maps opened by `identity_map`
         self.reset(**(connection_settings or DEFAULT_CONNECTION_SETTINGS))
         # _models keep an entry for each defined model on this database
         self._models = dict()
@@ -182,6 +302,99 @@ class RedisDatabase(object):
             script_dict['script_object'] = self.connection.register_script(script_dict['lua'])
         return script_dict['script_object'](keys=keys, args=args, client=self.connection)
 
+    @property
+    def index_write_connection(self):
+        """
+        Return the object to use by the indexes to write their data: the pipeline
+        opened by ``index_pipeline`` in the current thread if any, else the
+        normal connection.
+        """
+        pipeline = getattr(self._index_pipelines, 'pipeline', None)
+        if pipeline is not None:
+            return pipeline
+        return self.connection
+
+    @contextmanager
+    def index_pipeline(self):
+        """Buffer all index writes done in the current thread and send them in one pipeline
+
+        To be used with ``with``. All the writes done by the indexes (via
+        ``index_write_connection``) are not sent to redis until the end of the
+        ``with`` block, where they are all sent in one round trip, in the order
+        they were asked.
+        Reads done by the indexes (for example to check uniqueness) are still
+        sent immediately.
+        If an exception is raised in the ``with`` block, the buffered writes
+        are discarded.
+        If an ``index_pipeline`` is already opened in the current thread, or if
+        the connection is already a pipeline, writes are simply sent to it.
+
+        Examples
+        --------
+
+        >>> with database.index_pipeline():
+        ...     field.deindex()
+        ...     field.index()
+
+        """
+        if getattr(self._index_pipelines, 'pipeline', None) is not None \
+                or isinstance(self.connection, Pipeline):
+            yield
+            return
+
+        pipeline = self._index_pipelines.pipeline = self.connection.pipeline(transaction=False)
+        try:
+            yield
+            self._index_pipelines.pipeline = None
+            pipeline.execute()
+        finally:
+            self._index_pipelines.pipeline = None
+            pipeline.reset()
+
+    @property
+    def current_identity_map(self):
+        """
+        Return the ``IdentityMap`` opened by ``identity_map`` in the current
+        thread, if any, else ``None``.
+        """
+        return getattr(self._identity_maps, 'identity_map', None)
+
+    @contextmanager
+    def identity_map(self):
+        """Keep the instances and the values read in redis during the ``with`` block
+
+        To be used with ``with``. In this block, getting many times the same pk of a
+        model (``Model(pk)``, ``Model.lazy_connect(pk)``, collections returning
+        instances, related fields...) returns the same instance, without checking
+        again its existence, and the getters called on the fields and instances don't
+        call redis again for the same arguments, until a modifier is called on the
+        same key.
+        Writes done outside of this block, or by other processes, are not seen.
+        If an ``identity_map`` is already opened in the current thread, it is reused.
+
+        Yields
+        ------
+        IdentityMap
+            The identity map used in the block
+
+        Examples
+        --------
+
+        >>> with database.identity_map():
+        ...     assert MyModel(1) is MyModel(1)
+
+        """
+        identity_map = self.current_identity_map
+        if identity_map is not None:
+            yield identity_map
+            return
+
+        identity_map = self._identity_maps.identity_map = IdentityMap()
+        try:
+            yield identity_map
+        finally:
+            self._identity_maps.identity_map = None
+
     def scan_keys(self, match=None, count=None):
         """Take a pattern expected by the redis `scan` command and iter on all matching keys
 
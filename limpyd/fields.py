@@ -6,12 +6,17 @@ from future.builtins import zip
 from future.utils import with_metaclass
 
 from inspect import isclass
+from itertools import chain
 from logging import getLogger
 from copy import copy
+import json
+import time
+import uuid
 
 from redis.exceptions import RedisError
 
 from limpyd.database import Lock
+from limpyd.indexes import IndexVersions
 from limpyd.utils import cached_property, make_key, normalize, NotProvided
 from limpyd.exceptions import *
 
@@ -111,8 +116,21 @@ class RedisProxyCommand(with_metaclass(MetaRedisProxy)):
 
         # Give priority to a "_call_{commmand}" method
         meth = getattr(self, '_call_%s' % name, self._traverse_command)
+
+        # Use the values already read in the current identity map, if any
+        identity_map = self.database.current_identity_map
+        if identity_map is not None and getattr(obj, '_pk', None):
+            return identity_map.call_command(self, meth, name, args, kwargs)
+
         return meth(name, *args, **kwargs)
 
+    def _get_identity_map_command_key(self, name, args, kwargs):
+        """
+        Return what identifies the result of a getter for the key of the
+        object in the identity map.
+        """
+        return (name, args, tuple(sorted(kwargs.items())))
+
     def _traverse_command(self, name, *args, **kwargs):
         """
         Add the key to the args and call the Redis command.
@@ -173,12 +191,15 @@ class RedisField(RedisProxyCommand):
     unique = False
     _copy_conf = {
         'args': [],
-        'kwargs': ['lockable', 'default', 'indexable', 'unique', ('indexes', 'index_classes')],
+        'kwargs': ['lockable', 'lock_scope', 'lockfree', 'default', 'indexable', 'unique', ('indexes', 'index_classes')],
         'attrs': ['name', '_instance', '_model']
     }
     _unique_supported = True
+    _lockfree_supported = False
+    lockfree_commands = set()  # modifiers that can be run without lock if `lockfree`
     _field_parts = 1
     default_indexes = None
+    _skip_indexing = False  # set during a command whose indexing is deferred
 
     available_getters = {'expire', 'expireat', 'pexpire', 'pexpireat', 'ttl', 'pttl', 'persist'}
     available_modifiers = set()
@@ -188,6 +209,13 @@ class RedisField(RedisProxyCommand):
         Manage all field attributes
         """
         self.lockable = kwargs.get('lockable', True)
+        self.lock_scope = kwargs.get('lock_scope', None)
+        if self.lock_scope is not None and self.lock_scope not in FieldLock.SCOPES:
+            raise ImplementationError('Invalid lock scope "%s", must be one of %s' % (
+                self.lock_scope, ', '.join(FieldLock.SCOPES)))
+        self.lockfree = kwargs.get('lockfree', False)
+        if self.lockfree and not self._lockfree_supported:
+            raise ImplementationError('%s field cannot be lock-free' % self.__class__.__name__)
         if "default" in kwargs:
             self.default = kwargs["default"]
 
@@ -451,6 +479,18 @@ class RedisField(RedisProxyCommand):
         """
         self._instance = instance
         self.lockable = self.lockable and instance.lockable
+        if self.lock_scope is None:
+            self.lock_scope = instance.lock_scope
+
+    @property
+    def deferred_indexing(self):
+        """
+        Tell if the indexing of this field is deferred, ie done later by
+        `RedisModel.process_deferred_indexing` (see `RedisModel.deferred_indexing`).
+        Unique and lock-free fields are always indexed immediately.
+        """
+        return bool(self._model.deferred_indexing and self.indexable
+                    and not self.unique and not self.lockfree)
 
     @property
     def attached_to_model(self):
@@ -477,12 +517,30 @@ class RedisField(RedisProxyCommand):
     def _call_command(self, name, *args, **kwargs):
         """
         Add lock management and call parent.
+        All the writes in the indexes done by the command are buffered, to be
+        sent to redis in one pipeline at the end of the command (or discarded
+        if an error occurs, before the indexes are restored using the rollback
+        cache).
         """
         meth = super(RedisField, self)._call_command
+        batch = getattr(getattr(self, '_instance', None), '_batch', None)
+        if batch is not None and not self.lockfree:
+            value = self._get_value_to_batch(name, *args, **kwargs)
+            if value is not NotProvided:
+                batch[self.name] = value
+                return None
+            if self.name in batch:
+                # the command needs the real value in redis
+                self._instance._flush_batch()
         if self.indexable and name in self.available_modifiers:
-            with FieldLock(self):
+            if self.lockfree:
+                return self._call_lockfree(name, *args, **kwargs)
+            if self.deferred_indexing:
+                return self._call_deferred(name, *args, **kwargs)
+            with FieldLock(self, value=self._get_value_to_lock(name, *args, **kwargs)):
                 try:
-                    result = meth(name, *args, **kwargs)
+                    with self.database.index_pipeline():
+                        result = meth(name, *args, **kwargs)
                 except:
                     if self._instance.connected:
                         self._rollback_indexes()
@@ -495,6 +553,45 @@ class RedisField(RedisProxyCommand):
         else:
             return meth(name, *args, **kwargs)
 
+    def _get_value_to_lock(self, name, *args, **kwargs):
+        """
+        Return the value that will be written by the given modifier, to be used
+        by a `FieldLock` with the "value" scope, or `NotProvided` if it cannot be
+        known in advance (the default).
+        """
+        return NotProvided
+
+    def _get_value_to_batch(self, name, *args, **kwargs):
+        """
+        Return the value to buffer if the given command can be delayed until the
+        end of a `RedisModel.batch` block, or `NotProvided` if it must be run
+        immediately (the default).
+        """
+        return NotProvided
+
+    def _call_lockfree(self, name, *args, **kwargs):
+        """
+        Run the given modifier without lock, in a lua script doing all the
+        work (reading the current value, checking uniqueness, writing the new
+        value and updating the indexes) atomically.
+        Only commands in `lockfree_commands` are allowed.
+        """
+        raise ImplementationError('%s field cannot be lock-free' % self.__class__.__name__)
+
+    def _call_deferred(self, name, *args, **kwargs):
+        """
+        Run the given modifier without lock and without touching the indexes,
+        then add an event in the deferred indexing queue of the model, for the
+        indexes to be updated later by `RedisModel.process_deferred_indexing`.
+        """
+        self._skip_indexing = True
+        try:
+            result = super(RedisField, self)._call_command(name, *args, **kwargs)
+        finally:
+            self._skip_indexing = False
+        self._model._defer_indexing([(self._instance.pk.get(), self.name)])
+        return result
+
     def _rollback_indexes(self):
         """
         Restore the index in its previous status, using deindexed/indexed values
@@ -518,11 +615,38 @@ class RedisField(RedisProxyCommand):
     def _prepare_index_data(self, pk, values=None):
         raise NotImplementedError
 
+    def _bulk_set(self, pipeline, value):
+        """
+        Queue in the given pipeline the command to set the given value, as
+        `proxy_set` would do, but without any index management, and return the
+        values to pass to `_prepare_index_data` to index them.
+        Used by `RedisModel.bulk_create`.
+        """
+        raise NotImplementedError
+
+    def _bulk_get(self, pipeline):
+        """
+        Queue in the given pipeline the command to get the value(s) of the
+        field, as `proxy_get` would do.
+        Used by `RedisModel.batch` and the bulk operations on collections.
+        """
+        raise NotImplementedError
+
+    def _prepare_bulk_index_data(self, pk, value):
+        """
+        Return the data to index, as `_prepare_index_data` does, from the
+        value(s) read by `_bulk_get`.
+        Used by the rebuild of the indexes.
+        """
+        return self._prepare_index_data(pk, value)
+
     def _index(self, values, only_index=None):
         """
         Handle field index process.
         """
         assert self.indexable, "Field not indexable"
+        if self._skip_indexing:
+            return
         if only_index:
             indexes = [self.get_index(
                 index_class=only_index.__class__, key=only_index.key, prefix=only_index.prefix
@@ -533,10 +657,28 @@ class RedisField(RedisProxyCommand):
         pk = self._instance.pk.get()
         values = self._prepare_index_data(pk, values)
 
+        self._add_to_indexes(indexes, pk, values, bool(self.unique))
+
+    def _add_to_indexes(self, indexes, pk, values, check_uniqueness):
+        """
+        Add the given values, as returned by `_prepare_index_data`, to the
+        given indexes, checking the uniqueness only once for each value.
+        During a shadow rebuild, the version being built gets the writes too.
+        """
+        self._add_to_indexes_version(indexes, pk, values, check_uniqueness)
+        building = self._get_index_version_being_built()
+        if building:
+            with self._index_versions.force(building):
+                self._add_to_indexes_version(indexes, pk, values, False)
+
+    def _add_to_indexes_version(self, indexes, pk, values, check_uniqueness):
+        """
+        Do the work of `_add_to_indexes` for the current version.
+        """
         for parts in values:
             value = parts[-1]
             if value is not None:
-                needs_to_check_uniqueness = bool(self.unique)
+                needs_to_check_uniqueness = check_uniqueness
 
                 for index in indexes:
                     index.add(
@@ -554,6 +696,8 @@ class RedisField(RedisProxyCommand):
         Run process of deindexing field value(s).
         """
         assert self.indexable, "Field not indexable"
+        if self._skip_indexing:
+            return
         if only_index:
             indexes = [self.get_index(
                 index_class=only_index.__class__, key=only_index.key, prefix=only_index.prefix
@@ -564,12 +708,49 @@ class RedisField(RedisProxyCommand):
         pk = self._instance.pk.get()
         values = self._prepare_index_data(pk, values)
 
+        self._remove_from_indexes(indexes, pk, values)
+
+    def _remove_from_indexes(self, indexes, pk, values):
+        """
+        Remove the given values, as returned by `_prepare_index_data`, from
+        the given indexes.
+        During a shadow rebuild, the version being built gets the writes too.
+        """
+        self._remove_from_indexes_version(indexes, pk, values)
+        building = self._get_index_version_being_built()
+        if building:
+            with self._index_versions.force(building):
+                self._remove_from_indexes_version(indexes, pk, values)
+
+    def _remove_from_indexes_version(self, indexes, pk, values):
+        """
+        Do the work of `_remove_from_indexes` for the current version.
+        """
         for parts in values:
             value = parts[-1]
             if value is not None:
                 for index in indexes:
                     index.remove(pk, *parts)
 
+    @cached_property
+    def _index_versions(self):
+        """
+        The versions of the keys of the indexes of the field, shared by the
+        field of the model and the ones of its instances (see `IndexVersions`).
+        """
+        if self.attached_to_instance:
+            return self._model.get_field(self.name)._index_versions
+        return IndexVersions(self)
+
+    def _get_index_version_being_built(self):
+        """
+        Return the version of the indexes being built by a shadow rebuild, if
+        any, which must get the index writes too.
+        """
+        if not self._model.versioned_indexes:
+            return None
+        return self._index_versions.building
+
     def clear_indexes(self, chunk_size=1000, aggressive=False):
         """Clear all indexes tied to this field
 
@@ -604,7 +785,7 @@ class RedisField(RedisProxyCommand):
         for index in self._indexes:
             index.clear(chunk_size=chunk_size, aggressive=aggressive)
 
-    def rebuild_indexes(self, chunk_size=1000, aggressive_clear=False):
+    def rebuild_indexes(self, chunk_size=1000, aggressive_clear=False, workers=None, shadow=False):
         """Rebuild all indexes tied to this field
 
         Parameters
@@ -615,12 +796,27 @@ class RedisField(RedisProxyCommand):
             Will be passed to the `aggressive` argument of the `clear_indexes` method.
             If `False`, all values will be normally deindexed. If `True`, the work
             will be done at low level, scanning for keys that may match the ones used by the indexes
+        workers: Optional[int]
+            If more than ``1``, each index is rebuilt in parallel by this number of processes,
+            into temporary keys replacing the ones of the index at the end.
+            See ``BaseIndex.rebuild``.
+        shadow: bool
+            Default to ``False``. If ``True``, the model must have ``versioned_indexes``, and
+            the indexes are built under a new version while the current one is still used (the
+            writes going to both), then this new version is activated, and the keys of the
+            old one are deleted with ``UNLINK``. See ``IndexVersions``.
+            ``aggressive_clear`` and ``workers`` are not used.
 
         Raises
         ------
         AssertionError
             If called from an instance field. It must be called from the model field
             Also raised if the field is not indexable
+        ImplementationError
+            If ``shadow`` is used on a field of a model without ``versioned_indexes``, or on a
+            lock-free field
+        LimpydException
+            If ``shadow`` is used while a shadow rebuild is already running for this field
 
         Examples
         --------
@@ -633,8 +829,258 @@ class RedisField(RedisProxyCommand):
         assert self.attached_to_model, \
             '`rebuild_indexes` can only be called on a field attached to the model'
 
+        if shadow:
+            self._shadow_rebuild_indexes(chunk_size)
+            return
+
         for index in self._indexes:
-            index.rebuild(chunk_size=chunk_size, aggressive_clear=aggressive_clear)
+            index.rebuild(chunk_size=chunk_size, aggressive_clear=aggressive_clear, workers=workers)
+
+    def _shadow_rebuild_indexes(self, chunk_size):
+        """
+        Build the indexes under a new version, activate it, then delete the
+        keys of the previous one. See `rebuild_indexes`.
+        """
+        if not self._model.versioned_indexes:
+            raise ImplementationError('Shadow rebuilds need `versioned_indexes` on the model %s' %
+                                      self._model.__name__)
+        if self.lockfree:
+            # the lua script of lock-free writes cannot write to two versions
+            raise ImplementationError('Indexes of the lock-free field %s cannot be rebuilt in shadow' %
+                                      self.name)
+
+        versions = self._index_versions
+        connection = self.connection
+        previous, building = versions.get_state(refresh=True)
+        if building:
+            raise LimpydException('Indexes of the field %s are already being rebuilt' % self.name)
+
+        version = str(connection.hincrby(versions.key, 'last', 1))
+        connection.hset(versions.key, 'building', version)
+        # let the other processes see the new version, so they write to it too: the
+        # versions are cached for `cache_ttl`, and a write may already be in flight
+        # when they are refreshed, so wait twice this delay
+        time.sleep(2 * versions.cache_ttl)
+
+        try:
+            with versions.force(version):
+                for index in self._indexes:
+                    index.walk(index.add, chunk_size=chunk_size)
+        except:
+            connection.hdel(versions.key, 'building')
+            self._unlink_indexes_keys(version)
+            raise
+
+        with connection.pipeline(transaction=True) as pipeline:
+            pipeline.hset(versions.key, 'active', version)
+            pipeline.hdel(versions.key, 'building')
+            if self._model.cache_collections:
+                pipeline.hincrby(self._model._index_versions_key(), '', 1)
+            pipeline.execute()
+        versions.get_state(refresh=True)
+
+        # let the other processes use the new version before deleting the old one
+        # (with the same margin)
+        time.sleep(2 * versions.cache_ttl)
+        self._unlink_indexes_keys(previous)
+
+    def _unlink_indexes_keys(self, version, chunk_size=1000):
+        """
+        Delete, with `UNLINK` (the memory being freed in the background by
+        redis), all the keys of the indexes of the field for the given version.
+        """
+        with self._index_versions.force(version):
+            keys = set()
+            for index in self._indexes:
+                keys.update(index.get_all_storage_keys())
+        keys = list(keys)
+        for start in range(0, len(keys), chunk_size):
+            self.connection.unlink(*keys[start:start + chunk_size])
+
+    def verify_indexes(self, chunk_size=1000, repair=False):
+        """Check that the indexes tied to this field match the stored values
+
+        The primary keys are read with ``SSCAN``, and for each chunk, the values are read in
+        one pipeline, and the existence of the entries they need in the indexes is checked in
+        another one: the ones not found, or found with a wrong score, are "missing".
+        Then the keys of the indexes are scanned, and their members checked against the
+        entries needed by the values of the instances, by chunks: the ones not needed are
+        "stale".
+        For a field with deferred indexing, the values stored as indexed by
+        ``RedisModel.process_deferred_indexing`` are checked instead of the current ones.
+        Each problem is logged as a warning.
+
+        Parameters
+        ----------
+        chunk_size: int
+            Default to 1000, it's the number of instances, or members of index keys, to check
+            at once.
+        repair: bool
+            Default to ``False``. If ``True``, the missing entries are added, and the stale
+            ones removed, with one pipeline for each chunk, the field being locked while a
+            chunk is checked and repaired.
+
+        Returns
+        -------
+        dict
+            The number of ``missing`` and ``stale`` entries found.
+
+        Raises
+        ------
+        AssertionError
+            If called from an instance field. It must be called from the model field
+            Also raised if the field is not indexable
+
+        Examples
+        --------
+
+        >>> MyModel.get_field('myfield').verify_indexes(repair=True)
+        {'missing': 0, 'stale': 2}
+
+        """
+        assert self.indexable, "Field not indexable"
+        assert self.attached_to_model, \
+            '`verify_indexes` can only be called on a field attached to the model'
+
+        counts = {'missing': 0, 'stale': 0}
+        connection = self.connection
+        # when repairing, the field is locked for each chunk, to not fix the indexes from
+        # values being updated
+        locked = [self.name] if repair else []
+
+        # check that the entries needed by the values are in the indexes
+        collection_key = self._model.get_field('pk').collection_key
+        cursor = 0
+        while True:
+            cursor, pks = connection.sscan(collection_key, cursor=cursor, count=chunk_size)
+            pks = [normalize(pk) for pk in pks]
+            if pks:
+                with self._model._lock_fields(locked):
+                    entries = list(chain.from_iterable(self._get_index_entries(pks).values()))
+                    with connection.pipeline(transaction=False) as pipeline:
+                        for key, member, score in entries:
+                            if score is None:
+                                pipeline.sismember(key, member)
+                            else:
+                                pipeline.zscore(key, member)
+                        results = pipeline.execute()
+                    missing = [
+                        (key, member, score)
+                        for (key, member, score), result in zip(entries, results)
+                        if (not result if score is None else result is None or float(result) != score)
+                    ]
+                    counts['missing'] += self._fix_index_entries('missing', missing, repair)
+            if not cursor:
+                break
+
+        # check that the entries in the indexes are needed by the values
+        for index in chain.from_iterable(index.get_storing_indexes() for index in self._indexes):
+            key_type = index.storage_key_type
+            keys = [normalize(key) for key in index.get_all_storage_keys()]
+            with connection.pipeline(transaction=False) as pipeline:
+                for key in keys:
+                    pipeline.type(key)
+                types = [normalize(type_) for type_ in pipeline.execute()]
+
+            for key, type_ in zip(keys, types):
+                if type_ != key_type:
+                    continue  # key of another index of the field, or data not stored by the index
+                if key_type == 'set':
+                    members = connection.sscan_iter(key, count=chunk_size)
+                else:
+                    members = (member for member, score in connection.zscan_iter(key, count=chunk_size))
+                chunk = []
+                for member in chain(members, [None]):
+                    if member is not None:
+                        chunk.append(normalize(member))
+                        if len(chunk) < chunk_size:
+                            continue
+                    if chunk:
+                        pks = set(index.get_entry_pk(member) for member in chunk)
+                        with self._model._lock_fields(locked):
+                            needed = set((entry_key, entry_member) for entry_key, entry_member, __
+                                         in chain.from_iterable(self._get_index_entries(pks).values()))
+                            stale = [(key, member, None if key_type == 'set' else 0)
+                                     for member in chunk if (key, member) not in needed]
+                            counts['stale'] += self._fix_index_entries('stale', stale, repair)
+                        chunk = []
+
+        if repair and (counts['missing'] or counts['stale']) and self._model.cache_collections:
+            connection.hincrby(self._model._index_versions_key(), '', 1)
+
+        return counts
+
+    def _get_index_entries(self, pks):
+        """
+        Return, for each of the given pks, the entries needed in the indexes
+        tied to this field, reading the values of all the pks, and the ones of
+        the other fields needed by the indexes, in one pipeline (none for the
+        pks of instances that don't exist).
+        If the indexing of the field is deferred, the values stored as indexed
+        by `RedisModel.process_deferred_indexing` are used instead of the
+        current ones, so the events still in the queue are not reported, and
+        the repaired entries are the ones the worker will deindex.
+        """
+        other_fields = []
+        for index in self._indexes:
+            other_fields.extend(field for field in index.get_entries_other_fields()
+                                if field.name not in [other_field.name for other_field in other_fields])
+
+        deferred = self.deferred_indexing
+        collection_key = self._model.get_field('pk').collection_key
+        with self.connection.pipeline(transaction=False) as pipeline:
+            for pk in pks:
+                pipeline.sismember(collection_key, pk)
+                if deferred:
+                    pipeline.hget(self._model._deferred_indexed_key(self.name), pk)
+                else:
+                    self.get_for_instance(pk)._bulk_get(pipeline)
+                for field in other_fields:
+                    field.get_for_instance(pk)._bulk_get(pipeline)
+            results = iter(pipeline.execute())
+
+        entries = {}
+        for pk in pks:
+            exists, value = next(results), next(results)
+            other_values = {field.name: next(results) for field in other_fields}
+            entries[pk] = set()
+            if deferred:
+                # the worker deindexes the values of deleted instances itself
+                for parts in json.loads(value or '[]'):
+                    for index in self._indexes:
+                        entries[pk].update(index.get_entries(pk, *parts, other_values=other_values))
+                continue
+            if not exists:
+                continue
+            for parts in self._prepare_bulk_index_data(pk, value):
+                if parts[-1] is None:
+                    continue
+                for index in self._indexes:
+                    entries[pk].update(index.get_entries(pk, *parts, other_values=other_values))
+        return entries
+
+    def _fix_index_entries(self, kind, entries, repair):
+        """
+        Log the given "missing" or "stale" entries of the indexes, and add or
+        remove them, in one pipeline, if `repair` is True. Return their number.
+        """
+        for key, member, score in entries:
+            log.warning('%s entry in the index of %s.%s: %s in %s',
+                        kind.capitalize(), self._model.__name__, self.name, member, key)
+        if repair and entries:
+            with self.connection.pipeline(transaction=False) as pipeline:
+                for key, member, score in entries:
+                    if kind == 'missing':
+                        if score is None:
+                            pipeline.sadd(key, member)
+                        else:
+                            pipeline.zadd(key, {member: score})
+                    elif score is None:
+                        pipeline.srem(key, member)
+                    else:
+                        pipeline.zrem(key, member)
+                pipeline.execute()
+        return len(entries)
 
     def get_unique_index(self):
         assert self.unique, "Field not unique"
@@ -737,6 +1183,206 @@ class SingleValueField(RedisField):
             values = [self.get_for_instance(pk).proxy_get()]
         return [(value, ) for value in values]
 
+    _commands_with_value_to_lock = {'set', 'getset', 'setnx', 'hset', 'hsetnx'}
+
+    def _get_value_to_lock(self, name, *args, **kwargs):
+        """
+        For commands setting a new value, return this value.
+        For the parameters, see `RedisField._get_value_to_lock`
+        """
+        if name not in self._commands_with_value_to_lock:
+            return NotProvided
+        if 'value' in kwargs:
+            return kwargs['value']
+        return args[0] if args else NotProvided
+
+    def _bulk_set(self, pipeline, value):
+        if value is None:
+            return []
+        value = self.from_python(value)
+        getattr(pipeline, self.proxy_setter)(self.key, value)
+        return [value]
+
+    def _bulk_get(self, pipeline):
+        getattr(pipeline, self.proxy_getter)(self.key)
+
+    def _prepare_bulk_index_data(self, pk, value):
+        return self._prepare_index_data(pk, [value])
+
+    def _get_value_to_batch(self, name, *args, **kwargs):
+        """
+        Only a plain call of the setter, with only the value, can be buffered.
+        For the parameters, see `RedisField._get_value_to_batch`
+        """
+        if name != self.proxy_setter:
+            return NotProvided
+        if len(args) == 1 and not kwargs:
+            return args[0]
+        if not args and list(kwargs) == ['value']:
+            return kwargs['value']
+        return NotProvided
+
+    lockfree_script = {
+        # KEYS[1] is the key holding the value, ARGV are, in this order: the name of the
+        # entry if the key is a hash (else an empty string), the pk, the mode ("set",
+        # "getset" or "del"), the new value (empty if "del"), the key of the hash of the
+        # index versions (empty if the model doesn't cache its collections), then five
+        # entries for each index, as returned by `BaseIndex.get_lockfree_write_args`
+        # Returns a table with 1 and the result of the write command, or 0 and the pk
+        # already using the value if the uniqueness check failed
+        'lua': """
+            local data_key = KEYS[1]
+            local hash_field, pk, mode, new_value = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+            local versions_key = ARGV[5]
+            local indexes = {}
+            for i = 6, #ARGV, 5 do
+                indexes[#indexes + 1] = {
+                    kind = ARGV[i], key = ARGV[i + 1], extra = ARGV[i + 2],
+                    unique = ARGV[i + 3] == '1', value = ARGV[i + 4]
+                }
+            end
+            local old_value
+            if hash_field ~= '' then
+                old_value = redis.call('hget', data_key, hash_field)
+            else
+                old_value = redis.call('get', data_key)
+            end
+            local setting = mode ~= 'del'
+            local changed = not setting or old_value ~= new_value
+            -- increment the version of an index (see `BaseIndex.get_version_entry`)
+            local function bump_version(key)
+                if versions_key ~= '' then
+                    redis.call('hincrby', versions_key, key, 1)
+                end
+            end
+            -- check uniqueness before writing anything
+            if setting and changed then
+                for _, index in ipairs(indexes) do
+                    if index.unique then
+                        local others
+                        if index.kind == 'equal' then
+                            others = redis.call('smembers', index.key .. index.value)
+                        elseif index.kind == 'text' then
+                            local prefix = index.value .. index.extra
+                            others = {}
+                            local members = redis.call('zrangebylex', index.key, '[' .. prefix, '[' .. prefix .. '\255')
+                            for _, member in ipairs(members) do
+                                others[#others + 1] = string.sub(member, #prefix + 1)
+                            end
+                        else
+                            others = redis.call('zrangebyscore', index.key, index.value, index.value)
+                        end
+                        for _, other_pk in ipairs(others) do
+                            if other_pk ~= pk then
+                                return {0, other_pk}
+                            end
+                        end
+                    end
+                end
+            end
+            -- deindex the old value
+            if changed and old_value then
+                for _, index in ipairs(indexes) do
+                    if index.kind == 'equal' then
+                        redis.call('srem', index.key .. old_value, pk)
+                    elseif index.kind == 'text' then
+                        redis.call('zrem', index.key, old_value .. index.extra .. pk)
+                    else
+                        redis.call('zrem', index.key, pk)
+                    end
+                    bump_version(index.key)
+                end
+            end
+            -- write the value
+            local result
+            if not setting then
+                if hash_field ~= '' then
+                    result = redis.call('hdel', data_key, hash_field)
+                else
+                    result = redis.call('del', data_key)
+                end
+            elseif hash_field ~= '' then
+                result = redis.call('hset', data_key, hash_field, new_value)
+            else
+                redis.call('set', data_key, new_value)
+                if mode == 'getset' then
+                    result = old_value
+                else
+                    result = 1
+                end
+            end
+            -- index the new value
+            if setting and changed then
+                for _, index in ipairs(indexes) do
+                    if index.kind == 'equal' then
+                        redis.call('sadd', index.key .. index.value, pk)
+                    elseif index.kind == 'text' then
+                        redis.call('zadd', index.key, 0, index.value .. index.extra .. pk)
+                    else
+                        redis.call('zadd', index.key, index.value, pk)
+                    end
+                    bump_version(index.key)
+                end
+            end
+            return {1, result}
+        """
+    }
+
+    def _get_lockfree_hash_field(self):
+        """
+        Return the name of the entry in the hash holding the value, or an empty
+        string if the value is not stored in a hash.
+        """
+        return ''
+
+    def _call_lockfree(self, name, *args, **kwargs):
+        """
+        Run the modifier in the `lockfree_script` lua script.
+        For the parameters, see `RedisField._call_lockfree`
+        """
+        if name not in self.lockfree_commands:
+            raise ImplementationError('%s command cannot be used on the lock-free field %s' % (
+                name, self.name))
+        if any(kwargs.values()):
+            raise ImplementationError('Arguments %s cannot be used on the lock-free field %s' % (
+                ', '.join(sorted(kwargs)), self.name))
+
+        instance = self._instance
+        if instance._pk and not instance.connected:
+            instance.connect()
+
+        mode = name if name in ('set', 'getset', 'hset') else 'del'
+        value = args[0] if mode != 'del' else None
+
+        key = self.key  # will create the pk if needed
+        pk = instance.pk.get()
+
+        script_args = [
+            self._get_lockfree_hash_field(), pk, mode, '' if value is None else value,
+            self._model._index_versions_key() if self._model.cache_collections else '',
+        ]
+        unique_index = self.get_unique_index() if self.unique and mode != 'del' else None
+        for index in self._indexes:
+            script_args.extend(index.get_lockfree_write_args(value, unique=index is unique_index))
+
+        ok, result = self.database.call_script(self.lockfree_script, keys=[key], args=script_args)
+        identity_map = self.database.current_identity_map
+        if identity_map is not None:
+            identity_map.invalidate(key)
+        if not ok:
+            raise UniquenessError('Value "%s" already indexed for %s (for instance %s)' % (
+                value, unique_index.unique_index_name, result))
+
+        if name == 'set':
+            result = bool(result)
+        return self.post_command(
+            sender=self,
+            name=name,
+            result=result,
+            args=args,
+            kwargs=kwargs
+        )
+
     def index(self, value=None, only_index=None):
         self._index(None if value is None else [value], only_index)
 
@@ -768,6 +1414,9 @@ class StringField(SingleValueField):
     _call_setex = SingleValueField._deny_if_indexable
     _call_psetex = SingleValueField._deny_if_indexable
 
+    _lockfree_supported = True
+    lockfree_commands = {'set', 'getset', 'delete'}
+
     def _call_setnx(self, command, value):
         """
         Index only if value has been set.
@@ -845,6 +1494,12 @@ class MultiValuesField(RedisField):
             values = self.get_for_instance(pk).proxy_get()
         return [(value, ) for value in values]
 
+    def _bulk_set(self, pipeline, values):
+        values = [self.from_python(value) for value in values]
+        if values:
+            getattr(pipeline, self.proxy_setter)(self.key, *values)
+        return values
+
     def index(self, values=None, only_index=None):
         """
         Index all values stored in the field, or only given ones if any.
@@ -927,6 +1582,16 @@ class SortedSetField(MultiValuesField):
             self.index(mapping.keys())
         return self._traverse_command(command, *args, **kwargs)
 
+    def _bulk_set(self, pipeline, values):
+        args, kwargs = self.coerce_zadd_args(**values)
+        mapping = {self.from_python(value): score for value, score in iteritems(kwargs['mapping'])}
+        if mapping:
+            pipeline.zadd(self.key, mapping)
+        return list(mapping.keys())
+
+    def _bulk_get(self, pipeline):
+        pipeline.zrange(self.key, 0, -1)
+
     def _call_zincrby(self, command, amount, value):
         """
         This command update a score of a given value. But it can be a new value
@@ -1021,6 +1686,9 @@ class SetField(MultiValuesField):
 
         return super(SetField, self)._pop(command, count=count)
 
+    def _bulk_get(self, pipeline):
+        pipeline.smembers(self.key)
+
 
 class ListField(MultiValuesField):
     """
@@ -1088,6 +1756,9 @@ class ListField(MultiValuesField):
         """
         return self.lrange(0, -1)
 
+    def _bulk_get(self, pipeline):
+        pipeline.lrange(self.key, 0, -1)
+
     def _call_lrank(self, command, value):
         """
         Addon to redis, to know if a value is in the list without having to retrieve all the list,
@@ -1247,6 +1918,14 @@ class HashField(MultiValuesField):
             values = self.get_for_instance(pk).proxy_get()
         return list(iteritems(values))
 
+    def _bulk_set(self, pipeline, values):
+        if values:
+            pipeline.hmset(self.key, values)
+        return values
+
+    def _bulk_get(self, pipeline):
+        pipeline.hgetall(self.key)
+
     def index(self, values=None, only_index=None):
         """
         Deal with dicts and field names.
@@ -1290,14 +1969,51 @@ class InstanceHashField(SingleValueField):
     _call_hset = SingleValueField._call_set
     _call_hdel = RedisField._del
 
+    _lockfree_supported = True
+    lockfree_commands = {'hset', 'hdel'}
+
+    def _get_lockfree_hash_field(self):
+        return self.name
+
+    def _call_command(self, name, *args, **kwargs):
+        """
+        Use the value prefetched by a collection (see `CollectionManager.prefetch`)
+        for `hget`, and forget it for any other command.
+        """
+        prefetched = getattr(getattr(self, '_instance', None), '_prefetched', None)
+        if prefetched and self.name in prefetched:
+            if name == 'hget':
+                return prefetched[self.name]
+            del prefetched[self.name]
+        return super(InstanceHashField, self)._call_command(name, *args, **kwargs)
+
     @property
     def key(self):
         return self._instance.key
 
+    def _get_identity_map_command_key(self, name, args, kwargs):
+        """
+        All the fields of an instance share its hash key, so the hash field
+        is part of the command key, as it is added to the args only by
+        `_traverse_command`.
+        """
+        command_key = super(InstanceHashField, self)._get_identity_map_command_key(name, args, kwargs)
+        return (self.name, ) + command_key
+
     @property
     def sort_wildcard(self):
         return "%s->%s" % (self._model.sort_wildcard(), self.name)
 
+    def _bulk_set(self, pipeline, value):
+        if value is None:
+            return []
+        value = self.from_python(value)
+        pipeline.hset(self.key, self.name, value)
+        return [value]
+
+    def _bulk_get(self, pipeline):
+        pipeline.hget(self.key, self.name)
+
     def _traverse_command(self, name, *args, **kwargs):
         """Add key AND the hash field to the args, and call the Redis command."""
         args = list(args)
@@ -1404,6 +2120,24 @@ class PKField(SingleValueField):
         else:
             return self.connection.sismember(self.collection_key, value)
 
+    def exists_many(self, values):
+        """
+        Return a list of booleans telling, for each of the given pk values, if
+        it exists for the given class.
+        Only one call to redis is done: a SMISMEMBER if the redis server
+        supports it (redis >= 6.2), else a pipeline of SISMEMBER.
+        """
+        values = [self.normalize(value) for value in values]
+        if not values:
+            return []
+        if self.database.redis_version >= (6, 2):
+            result = self.connection.execute_command('SMISMEMBER', self.collection_key, *values)
+            return [bool(exists) for exists in result]
+        with self.connection.pipeline(transaction=False) as pipeline:
+            for value in values:
+                pipeline.sismember(self.collection_key, value)
+            return pipeline.execute()
+
     def collection(self):
         """
         Return all available primary keys for the given class
@@ -1482,23 +2216,90 @@ class FieldLock(Lock):
     This subclass of the Lock object is used to add a lock on the field. It will
     be used on write operations to block writes for other instances on this
     field, during all operations needed to do a deindex+write+index.
-    Only one lock is done on a specific field for a specific model. If during
-    lock, another one is asked in the same thread, we assume that it's a
-    operation that must be done during the main lock and we don't wait for
-    release.
+    The scope of the lock depends on the `lock_scope` of the field:
+    - "field" (the default): only one lock is done on a specific field for a
+      specific model, for all its instances.
+    - "instance": one lock is done for each instance, for all its fields. For
+      unique fields, the "value" scope is used instead, as their uniqueness
+      must be ensured between instances.
+    - "value": for unique fields, one lock is done for each value being written
+      (if the value cannot be known in advance, the "field" scope is used),
+      with the instance also locked (as with the "instance" scope), so two
+      different values cannot be written on the same instance at the same
+      time. For non-unique fields, the "instance" scope is used instead.
+    A field not attached to an instance always uses the "field" scope.
+    The "field" scope is exclusive with the other ones: a lock with the
+    "instance" or "value" scope also takes a `SharedFieldLock` on the field,
+    which waits while a lock with the "field" scope is held, and a lock with
+    the "field" scope waits for the shared locks on the field to be released
+    (new ones cannot be taken meanwhile).
+    If during lock, another one with the same scope is asked in the same
+    thread, we assume that it's a operation that must be done during the main
+    lock and we don't wait for release.
     """
 
+    SCOPES = ('field', 'instance', 'value')
+
+    exclusive_lock_script = {
+        # KEYS[1] is the lock, KEYS[2] the sorted set of the shared locks on the field
+        # (see `SharedFieldLock`). ARGV[1] is the token, ARGV[2] the timeout in
+        # milliseconds (empty if none) and ARGV[3] "1" to wait for the shared locks.
+        # The lock is taken (or refreshed) if free or already ours, to block new shared
+        # locks, but 1 is returned only if no other shared lock is held.
+        'lua': """
+            if redis.replicate_commands then
+                redis.replicate_commands()
+            end
+            local current = redis.call('get', KEYS[1])
+            if current and current ~= ARGV[1] then
+                return 0
+            end
+            if ARGV[2] ~= '' then
+                redis.call('set', KEYS[1], ARGV[1], 'px', ARGV[2])
+            else
+                redis.call('set', KEYS[1], ARGV[1])
+            end
+            if ARGV[3] == '1' and redis.call('exists', KEYS[2]) == 1 then
+                local now = redis.call('time')
+                now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+                redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+                if redis.call('zcard', KEYS[2]) > 0 then
+                    return 0
+                end
+            end
+            return 1
+        """
+    }
+
     def __init__(self, field, timeout=5, sleep=0.1,
-                 blocking=True, blocking_timeout=None, thread_local=True):
+                 blocking=True, blocking_timeout=None, thread_local=True, value=NotProvided,
+                 scope=None):
         """
         Save the field and create a real lock,, using the correct connection
-        and a computed lock key based on the names of the field and its model.
+        and a computed lock key based on the names of the field and its model,
+        and depending on the scope (computed by `get_scope` if not given), on
+        the pk of the instance or on the value being written. For the "value"
+        scope, another lock, on the instance, is created, to be acquired
+        before this one.
         """
         self.field = field
         self.sub_lock_mode = False
+        self.instance_lock = None
+        self.shared_lock = None
+        self.shared_lock_acquired = False
+        if scope is None:
+            scope = self.get_scope(field, value)
+        self.scope = scope
+        if scope == 'value':
+            self.instance_lock = FieldLock(field, timeout, sleep, blocking, blocking_timeout,
+                                           thread_local, scope='instance')
+            self.instance_lock.shared_lock = None
+        if scope != 'field':
+            self.shared_lock = SharedFieldLock(field, timeout, sleep, blocking, blocking_timeout,
+                                               thread_local)
         super(FieldLock, self).__init__(
             redis=field._model.get_connection(),
-            name=make_key(field._model._name, 'lock-for-update', field.name),
+            name=self.get_lock_name(field, value, scope),
             timeout=timeout,
             sleep=sleep,
             blocking=blocking,
@@ -1506,18 +2307,103 @@ class FieldLock(Lock):
             thread_local=thread_local
         )
 
+    @classmethod
+    def get_scope(cls, field, value=NotProvided):
+        """
+        Return the real scope to use for the given field, and the value being
+        written if known.
+        """
+        if not field.attached_to_instance or not field.lockable:
+            return 'field'
+        scope = field.lock_scope or 'field'
+        if scope == 'instance' and field.unique:
+            scope = 'value'
+        if scope == 'value':
+            if not field.unique:
+                scope = 'instance'
+            elif value is NotProvided or value is None:
+                scope = 'field'
+        return scope
+
+    @classmethod
+    def get_lock_name(cls, field, value=NotProvided, scope=None):
+        """
+        Return the key of the lock to use for the given field and the value
+        being written if known (or for the given scope if passed). The value
+        is normalized as in the unique index, so two values that would use
+        the same uniqueness key (for example with a `transform`) use the same
+        lock.
+        """
+        if scope is None:
+            scope = cls.get_scope(field, value)
+        if scope == 'instance':
+            return make_key(field._model._name, field._instance.pk.get(), 'lock')
+        if scope == 'value':
+            return make_key(field._model._name, 'lock-for-update', field.name,
+                            field.get_unique_index().normalize_value(value))
+        return make_key(field._model._name, 'lock-for-update', field.name)
+
+    @classmethod
+    def can_be_shared(cls, field):
+        """
+        Tell if the given field can be locked with the "instance" or "value"
+        scope, ie if shared locks can be held on it.
+        """
+        return (field.lock_scope or field._model.lock_scope or 'field') != 'field'
+
+    def do_acquire(self, token):
+        """
+        For the "field" scope, take the lock only when no shared lock is held on
+        the field (except if one is held by the current thread, which would
+        never be released while waiting).
+        """
+        if self.scope != 'field' or not self.can_be_shared(self.field):
+            return super(FieldLock, self).do_acquire(token)
+        wait_shared = not self.field._model._is_lock_acquired(SharedFieldLock.get_lock_name(self.field))
+        return bool(self.field.database.call_script(
+            self.exclusive_lock_script,
+            keys=[self.name, SharedFieldLock.get_lock_name(self.field)],
+            args=[token, int(self.timeout * 1000) if self.timeout else '', int(wait_shared)]
+        ))
+
+    def _acquire_shared_lock(self, *args, **kwargs):
+        """
+        Take the shared lock on the field, if not already held in the current
+        thread, and if the current thread doesn't hold the lock with the "field"
+        scope.
+        """
+        self.shared_lock_acquired = False
+        model = self.field._model
+        if self.shared_lock is None or model._is_lock_acquired(self.shared_lock.name) \
+                or model._is_lock_acquired(self.get_lock_name(self.field, scope='field')):
+            return True
+        if not self.shared_lock.acquire(*args, **kwargs):
+            return False
+        model._mark_lock_as_acquired(self.shared_lock.name)
+        self.shared_lock_acquired = True
+        return True
+
+    def _release_shared_lock(self):
+        """
+        Release the shared lock on the field if taken by `_acquire_shared_lock`
+        """
+        if self.shared_lock_acquired:
+            self.shared_lock_acquired = False
+            self.field._model._unmark_lock_as_acquired(self.shared_lock.name)
+            self.shared_lock.release()
+
     def _get_already_locked_by_model(self):
         """
-        A lock is self_locked if already set for the current field+model on the current
-        thread.
+        A lock is self_locked if already set for the current lock name on the
+        current thread.
         """
-        return self.field._model._is_field_locked(self.field)
+        return self.field._model._is_lock_acquired(self.name)
 
     def _set_already_locked_by_model(self, value):
         if value:
-            self.field._model._mark_field_as_locked(self.field)
+            self.field._model._mark_lock_as_acquired(self.name)
         else:
-            self.field._model._unmark_field_as_locked(self.field)
+            self.field._model._unmark_lock_as_acquired(self.name)
 
     already_locked_by_model = property(_get_already_locked_by_model, _set_already_locked_by_model)
 
@@ -1528,11 +2414,26 @@ class FieldLock(Lock):
         """
         if not self.field.lockable:
             return True
+        if self.instance_lock is not None and not self.instance_lock.acquire(*args, **kwargs):
+            return False
         if self.already_locked_by_model:
-            self.sub_lock_mode = True
-            return True
-        self.already_locked_by_model = True
-        return super(FieldLock, self).acquire(*args, **kwargs)
+            if self._acquire_shared_lock(*args, **kwargs):
+                self.sub_lock_mode = True
+                return True
+        else:
+            self.already_locked_by_model = True
+            token = uuid.uuid1().hex
+            if super(FieldLock, self).acquire(*args, token=token, **kwargs):
+                if self._acquire_shared_lock(*args, **kwargs):
+                    return True
+                super(FieldLock, self).release()
+            elif self.scope == 'field':
+                # the lock may have been taken while waiting for the shared locks
+                self.lua_release(keys=[self.name], args=[token], client=self.redis)
+            self.already_locked_by_model = False
+        if self.instance_lock is not None:
+            self.instance_lock.release()
+        return False
 
     def release(self, *args, **kwargs):
         """
@@ -1541,10 +2442,12 @@ class FieldLock(Lock):
         """
         if not self.field.lockable:
             return
-        if self.sub_lock_mode:
-            return
-        super(FieldLock, self).release(*args, **kwargs)
-        self.already_locked_by_model = self.sub_lock_mode = False
+        self._release_shared_lock()
+        if not self.sub_lock_mode:
+            super(FieldLock, self).release(*args, **kwargs)
+            self.already_locked_by_model = self.sub_lock_mode = False
+        if self.instance_lock is not None:
+            self.instance_lock.release()
 
     def __exit__(self, *args, **kwargs):
         """
@@ -1555,3 +2458,80 @@ class FieldLock(Lock):
             return
         if not self.sub_lock_mode:
             self.already_locked_by_model = False
+
+
+class SharedFieldLock(Lock):
+    """
+    A lock shared by all the writes of a field using a `FieldLock` with the
+    "instance" or "value" scope, so that they are not done while a lock with
+    the "field" scope (used for the writes of the field not attached to an
+    instance, like the bulk ones) is held, and the other way around.
+    Each holder is stored in a sorted set, with the time (in milliseconds) at
+    which it expires as score.
+    """
+
+    acquire_script = {
+        # KEYS[1] is the sorted set of the holders, KEYS[2] the lock with the "field"
+        # scope. ARGV[1] is the token, ARGV[2] the timeout in milliseconds (empty if
+        # none). Returns 1 if the lock was acquired, 0 if the "field" lock is held.
+        'lua': """
+            if redis.replicate_commands then
+                redis.replicate_commands()
+            end
+            if redis.call('exists', KEYS[2]) == 1 then
+                return 0
+            end
+            if ARGV[2] == '' then
+                redis.call('zadd', KEYS[1], '+inf', ARGV[1])
+                redis.call('persist', KEYS[1])
+                return 1
+            end
+            local now = redis.call('time')
+            now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+            redis.call('zadd', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+            if redis.call('pttl', KEYS[1]) < tonumber(ARGV[2]) then
+                redis.call('pexpire', KEYS[1], ARGV[2])
+            end
+            return 1
+        """
+    }
+
+    def __init__(self, field, timeout=5, sleep=0.1,
+                 blocking=True, blocking_timeout=None, thread_local=True):
+        """
+        Save the field and create the lock, using the correct connection and
+        the name of the sorted set of the holders.
+        """
+        self.field = field
+        super(SharedFieldLock, self).__init__(
+            redis=field._model.get_connection(),
+            name=self.get_lock_name(field),
+            timeout=timeout,
+            sleep=sleep,
+            blocking=blocking,
+            blocking_timeout=blocking_timeout,
+            thread_local=thread_local
+        )
+
+    @classmethod
+    def get_lock_name(cls, field):
+        """
+        Return the key of the sorted set of the holders of the shared lock
+        """
+        return make_key(field._model._name, 'lock-shared-for-update', field.name)
+
+    def do_acquire(self, token):
+        return bool(self.field.database.call_script(
+            self.acquire_script,
+            keys=[self.name, FieldLock.get_lock_name(self.field, scope='field')],
+            args=[token, int(self.timeout * 1000) if self.timeout else '']
+        ))
+
+    def do_release(self, expected_token):
+        self.redis.zrem(self.name, expected_token)
+
+    def locked(self):
+        return bool(self.redis.zcard(self.name))
+
+    def owned(self):
+        return self.local.token is not None and self.redis.zscore(self.name, self.local.token) is not None
@@ -5,16 +5,124 @@ from future.utils import PY3
 from past.builtins import str as oldstr
 
 from collections import defaultdict
+from contextlib import contextmanager
 from itertools import product
 from logging import getLogger
+import multiprocessing
 import threading
+import time
 
 from limpyd.exceptions import ImplementationError, LimpydException, UniquenessError
-from limpyd.utils import make_key, unique_key
+from limpyd.utils import make_key, normalize, unique_key, TMP_KEY_TTL
 
 logger = getLogger(__name__)
 
 
+# data about the parallel rebuild being run, inherited by the forked workers
+_parallel_rebuild = {}
+
+
+def _get_multiprocessing_context():
+    """Return the ``multiprocessing`` context forking processes, used by parallel rebuilds"""
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:  # python 2, where processes are always forked
+        return multiprocessing
+
+
+def _rebuild_chunk(pks):
+    """Index, in a worker of a parallel rebuild, the instances with the given pks in temporary keys"""
+    index = _parallel_rebuild['index']
+    index.model._index_keys_prefix = _parallel_rebuild['prefix']
+    return index._walk_chunk(index.add, pks)
+
+
+class IndexVersions(object):
+    """The versions of the keys of the indexes of a field, used by shadow rebuilds
+
+    When the model has ``versioned_indexes`` set to ``True``, the keys of the indexes of a
+    field are prefixed by the active version of the field (none at first). A shadow rebuild
+    (see ``RedisField.rebuild_indexes``) builds the indexes under a new version, while the
+    writes go to both versions, then flips the active version, stored in a single redis key.
+
+    The versions are read from redis at most once every ``cache_ttl`` seconds by each process.
+
+    Parameters
+    ----------
+    field: RedisField
+        The field, attached to its model, whose indexes are versioned
+
+    """
+
+    cache_ttl = 1
+
+    def __init__(self, field):
+        """Prepare the key holding the versions and the local cache"""
+        self.field = field
+        self.key = make_key(field._model._name, '__index__', field.name, 'versions')
+        self._forced = threading.local()
+        self._state = None
+        self._read_at = None
+
+    def get_state(self, refresh=False):
+        """Get the active version, and the one being built if any
+
+        Parameters
+        ----------
+        refresh: bool
+            Default to ``False``. If ``True``, the versions are read from redis even if
+            the cached ones are not expired.
+
+        Returns
+        -------
+        Tuple[Union[str, None], Union[str, None]]
+            The active version (``None`` for the keys not versioned) and the version being
+            built (``None`` if no shadow rebuild is running)
+
+        """
+        now = time.time()
+        if refresh or self._state is None or now - self._read_at >= self.cache_ttl:
+            active, building = self.field.connection.hmget(self.key, 'active', 'building')
+            self._state = (normalize(active) or None, normalize(building) or None)
+            self._read_at = now
+        return self._state
+
+    @property
+    def current(self):
+        """The version to use for the keys: the forced one if any, else the active one"""
+        forced = getattr(self._forced, 'version', None)
+        if forced is not None:
+            return forced or None
+        return self.get_state()[0]
+
+    @property
+    def building(self):
+        """The version being built, that must also get the writes, if not already forced"""
+        if getattr(self._forced, 'version', None) is not None:
+            return None
+        return self.get_state()[1]
+
+    def get_prefix(self, version):
+        """Get the prefix of the keys of the given version (``None`` if not versioned)"""
+        if not version:
+            return None
+        return make_key(self.field._model._name, '__index__', self.field.name, 'v%s' % version)
+
+    @contextmanager
+    def force(self, version):
+        """Use the given version (``None`` for the keys not versioned) in the current thread
+
+        To be used with ``with``.
+
+        """
+        previous = getattr(self._forced, 'version', None)
+        self._forced.version = version or ''
+        try:
+            yield
+        finally:
+            self._forced.version = previous
+
+
 class BaseIndex(object):
     """Base of all indexes
 
@@ -60,6 +168,10 @@ class BaseIndex(object):
         May include: 'set', 'zset' or 'list'
     filter_single_field : bool
         Tell if the index can be used to filter a field independently than others.
+    storage_key_type : str
+        The type of the redis keys where the index stores its entries (``set`` or ``zset``),
+        used to check them in ``RedisField.verify_indexes``. ``None`` if the index doesn't
+        store anything by itself.
 
     Parameters
     -----------
@@ -80,6 +192,7 @@ class BaseIndex(object):
     }
 
     supported_key_types = set()
+    storage_key_type = None
 
     def __init__(self, field):
         """Attach the index to the given field and prepare the internal cache"""
@@ -273,6 +386,85 @@ class BaseIndex(object):
         """
         return self.field.connection
 
+    @property
+    def write_connection(self):
+        """Shortcut to get the redis connection to use to write the index data
+
+        Returns
+        -------
+        Union[Redis, Pipeline]
+            The pipeline buffering the index writes in the current thread if any (see
+            ``RedisDatabase.index_pipeline``), else the normal redis connection.
+
+        """
+        return self.model.database.index_write_connection
+
+    def bump_version(self, key):
+        """Increment the version of the given index key, if the model caches its collections
+
+        The version is incremented with the same connection (or pipeline) as the writes, so
+        it's done in the same round trip. Collections cached with ``CollectionManager.cache``
+        depend on the versions of the index keys they read, and will be computed again.
+
+        Parameters
+        ----------
+        key : str
+            The index key that was written to. An empty string means that all the keys of the
+            index may have changed (when it's cleared)
+
+        """
+        if self.model.cache_collections and not self.model._index_keys_prefix:
+            self.write_connection.hincrby(self.model._index_versions_key(),
+                                          self.get_version_entry(key) if key else key, 1)
+
+    def get_version_entry(self, key, suffix=None):
+        """Get the entry of the hash of the index versions holding the version of the given key
+
+        Parameters
+        ----------
+        key : str
+            An index key, written to or read by a filter
+        suffix : str
+            The suffix of the filter reading the key, if any
+
+        Returns
+        -------
+        str
+            The key itself by default. Indexes storing the values in many keys return an
+            entry shared by these keys, so the hash doesn't grow with the number of values.
+
+        """
+        return key
+
+    def make_key(self, *parts):
+        """Make a redis key used by this index from the given parts
+
+        If the model has ``versioned_indexes``, the key is prefixed with the current version
+        of the indexes of the field (see ``IndexVersions``). Then, when called in a worker of
+        a parallel rebuild (see ``rebuild``), it's prefixed with the temporary prefix of the
+        rebuild, so the live index is not touched.
+
+        Parameters
+        ----------
+        parts: tuple
+            The parts of the key, starting with the name of the model and of the field
+
+        Returns
+        -------
+        str
+            The redis key to use
+
+        """
+        key = self.field.make_key(*parts)
+        if self.model.versioned_indexes:
+            versions = self.field._index_versions
+            version_prefix = versions.get_prefix(versions.current)
+            if version_prefix:
+                key = make_key(version_prefix, key)
+        if self.model._index_keys_prefix:
+            key = make_key(self.model._index_keys_prefix, key)
+        return key
+
     @property
     def model(self):
         """Shortcut to get the model tied to the field tied to this index
@@ -319,9 +511,31 @@ class BaseIndex(object):
         deindexed_values = set(cache.get('deindexed_values'))
 
         for args in indexed_values:
-            self.remove(pk, *args)
+            self._for_each_version(self.remove, pk, *args)
         for args in deindexed_values:
-            self.add(pk, *args, check_uniqueness=False)
+            self._for_each_version(self.add, pk, *args, check_uniqueness=False)
+
+    def _for_each_version(self, method, *args, **kwargs):
+        """Call a method writing in the index for each version of its keys to update
+
+        The method is called for the current version, then, during a shadow rebuild of the
+        field (see ``IndexVersions``), for the version being built.
+
+        Parameters
+        ----------
+        method: Callable
+            The method to call, usually ``add`` or ``remove``.
+        args: tuple
+            The positional arguments to pass to the method.
+        kwargs: dict
+            The named arguments to pass to the method.
+
+        """
+        method(*args, **kwargs)
+        building = self.field._get_index_version_being_built()
+        if building:
+            with self.field._index_versions.force(building):
+                method(*args, **kwargs)
 
     def _check_key_accepted_key_types(self, accepted_key_types):
         """Check if key types accepted from the collection match the ones supported by the index.
@@ -408,6 +622,62 @@ class BaseIndex(object):
 
         raise NotImplementedError
 
+    def check_uniqueness_many(self, entries):
+        """For a unique index, check that many values are not used twice, in redis or in `entries`
+
+        It's used to check many values at once, for example by ``RedisModel.bulk_create``.
+        This default implementation calls ``check_uniqueness`` for each entry, subclasses
+        may do it in less round trips.
+
+        Parameters
+        ----------
+        entries: Iterable[Tuple[Any, tuple]]
+            Each entry is a tuple with the pk of an instance and the "value" to check for this
+            pk (see `args` in ``check_uniqueness``)
+
+        Raises
+        ------
+        UniquenessError
+            If the uniqueness is not respected, in redis or between the given entries.
+
+        """
+        if not self.field.unique:
+            return
+
+        entries = [
+            (pk, tuple(args), tuple(args[:-1]) + (self.normalize_value(args[-1]), ))
+            for pk, args in entries
+        ]
+        self.assert_entries_uniqueness(entries)
+
+        for pk, args, __ in entries:
+            self.check_uniqueness(pk, *args)
+
+    def assert_entries_uniqueness(self, entries):
+        """Check that many entries to check for uniqueness do not use the same value
+
+        Parameters
+        ----------
+        entries: Iterable[Tuple[Any, tuple, Hashable]]
+            Each entry is a tuple with the pk of an instance, the "value" to check for this
+            pk (see `args` in ``check_uniqueness``), and a reference that is the same for
+            two entries having the same indexed value (for example the storage key)
+
+        Raises
+        ------
+        UniquenessError
+            If the same reference is used by two different pks.
+
+        """
+        seen = {}
+        for pk, args, reference in entries:
+            if seen.setdefault(reference, pk) != pk:
+                raise UniquenessError(
+                    'Value "%s" used many times for %s (for instances %s and %s)' % (
+                        args[-1], self.unique_index_name, seen[reference], pk
+                    )
+                )
+
     @property
     def unique_index_name(self):
         """Get a string to describe the index in case of UniquenessError"""
@@ -496,7 +766,143 @@ class BaseIndex(object):
         """
         raise NotImplementedError
 
-    def clear(self, chunk_size=1000, aggressive=False):
+    def get_entries(self, pk, *args, **kwargs):
+        """Get the entries that ``add`` stores for the given "value" (via `args`), without writing
+
+        Used by ``RedisField.verify_indexes`` to find the missing and stale entries.
+
+        Parameters
+        ----------
+        kwargs['other_values']: Optional[Dict[str, Any]]
+            The values of the fields returned by ``get_entries_other_fields``, read with the
+            value of the field (by their ``_bulk_get``), with the names of the fields as keys.
+            If not given, the index reads them itself.
+
+        For the other parameters, see ``BaseIndex.add``
+
+        Returns
+        -------
+        List[Tuple[str, str, Union[float, None]]]
+            A list with a tuple for each entry: the key, the member, and the score (``None`` if
+            the key is a set).
+
+        """
+        raise NotImplementedError
+
+    def get_entries_other_fields(self):
+        """Get the other fields whose values are needed by ``get_entries``
+
+        Their values are read in bulk with the ones of the field, and passed to
+        ``get_entries`` in ``other_values``.
+
+        Returns
+        -------
+        List[RedisField]
+            The fields, attached to the model. None by default.
+
+        """
+        return []
+
+    def get_entry_pk(self, member):
+        """Get the pk of the instance from a member of a key of this index
+
+        Parameters
+        ----------
+        member: str
+            A member of a key of type ``storage_key_type``
+
+        Returns
+        -------
+        str
+            The pk of the instance. The member itself by default.
+
+        """
+        return member
+
+    def get_storing_indexes(self):
+        """Get the indexes really storing the entries, with their own keys
+
+        Returns
+        -------
+        List[BaseIndex]
+            Only this index by default.
+
+        """
+        return [self]
+
+    def get_lockfree_write_args(self, value, unique=False):
+        """Get the arguments to pass to the lock-free write script of a field to update this index
+
+        For fields with lock-free writes, the read of the current value, the uniqueness check,
+        the write and the update of the indexes are done in one lua script. This script
+        needs, for each index, the information to compute the keys and members to update
+        from a raw value.
+
+        Parameters
+        ----------
+        value: Any
+            The new value to index. ``None`` if the field is being deleted.
+        unique: bool
+            If this index must check the uniqueness of the new value.
+
+        Returns
+        -------
+        list
+            A list of five entries, in this order: the kind of the index (``equal``, ``text``,
+            or ``number``), the storage key (or its prefix for ``equal``), an extra string
+            (the separator for ``text``), ``1`` if the uniqueness must be checked else ``0``,
+            and the normalized new value (or an empty string if `value` is ``None``).
+
+        Raises
+        ------
+        ImplementationError
+            If this index cannot be updated by the lock-free write script, which is the
+            default.
+
+        """
+        raise ImplementationError('%s cannot be used on a field with lock-free writes' %
+                                  self.__class__.__name__)
+
+    def get_script_filter_sources(self, suffix, *args, **kwargs):
+        """Get the sources of the pks matching a filter, for the single-call collection script
+
+        When a collection is computed in only one call to redis (see
+        ``CollectionManager.single_call``), the filters are applied by a lua script
+        that needs, for each one, where to read the matching pks.
+
+        For the parameters, see ``BaseIndex.get_filtered_keys``
+
+        Returns
+        -------
+        list or None
+            ``None`` if the filter cannot be applied by the script (the default), in which
+            case the collection will be computed the normal way.
+            Else a list, the matching pks being the union of the pks of all the entries (an
+            empty list meaning the filter must be ignored). Each entry is a tuple with six
+            entries: the kind of source (``set``, ``text`` or ``number``), the key to read,
+            the boundaries to pass to ``zrangebylex``/``zrangebyscore`` (empty strings for a
+            ``set``), the value to exclude, and the extra data (the separator for ``text``).
+
+        """
+        return None
+
+    def get_sort_storage_key(self):
+        """Get the key of the sorted set to use to sort a collection by the field
+
+        When a collection is sorted by a field having an index returning a key here, the
+        collection is ordered and sliced with ``zinterstore`` and ``zrange`` on this sorted
+        set (where the score of each pk is the value used to sort), instead of the ``sort``
+        command that has to fetch the value of the field for each pk.
+
+        Returns
+        -------
+        str or None
+            ``None`` if the index cannot be used to sort the collection (the default)
+
+        """
+        return None
+
+    def clear(self, chunk_size=1000, aggressive=False, cursor=0, progress=None):
         """Will deindex all the value for the current field
 
         Parameters
@@ -510,6 +916,11 @@ class BaseIndex(object):
             pattern of the keys used by the index. This is a lot faster and may find forsgotten keys.
             But may also find keys not related to the index.
             Should be set to ``True`` if you are not sure about the already indexed values.
+        cursor: int
+            Default to ``0``. If not in aggressive mode, the cursor to resume from, as passed to
+            ``progress``. See ``walk``.
+        progress: Optional[Callable[[int, int], None]]
+            If not in aggressive mode, a function called after each chunk. See ``walk``.
 
         Examples
         --------
@@ -519,27 +930,16 @@ class BaseIndex(object):
         """
         if aggressive:
             keys = self.get_all_storage_keys()
-            with self.model.database.pipeline(transaction=False) as pipe:
+            with self.model.database.connection.pipeline(transaction=False) as pipe:
                 for key in keys:
                     pipe.delete(key)
                 pipe.execute()
+            self.bump_version('')
 
         else:
-            start = 0
-            while True:
-                instances = self.model.collection().sort().instances(lazy=True)[start:start + chunk_size]
-                for instance in instances:
-                    field = instance.get_instance_field(self.field.name)
-                    value = field.proxy_get()
-                    if value is not None:
-                        field.deindex(value, only_index=self)
-
-                if len(instances) < chunk_size:  # not enough data, it means we are done
-                    break
-
-                start += chunk_size
+            self.walk(self.remove, chunk_size=chunk_size, cursor=cursor, progress=progress)
 
-    def rebuild(self, chunk_size=1000, aggressive_clear=False):
+    def rebuild(self, chunk_size=1000, aggressive_clear=False, cursor=0, progress=None, workers=None):
         """Rebuild the whole index for this field.
 
         Parameters
@@ -550,28 +950,181 @@ class BaseIndex(object):
             Will be passed to the `aggressive` argument of the `clear` method.
             If `False`, all values will be normally deindexed. If `True`, the work
             will be done at low level, scanning for keys that may match the ones used by the index
+        cursor: int
+            Default to ``0``. The cursor to resume an interrupted rebuild from, as passed to
+            ``progress``. If not ``0``, the index is not cleared again. See ``walk``.
+        progress: Optional[Callable[[int, int], None]]
+            A function called after each chunk of indexed instances. See ``walk``.
+        workers: Optional[int]
+            If more than ``1``, the index is rebuilt by this number of processes: the primary
+            keys are read by chunks with ``SSCAN`` by the current process, and each chunk is
+            indexed by one of the workers, with its own connection, into temporary keys. These keys then replace the ones of the index in one
+            transaction, so the index is never seen half-built (but writes done in the meantime
+            may be missed). ``aggressive_clear``, ``cursor`` and ``progress`` are not used.
+            Only on platforms where processes can be forked.
 
         Examples
         --------
 
         >>> MyModel.get_field('myfield').get_index().rebuild()
 
+        To save the progress of the rebuild, to resume it later if interrupted:
+
+        >>> index.rebuild(progress=lambda cursor, count: save_cursor(cursor))
+        >>> index.rebuild(cursor=load_cursor())
+
+        """
+        if workers and workers > 1:
+            self._rebuild_in_parallel(chunk_size, workers)
+            return
+
+        if not cursor:
+            self.clear(chunk_size=chunk_size, aggressive=aggressive_clear)
+
+        self.walk(self.add, chunk_size=chunk_size, cursor=cursor, progress=progress)
+
+    def _rebuild_in_parallel(self, chunk_size, workers):
+        """Rebuild the index in many processes, into temporary keys, then swap them
+
+        For the parameters, see ``rebuild``
+
         """
-        self.clear(chunk_size=chunk_size, aggressive=aggressive_clear)
+        prefix = self._unique_key('rebuild')
+        _parallel_rebuild.update(index=self, prefix=prefix)
+        try:
+            pool = _get_multiprocessing_context().Pool(workers)
+            try:
+                # the pks are read only once, here, each chunk being sent to a worker
+                for __ in pool.imap_unordered(_rebuild_chunk, self._iterate_pks(chunk_size)):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+
+            temporary_keys = [normalize(key) for key in self.model.database.scan_keys(make_key(prefix, '*'))]
+            live_keys = {key[len(prefix) + 1:]: key for key in temporary_keys}
+            old_keys = [key for key in map(normalize, self.get_all_storage_keys()) if key not in live_keys]
+
+            with self.model.database.connection.pipeline(transaction=True) as pipeline:
+                if old_keys:
+                    pipeline.delete(*old_keys)
+                for live_key, temporary_key in live_keys.items():
+                    pipeline.rename(temporary_key, live_key)
+                if self.model.cache_collections:
+                    pipeline.hincrby(self.model._index_versions_key(), '', 1)
+                pipeline.execute()
+
+        except:
+            temporary_keys = list(self.model.database.scan_keys(make_key(prefix, '*')))
+            if temporary_keys:
+                self.model.database.connection.delete(*temporary_keys)
+            raise
+
+        finally:
+            _parallel_rebuild.clear()
+
+    def walk(self, method, chunk_size=1000, cursor=0, progress=None):
+        """Call ``add`` or ``remove`` for the value(s) of the field of all the instances
+
+        The primary keys are read from the set of all the primary keys of the model with
+        ``SSCAN``, and for each chunk, with the field locked, the values of the field are read
+        in one pipeline, and all the index writes are sent in another one.
 
-        start = 0
+        Parameters
+        ----------
+        method: Callable
+            The ``add`` or ``remove`` method of this index. The uniqueness is not checked by
+            ``add``, the index reflecting the values already stored.
+        chunk_size: int
+            Default to 1000, it's the number of instances to load at once (it's only a hint
+            given to ``SSCAN``).
+        cursor: int
+            Default to ``0``. The ``SSCAN`` cursor to start from, to resume an interrupted walk.
+            As for ``SSCAN``, an instance may be processed twice, which does not matter for
+            an index.
+        progress: Optional[Callable[[int, int], None]]
+            A function called after each chunk with two arguments: the cursor to use to resume
+            the walk from there (``0`` when the walk is done), and the number of instances
+            processed since the start of this call.
+
+        Returns
+        -------
+        int
+            The number of instances processed.
+
+        """
+        count = 0
+        for cursor, pks in self._iterate_pks(chunk_size, cursor, with_cursor=True):
+            count += self._walk_chunk(method, pks)
+            if progress is not None:
+                progress(cursor, count)
+        return count
+
+    def _iterate_pks(self, chunk_size, cursor=0, with_cursor=False):
+        """Yield the primary keys of all the instances, by chunks read with ``SSCAN``
+
+        Parameters
+        ----------
+        chunk_size: int
+            The ``COUNT`` hint given to ``SSCAN``.
+        cursor: int
+            Default to ``0``. The ``SSCAN`` cursor to start from.
+        with_cursor: bool
+            Default to ``False``. If ``True``, yield tuples with the cursor to use to continue
+            after the chunk (``0`` for the last one) and the chunk, which may then be empty.
+
+        """
+        collection_key = self.model.get_field('pk').collection_key
+        connection = self.model.get_connection()
         while True:
-            instances = self.model.collection().sort().instances(lazy=True)[start:start + chunk_size]
-            for instance in instances:
-                field = instance.get_instance_field(self.field.name)
-                value = field.proxy_get()
-                if value is not None:
-                    field.index(value, only_index=self)
+            cursor, pks = connection.sscan(collection_key, cursor=cursor, count=chunk_size)
+            pks = [normalize(pk) for pk in pks]
+            if with_cursor:
+                yield cursor, pks
+            elif pks:
+                yield pks
+            if not cursor:
+                return
+
+    def _walk_chunk(self, method, pks):
+        """Call ``add`` or ``remove`` for the value(s) of the field of the given instances
 
-            if len(instances) < chunk_size:  # not enough data, it means we are done
-                break
+        For the parameters, see ``walk``, ``pks`` being the primary keys of the instances.
+
+        Returns
+        -------
+        int
+            The number of instances processed.
 
-            start += chunk_size
+        """
+        if not pks:
+            return 0
+        adding = method == self.add
+        connection = self.model.get_connection()
+
+        # lock the field so the values don't change between the read and the writes, except
+        # in the workers of a parallel rebuild, that write in temporary keys
+        with self.model._lock_fields([] if self.model._index_keys_prefix else [self.field.name]):
+            with connection.pipeline(transaction=False) as pipeline:
+                for pk in pks:
+                    self.field.get_for_instance(pk)._bulk_get(pipeline)
+                values = pipeline.execute()
+
+            try:
+                with self.model.database.index_pipeline():
+                    for pk, value in zip(pks, values):
+                        for parts in self.field._prepare_bulk_index_data(pk, value):
+                            if parts[-1] is None:
+                                continue
+                            if adding:
+                                method(pk, *parts, check_uniqueness=False)
+                            else:
+                                method(pk, *parts)
+            finally:
+                for pk in pks:
+                    self._reset_rollback_cache(pk)
+
+        return len(pks)
 
     @classmethod
     def _field_model_ready(cls, model, field):
@@ -594,10 +1147,7 @@ class BaseIndex(object):
         prefix_parts = [self.model._name, '__index__', self.__class__.__name__.lower()]
         if prefix:
             prefix_parts.append(prefix)
-        return unique_key(
-            self.connection,
-            prefix=make_key(*prefix_parts)
-        )
+        return unique_key(prefix=make_key(*prefix_parts))
 
 
 class EqualIndex(BaseIndex):
@@ -606,10 +1156,21 @@ class EqualIndex(BaseIndex):
     handled_suffixes = {None, 'eq', 'in'}
     handle_uniqueness = True
     supported_key_types = {'set'}
+    storage_key_type = 'set'
+
+    def get_entries(self, pk, *args, **kwargs):
+        """Get the entry that ``add`` stores: the pk in the set of the value
+
+        For the parameters, see ``BaseIndex.get_entries``
+
+        """
+        return [(self.get_storage_key(*args), str(pk), None)]
 
     def union_filtered_in_keys(self, dest_key, *source_keys):
         """Do a union of the given `source_keys` at the redis level, into `dest_key`
 
+        The `dest_key` being a temporary key, it is created with a time to live.
+
         Parameters
         ----------
         dest_key : str
@@ -618,7 +1179,10 @@ class EqualIndex(BaseIndex):
             The keys to union
 
         """
-        self.connection.sunionstore(dest_key, source_keys)
+        with self.connection.pipeline(transaction=False) as pipe:
+            pipe.sunionstore(dest_key, source_keys)
+            pipe.expire(dest_key, TMP_KEY_TTL)
+            pipe.execute()
 
     def get_filtered_keys(self, suffix, *args, **kwargs):
         """Return the set used by the index for the given "value" (`args`)
@@ -651,6 +1215,37 @@ class EqualIndex(BaseIndex):
         # do not transform because we already have the value we want to look for
         return [(self.get_storage_key(transform_value=False, *args), 'set', False)]
 
+    def get_script_filter_sources(self, suffix, *args, **kwargs):
+        """Return the set(s) used by the index for the given "value" (`args`)
+
+        For the parameters, see ``BaseIndex.get_script_filter_sources``
+
+        """
+        args = list(args)
+        if suffix == 'in':
+            values = set(args.pop())
+        else:
+            values = [args.pop()]
+
+        return [
+            ('set', self.get_storage_key(transform_value=False, *(args + [value])), '', '', '', '')
+            for value in values
+        ]
+
+    def get_version_entry(self, key, suffix=None):
+        """Get the entry of the hash of the index versions holding the version of the given key
+
+        For the parameters, see ``BaseIndex.get_version_entry``
+
+        Notes
+        -----
+        All the keys of the index share the same version, its storage key without value
+        (as used by the lua scripts), so one write invalidates the cached collections
+        reading any value of the index.
+
+        """
+        return self.get_storage_key('', transform_value=False)
+
     def get_storage_key(self, *args, **kwargs):
         """Return the redis key where to store the index for the given "value" (`args`)
 
@@ -693,7 +1288,7 @@ class EqualIndex(BaseIndex):
 
         parts.append(normalized_value)
 
-        return self.field.make_key(*parts)
+        return self.make_key(*parts)
 
     def get_all_storage_keys(self):
         """Returns the keys to be removed by `clear` in aggressive mode
@@ -721,13 +1316,29 @@ class EqualIndex(BaseIndex):
         parts2.append('*')
 
         return set(
-            self.model.database.scan_keys(self.field.make_key(*parts1))
+            self.model.database.scan_keys(self.make_key(*parts1))
         ).union(
             set(
-                self.model.database.scan_keys(self.field.make_key(*parts2))
+                self.model.database.scan_keys(self.make_key(*parts2))
             )
         )
 
+    def get_uniqueness_key(self, base_key):
+        """Get the key holding the pks to use to check for uniqueness for the given index key.
+
+        Parameters
+        ----------
+        base_key : str
+            The index key for a value, as returned by ``get_storage_key``
+
+        Returns
+        -------
+        str
+            The key to read to check for uniqueness. For this index, it's the same key.
+
+        """
+        return base_key
+
     def get_uniqueness_members(self, key):
         """Get from redis all the members of the given index `key` used to check for uniqueness.
 
@@ -742,7 +1353,7 @@ class EqualIndex(BaseIndex):
             The members of the index `key`.
 
         """
-        return list(self.connection.smembers(key))
+        return list(self.connection.smembers(self.get_uniqueness_key(key)))
 
     def check_uniqueness(self, pk, *args, **kwargs):
         """Check if the given "value" (via `args`) is unique or not.
@@ -771,6 +1382,26 @@ class EqualIndex(BaseIndex):
 
         self.assert_pks_uniqueness(pks, pk, lambda: list(args)[-1])
 
+    def check_uniqueness_many(self, entries):
+        """Check uniqueness of many values at once, with only one round trip to redis
+
+        For the parameters, see ``BaseIndex.check_uniqueness_many``
+
+        """
+        if not self.field.unique:
+            return
+
+        entries = [(pk, tuple(args), self.get_storage_key(*args)) for pk, args in entries]
+        self.assert_entries_uniqueness(entries)
+
+        with self.connection.pipeline(transaction=False) as pipe:
+            for __, __, key in entries:
+                pipe.smembers(self.get_uniqueness_key(key))
+            all_pks = pipe.execute()
+
+        for (pk, args, __), pks in zip(entries, all_pks):
+            self.assert_pks_uniqueness(pks, pk, lambda: args[-1])
+
     def store(self, key, pk, **kwargs):
         """Store data in the index in redis
 
@@ -790,7 +1421,8 @@ class EqualIndex(BaseIndex):
             subclasses.
 
         """
-        self.connection.sadd(key, pk)
+        self.write_connection.sadd(key, pk)
+        self.bump_version(key)
         return True
 
     def unstore(self, key, pk, **kwargs):
@@ -812,9 +1444,34 @@ class EqualIndex(BaseIndex):
             subclasses.
 
         """
-        self.connection.srem(key, pk)
+        self.write_connection.srem(key, pk)
+        self.bump_version(key)
         return True
 
+    def get_lockfree_write_args(self, value, unique=False):
+        """Get the arguments to pass to the lock-free write script of a field to update this index
+
+        The script will concatenate the value to the storage key prefix we return.
+
+        For the parameters and return value, see ``BaseIndex.get_lockfree_write_args``
+
+        Raises
+        ------
+        ImplementationError
+            If the index has a ``transform`` function, that cannot be applied in lua.
+
+        """
+        if self.transform:
+            raise ImplementationError('%s with a transform cannot be used on a field with lock-free writes' %
+                                      self.__class__.__name__)
+        return [
+            'equal',
+            self.get_storage_key(''),
+            '',
+            1 if unique else 0,
+            '' if value is None else self.normalize_value(value),
+        ]
+
     def add(self, pk, *args, **kwargs):
         """Add the instance tied to the field for the given "value" (via `args`) to the index
 
@@ -852,7 +1509,21 @@ class BaseRangeIndex(BaseIndex):
 
     handle_uniqueness = True
     lua_filter_script = NotImplemented
+    script_kind = None  # how lua scripts (lock-free writes, single-call collections) use this index
+    script_extra = ''  # extra data to pass to these lua scripts
     supported_key_types = {'set', 'zset'}
+    storage_key_type = 'zset'
+
+    def get_entries(self, pk, *args, **kwargs):
+        """Get the entry that ``add`` stores: the member and score from ``prepare_data_to_store``
+
+        For the parameters, see ``BaseIndex.get_entries``
+
+        """
+        member, score = self.prepare_data_to_store(pk, args[-1])
+        if score is None:
+            return []
+        return [(self.get_storage_key(*args), str(member), float(score))]
 
     def get_storage_key(self, *args):
         """Return the redis key where to store the index for the given "value" (`args`)
@@ -889,7 +1560,7 @@ class BaseRangeIndex(BaseIndex):
         if self.key:
             parts.append(self.key)
 
-        return self.field.make_key(*parts)
+        return self.make_key(*parts)
 
     def get_all_storage_keys(self):
         """Returns the keys to be removed by `clear` in aggressive mode
@@ -914,10 +1585,10 @@ class BaseRangeIndex(BaseIndex):
             parts2.append(self.key)
 
         return set(
-            self.model.database.scan_keys(self.field.make_key(*parts1))
+            self.model.database.scan_keys(self.make_key(*parts1))
         ).union(
             set(
-                self.model.database.scan_keys(self.field.make_key(*parts2))
+                self.model.database.scan_keys(self.make_key(*parts2))
             )
         )
 
@@ -959,6 +1630,32 @@ class BaseRangeIndex(BaseIndex):
 
         self.assert_pks_uniqueness(pks, pk, lambda: value)
 
+    def check_uniqueness_many(self, entries):
+        """Check uniqueness of many values at once, with only one round trip to redis
+
+        For the parameters, see ``BaseIndex.check_uniqueness_many``
+
+        """
+        if not self.field.unique:
+            return
+
+        entries = [
+            (pk, tuple(args), (self.get_storage_key(*args), self.normalize_value(args[-1])))
+            for pk, args in entries
+        ]
+        self.assert_entries_uniqueness(entries)
+
+        boundaries = []
+        with self.connection.pipeline(transaction=False) as pipe:
+            for __, __, (key, value) in entries:
+                start, end, exclude = self.get_boundaries('eq', value)
+                boundaries.append(exclude)
+                self.get_members_for_boundaries(pipe, key, start, end)
+            all_members = pipe.execute()
+
+        for (pk, args, __), members, exclude in zip(entries, all_members, boundaries):
+            self.assert_pks_uniqueness(self.get_pks_from_members(members, exclude), pk, lambda: args[-1])
+
     def store(self, key, member, score):
         """Store data in the index in redis
 
@@ -980,7 +1677,8 @@ class BaseRangeIndex(BaseIndex):
         """
         if score is None:
             return False
-        self.connection.zadd(key, {member: score})
+        self.write_connection.zadd(key, {member: score})
+        self.bump_version(key)
         return True
 
     def unstore(self, key, member, score):
@@ -1002,9 +1700,33 @@ class BaseRangeIndex(BaseIndex):
             subclasses.
 
         """
-        self.connection.zrem(key, member)
+        self.write_connection.zrem(key, member)
+        self.bump_version(key)
         return True
 
+    def get_lockfree_write_args(self, value, unique=False):
+        """Get the arguments to pass to the lock-free write script of a field to update this index
+
+        For the parameters and return value, see ``BaseIndex.get_lockfree_write_args``
+
+        Raises
+        ------
+        ImplementationError
+            If the index has a ``transform`` function, that cannot be applied in lua, or if
+            the index does not define its kind in ``script_kind``
+
+        """
+        if self.transform or not self.script_kind:
+            raise ImplementationError('%s cannot be used on a field with lock-free writes' %
+                                      self.__class__.__name__)
+        return [
+            self.script_kind,
+            self.get_storage_key(value),
+            self.script_extra,
+            1 if unique else 0,
+            '' if value is None else self.normalize_value(value),
+        ]
+
     def add(self, pk, *args, **kwargs):
         """Add the instance tied to the field for the given "value" (via `args`) to the index
 
@@ -1097,7 +1819,8 @@ class BaseRangeIndex(BaseIndex):
             # to avoid registering it many times
             script_dict=self.__class__.lua_filter_script,
             keys=[key, tmp_key],
-            args=[key_type, start, end, exclude or ""] + list(args)  # None is refused by redis-py so we pass ""
+            # None is refused by redis-py so we pass ""
+            args=[key_type, start, end, exclude or "", TMP_KEY_TTL] + list(args)
         )
 
     def get_filtered_keys(self, suffix, *args, **kwargs):
@@ -1110,6 +1833,10 @@ class BaseRangeIndex(BaseIndex):
         The process of reading from the sorted-set, extracting the primary keys, excluding some
         values if needed, and putting the primary keys in a set or zset, is done in lua at the
         redis level.
+        ``ZRANGESTORE`` (``redis >= 6.2``) is not used, even for a ``NumberRangeIndex``: it can
+        only create a sorted set, and the collections need a set (to use ``SINTERSTORE``,
+        ``SCARD``, ``SSCAN``...), as a sorted set would change how the extended collection
+        is sorted and paginated.
 
         """
         accepted_key_types = kwargs.get('accepted_key_types')
@@ -1132,14 +1859,15 @@ class BaseRangeIndex(BaseIndex):
                 for value in values
             ]
 
-            if key_type == 'set':
-                self.connection.sunionstore(tmp_key, in_keys)
-            else:
-                self.connection.zunionstore(tmp_key, in_keys)
-
-            # we can delete the temporary keys
-            for in_key in in_keys:
-                self.connection.delete(in_key)
+            with self.connection.pipeline(transaction=False) as pipe:
+                if key_type == 'set':
+                    pipe.sunionstore(tmp_key, in_keys)
+                else:
+                    pipe.zunionstore(tmp_key, in_keys)
+                pipe.expire(tmp_key, TMP_KEY_TTL)
+                # we can delete the temporary keys
+                pipe.delete(*in_keys)
+                pipe.execute()
 
             return [(tmp_key, key_type, True)]
 
@@ -1153,6 +1881,29 @@ class BaseRangeIndex(BaseIndex):
 
         return [(tmp_key, key_type, True)]
 
+    def get_script_filter_sources(self, suffix, *args, **kwargs):
+        """Return the boundaries to read in the sorted-set for the given "value" (`args`)
+
+        For the parameters, see ``BaseIndex.get_script_filter_sources``
+
+        """
+        if not self.script_kind:
+            return None
+
+        args = list(args)
+        if suffix == 'in':
+            values, real_suffix = set(args.pop()), 'eq'
+        else:
+            values, real_suffix = [args.pop()], self.remove_prefix(suffix)
+
+        sources = []
+        for value in values:
+            key = self.get_storage_key(*(args + [value]))
+            start, end, exclude = self.get_boundaries(
+                real_suffix, self.normalize_value(value, transform=False))
+            sources.append((self.script_kind, key, start, end, exclude or '', self.script_extra))
+        return sources
+
     def get_pks_for_filter(self, key, filter_type, value):
         """Extract the pks from the zset key for the given type and value
 
@@ -1173,7 +1924,49 @@ class BaseRangeIndex(BaseIndex):
             The list of instances PKs extracted from the sorted set
 
         """
+        start, end, exclude = self.get_boundaries(filter_type, value)
+        members = self.get_members_for_boundaries(self.connection, key, start, end)
+        return self.get_pks_from_members(members, exclude)
+
+    def get_members_for_boundaries(self, connection, key, start, end):
+        """Call the sorted-set command to get the members of `key` between the given boundaries
+
+        Parameters
+        ----------
+        connection: Union[Redis, Pipeline]
+            The connection to use. If it's a pipeline, the result will be available when the
+            pipeline will be executed.
+        key: str
+            The key of the redis sorted-set to use
+        start: str
+            The "start" boundary, as returned by ``get_boundaries``
+        end: str
+            The "end" boundary, as returned by ``get_boundaries``
+
+        Returns
+        -------
+        list
+            The members returned by redis (or the pipeline if `connection` is a pipeline)
 
+        """
+        raise NotImplementedError
+
+    def get_pks_from_members(self, members, exclude):
+        """Get the pks from the members returned by ``get_members_for_boundaries``
+
+        Parameters
+        ----------
+        members: list
+            The members of the sorted set, as returned by redis
+        exclude: Any
+            The ``exclude`` value returned by ``get_boundaries``
+
+        Returns
+        -------
+        list
+            The list of instances PKs extracted from the members
+
+        """
         raise NotImplementedError
 
 
@@ -1191,6 +1984,8 @@ class TextRangeIndex(BaseRangeIndex):
     handled_suffixes = {None, 'eq', 'gt', 'gte', 'lt', 'lte', 'startswith', 'in'}
     key = 'text-range'
     separator = u':%s-SEPARATOR:' % key.upper()
+    script_kind = 'text'
+    script_extra = separator
 
     lua_filter_script = {
         # we extract members of the sorted-set via zrangebylex
@@ -1199,15 +1994,16 @@ class TextRangeIndex(BaseRangeIndex):
         # and we add every pk to a set or zset depending on the asked type
         # if a zset, we use the returned position as a score for each member
         # we do this in block of 100 to avoid storing to many temporary things
-        # in memory
+        # in memory, each block starting after the last member of the previous
+        # one (members are unique), so no offset has to be skipped
         'lua': """
             local source_key, dest_type, dest_key = KEYS[1], ARGV[1], KEYS[2]
             local lex_start, lex_end = ARGV[2], ARGV[3]
-            local exclude, separator = ARGV[4], ARGV[5]
-            local start, block_size = 0, 100
+            local exclude, ttl, separator = ARGV[4], ARGV[5], ARGV[6]
+            local position, block_size = 0, 100
 
             while true do
-                local members = redis.call('zrangebylex', source_key, lex_start, lex_end, 'limit', start, block_size)
+                local members = redis.call('zrangebylex', source_key, lex_start, lex_end, 'limit', 0, block_size)
                 if members[1] == nil then -- nothing returned, we are done
                     break
                 end
@@ -1231,9 +2027,10 @@ class TextRangeIndex(BaseRangeIndex):
                         -- zadd expect args this way: score member score member ...
                         local args = {}
                         for i, member in ipairs(result) do
-                            args[2*i-1], args[2*i] = i-1, member
+                            args[2*i-1], args[2*i] = position + i - 1, member
                         end
                         redis.call('zadd', dest_key, unpack(args))
+                        position = position + nb_results
                     end
                 end
                 -- if we got less than the max, it means we are done
@@ -1241,8 +2038,10 @@ class TextRangeIndex(BaseRangeIndex):
                     break
                 end
                 -- loop again for the next block
-                start = start + block_size
+                lex_start = '(' .. members[block_size]
             end
+            -- the destination is a temporary key
+            redis.call('expire', dest_key, ttl)
             -- return the key, because why not
             return dest_key
         """
@@ -1260,6 +2059,14 @@ class TextRangeIndex(BaseRangeIndex):
         value = self.normalize_value(value)
         return self.separator.join([value, str(pk)]), 0
 
+    def get_entry_pk(self, member):
+        """Get the pk at the end of the member, after the separator
+
+        For the parameters, see ``BaseIndex.get_entry_pk``
+
+        """
+        return self._extract_value_from_storage(member)[1]
+
     def _extract_value_from_storage(self, string):
         """Taking a string that was a member of the zset, extract the value and pk
 
@@ -1335,13 +2142,18 @@ class TextRangeIndex(BaseRangeIndex):
 
         return start, end, exclude
 
-    def get_pks_for_filter(self, key, filter_type, value):
-        """Extract the pks from the zset key for the given type and value
+    def get_members_for_boundaries(self, connection, key, start, end):
+        """Call zrangebylex on the given key
 
-        For the parameters, see BaseRangeIndex.get_pks_for_filter
+        For the parameters, see BaseRangeIndex.get_members_for_boundaries
+        """
+        return connection.zrangebylex(key, start, end)
+
+    def get_pks_from_members(self, members, exclude):
+        """Extract the pks from the members, ignoring the ones with the ``exclude`` value
+
+        For the parameters, see BaseRangeIndex.get_pks_from_members
         """
-        start, end, exclude = self.get_boundaries(filter_type, value)
-        members = self.connection.zrangebylex(key, start, end)
         if exclude is not None:
             # special case where we don't want the exact given value, but we cannot
             # exclude it from the sorted set directly
@@ -1372,52 +2184,100 @@ class TextRangeIndex(BaseRangeIndex):
 
 
 class NumberRangeIndex(BaseRangeIndex):
+    """Index allowing to filter on numbers, in a sorted set, the value being the score
+
+    Configurable attributes
+    -----------------------
+    In addition to the ones defined in ``BaseIndex``:
+
+    sortable: bool
+        ``False`` by default. If ``True``, the sorted set of the index will be used to
+        sort collections by the field (see ``get_sort_storage_key``), instead of the
+        ``sort`` command. The order is the one of the indexed values (so a ``transform``
+        can be used, for example to sort dates by timestamps), whatever the ``alpha``
+        argument, and instances without indexed value are not returned.
+
+    """
 
     handled_suffixes = {None, 'eq', 'gt', 'gte', 'lt', 'lte', 'in'}
     key = 'number-range'
     raise_if_not_float = False
+    script_kind = 'number'
+    sortable = False
+
+    configurable_attrs = BaseRangeIndex.configurable_attrs | {'sortable'}
 
     lua_filter_script = {
-        # we extract members of the sorted-set via zrangebyscore
+        # we get the ranks of the first and last members in the range of scores
+        # then we extract members of the sorted-set via zrange, by rank
         # and we add every pk to a set or zset depending on the asked type
-        # if a zset, we use the returned position as a score for each member
+        # if a zset, we use the rank in the range as a score for each member
         # we do this in block of 100 to avoid storing to many temporary things
-        # in memory
+        # in memory, each block being read directly at its rank, so no offset
+        # has to be skipped
         'lua': """
             local source_key, dest_type, dest_key = KEYS[1], ARGV[1], KEYS[2]
             local score_start, score_end = ARGV[2], ARGV[3]
-            local start, block_size = 0, 100
+            local ttl = ARGV[5]
+            local block_size = 100
+
+            local first_rank = 0
+            if score_start:sub(1, 1) == '(' then
+                first_rank = redis.call('zcount', source_key, '-inf', score_start:sub(2))
+            elseif score_start ~= '-inf' then
+                first_rank = redis.call('zcount', source_key, '-inf', '(' .. score_start)
+            end
+            local last_rank = first_rank + redis.call('zcount', source_key, score_start, score_end) - 1
+            local rank = first_rank
 
-            while true do
-                local members = redis.call('zrangebyscore', source_key, score_start, score_end, 'limit', start, block_size)
+            while rank <= last_rank do
+                local members = redis.call('zrange', source_key, rank, math.min(rank + block_size - 1, last_rank))
                 if members[1] == nil then -- nothing returned, we are done
                     break
                 end
-                -- call sadd/zadd only if we have something to put in
-                if #members > 0 then  -- sadly, no "continue" in lua :(
-                    if dest_type == 'set' then
-                        redis.call('sadd', dest_key, unpack(members))
-                    else
-                        -- zadd expect args this way: score member score member ...
-                        local args = {}
-                        for i, member in ipairs(members) do
-                            args[2*i-1], args[2*i] = i-1, member
-                        end
-                        redis.call('zadd', dest_key, unpack(args))
+                if dest_type == 'set' then
+                    redis.call('sadd', dest_key, unpack(members))
+                else
+                    -- zadd expect args this way: score member score member ...
+                    local args = {}
+                    for i, member in ipairs(members) do
+                        args[2*i-1], args[2*i] = rank - first_rank + i - 1, member
                     end
-                end
-                -- if we got less than the max, it means we are done
-                if members[block_size] == nil then
-                    break
+                    redis.call('zadd', dest_key, unpack(args))
                 end
                 -- loop again for the next block
-                start = start + block_size
+                rank = rank + block_size
             end
+            -- the destination is a temporary key
+            redis.call('expire', dest_key, ttl)
             -- return the key, because why not
             return dest_key
         """
     }
 
+    @classmethod
+    def handle_configurable_attrs(cls, **kwargs):
+        """Handle attributes that can be passed to ``configure``.
+
+        This method handle the ``sortable`` attribute added in this index class.
+        For the other parameters, see ``BaseIndex.handle_configurable_attrs``.
+
+        """
+        name, attrs, kwargs = super(NumberRangeIndex, cls).handle_configurable_attrs(**kwargs)
+        if 'sortable' in kwargs:
+            attrs['sortable'] = bool(kwargs.pop('sortable'))
+        return name, attrs, kwargs
+
+    def get_sort_storage_key(self):
+        """Returns the sorted set of the index if the index is ``sortable``
+
+        For the parameters, see BaseIndex.get_sort_storage_key
+
+        """
+        if not self.sortable or self.field._field_parts != 1:
+            return None
+        return self.get_storage_key(None)
+
     def normalize_value(self, value, transform=True):
         """Prepare the given value to be stored in the index
 
@@ -1491,13 +2351,19 @@ class NumberRangeIndex(BaseRangeIndex):
 
         return start, end, exclude
 
-    def get_pks_for_filter(self, key, filter_type, value):
-        """Extract the pks from the zset key for the given type and value
+    def get_members_for_boundaries(self, connection, key, start, end):
+        """Call zrangebyscore on the given key
+
+        For the parameters, see BaseRangeIndex.get_members_for_boundaries
+        """
+        return connection.zrangebyscore(key, start, end)
 
-        For the parameters, see BaseRangeIndex.get_pks_for_filter
+    def get_pks_from_members(self, members, exclude):
+        """The members are the pks (we have nothing to exclude)
+
+        For the parameters, see BaseRangeIndex.get_pks_from_members
         """
-        start, end, __ = self.get_boundaries(filter_type, value)  # we have nothing to exclude
-        return self.connection.zrangebyscore(key, start, end)
+        return members
 
 
 class _MultiFieldsIndexMixin(object):
@@ -1513,6 +2379,17 @@ class _MultiFieldsIndexMixin(object):
         cls.configurable_attrs -= {'handle_uniqueness'}
         return super(_MultiFieldsIndexMixin, cls).handle_configurable_attrs(**kwargs)
 
+    def get_lockfree_write_args(self, value, unique=False):
+        """A multi-fields index cannot be updated by the lock-free write script of a field
+
+        For the parameters, see ``BaseIndex.get_lockfree_write_args``
+        """
+        return BaseIndex.get_lockfree_write_args(self, value, unique)
+
+    def get_script_filter_sources(self, suffix, *args, **kwargs):
+        """Multi-fields indexes cannot be used by the single-call collection script"""
+        return None
+
     def can_filter_fields(self, fields_and_suffixes):
         """Tell if the index can handle the given fields + suffixes
 
@@ -1589,3 +2466,19 @@ class _MultiFieldsIndexMixin(object):
 
         """
         raise NotImplementedError
+
+    def check_uniqueness_at_init_many(self, values_list):
+        """Check ``check_uniqueness_at_init`` for many instances to create at once
+
+        It's used by ``RedisModel.bulk_create``. This default implementation calls
+        ``check_uniqueness_at_init`` for each entry, subclasses may do it in less round
+        trips, and must also check that the same values are not used twice in `values_list`.
+
+        Parameters
+        ----------
+        values_list : List[Dict[str, Any]]
+            One dict for each instance to create, as the `values` of ``check_uniqueness_at_init``.
+
+        """
+        for values in values_list:
+            self.check_uniqueness_at_init(values)
@@ -5,13 +5,17 @@ from future.utils import iteritems, iterkeys
 from future.utils import with_metaclass
 
 from collections import defaultdict
+from contextlib import contextmanager
 from logging import getLogger
 from copy import copy
 import inspect
+import json
 import threading
+import time
 
 from limpyd.fields import *
-from limpyd.utils import make_key
+from limpyd.fields import FieldLock, SingleValueField
+from limpyd.utils import make_key, normalize, unique_key, NotProvided
 from limpyd.exceptions import *
 from limpyd.database import RedisDatabase
 from limpyd.collection import CollectionManager
@@ -22,6 +26,55 @@ log = getLogger(__name__)
 threadlocal = threading.local()
 
 
+class FieldDescriptor(object):
+    """
+    Descriptor set on a model for each of its fields (and for `pk` if the real
+    pk has another name). The field of an instance is created (by copying the
+    field of the model) only the first time it is accessed, then stored in the
+    instance `__dict__`, so it is directly used for the next accesses.
+    At the class level, the attribute overridden by the field, if any, is
+    returned as if the descriptor did not exist.
+    """
+    __slots__ = ('name', 'field_name', 'shadowed')
+
+    def __init__(self, name, field_name, shadowed=NotProvided):
+        self.name = name
+        self.field_name = field_name
+        self.shadowed = shadowed
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            if self.shadowed is NotProvided:
+                raise AttributeError(self.name)
+            if hasattr(self.shadowed, '__get__'):
+                return self.shadowed.__get__(None, owner)
+            return self.shadowed
+
+        if self.field_name != self.name:
+            # alias to the real pk field
+            field = getattr(instance, self.field_name)
+        else:
+            field = copy(owner.get_class_field(self.name))
+            field._attach_to_instance(instance)
+        instance.__dict__[self.name] = field
+        return field
+
+    @classmethod
+    def install(cls, model, name, field_name):
+        """
+        Set a descriptor on the given model for the given name, keeping the
+        attribute it overrides, if any, to be returned at the class level.
+        """
+        shadowed = NotProvided
+        for klass in model.__mro__:
+            if name in klass.__dict__:
+                shadowed = klass.__dict__[name]
+                if isinstance(shadowed, cls):
+                    shadowed = shadowed.shadowed
+                break
+        setattr(model, name, cls(name, field_name, shadowed))
+
+
 class MetaRedisModel(MetaRedisProxy):
     """
     We make invisible for user that fields were class properties
@@ -144,6 +197,11 @@ class MetaRedisModel(MetaRedisProxy):
         if pk_field.name != 'pk':
             it._redis_attr_pk = getattr(it, "_redis_attr_%s" % pk_field.name)
 
+        # The fields of the instances are created only when accessed
+        for field_name in _fields:
+            FieldDescriptor.install(it, field_name, field_name)
+        FieldDescriptor.install(it, 'pk', pk_field.name)
+
         # Tell index classes that fields are now ready
         for field in it.get_fields():
             if field is it._redis_attr_pk:
@@ -159,6 +217,27 @@ class MetaRedisModel(MetaRedisProxy):
 
         return it
 
+    def __call__(cls, *args, **kwargs):
+        """
+        If an identity map is opened on the database (see
+        `RedisDatabase.identity_map`), return the instance already in it for
+        the asked pk, or add the new instance to it.
+        """
+        identity_map = cls.database.current_identity_map if not cls.abstract else None
+        if identity_map is None:
+            return super(MetaRedisModel, cls).__call__(*args, **kwargs)
+
+        if len(args) == 1 and not kwargs:
+            instance = identity_map.get_instance(cls, cls.get_field('pk').normalize(args[0]))
+            if instance is not None:
+                instance.connect()  # may have been created by `lazy_connect`
+                return instance
+
+        instance = super(MetaRedisModel, cls).__call__(*args, **kwargs)
+        if instance._pk:
+            identity_map.add_instance(instance)
+        return instance
+
 
 class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
     """
@@ -167,10 +246,15 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
     namespace = None  # all models in an app may have the same namespace
     lockable = True
+    lock_scope = 'field'  # default scope of the lock of the fields: field, instance or value
+    deferred_indexing = False  # if True, non-unique fields are indexed later by a worker
+    cache_collections = False  # if True, index writes are versioned so collections can be cached
+    versioned_indexes = False  # if True, the index keys are versioned to allow shadow rebuilds
     abstract = True
     collection_manager = CollectionManager
     DoesNotExist = DoesNotExist
     default_indexes = None
+    _index_keys_prefix = None  # set in the workers of a parallel rebuild of an index
 
     available_getters = {'hmget', 'hgetall', 'hkeys', 'hvals', 'hlen', }
     available_modifiers = {'hmset', 'hdel', }
@@ -190,18 +274,18 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         # set to True when the instance's PK will be tested for existence in redis
         self._connected = False
 
+        # values set in a `batch` block, waiting to be written
+        self._batch = None
+
+        # values of InstanceHashField read by a collection (see `CollectionManager.prefetch`)
+        self._prefetched = None
+
         # --- Meta stuff
-        # Put back the fields with the original names
-        for field in self.get_class_fields():
-            # Copy it, to avoid sharing fields between model instances
-            new_field = copy(field)
-            new_field._attach_to_instance(self)
-            setattr(self, field.name, new_field)
-
-        # The `pk` field always exists, even if the real pk has another name
-        pk_field_name = getattr(self, "_redis_attr_pk").name
-        if pk_field_name != 'pk':
-            self.pk = getattr(self, pk_field_name)
+        # The fields are not created here but on first access, by copying the
+        # ones of the model, to avoid sharing fields between model instances
+        # (see `FieldDescriptor`). The `pk` field always exists, even if the
+        # real pk has another name.
+
         # Cache of the pk value
         self._pk = None
 
@@ -224,6 +308,7 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
             # (More robust than trying to manage a "pseudotransaction", as
             # redis do not has "real" transactions)
             # Here we do not set anything, in case one unique field fails
+            pk_field_name = self._redis_attr_pk.name
             kwargs_pk_field_name = None
             for field_name, value in iteritems(kwargs):
                 if self._field_is_pk(field_name):
@@ -242,26 +327,7 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
                 self._init_fields.add(field_name)
 
             # handle uniqueness check for multi-fields indexes
-            if self._multi_fields_index_for_filtering and any(index.unique for index in self._multi_fields_index_for_filtering):
-                passed_fields = {
-                    field.name: kwargs[field.name]
-                    for field in self.fields
-                    if field.name in kwargs and not self._field_is_pk(field.name)
-                }
-                if passed_fields:
-                    handled_together = defaultdict(list)
-                    for index in self._multi_fields_index_for_filtering:
-                        if not index.unique:
-                            continue
-                        handled_fields_tuples = index.can_filter_fields([(field_name, None) for field_name in passed_fields])
-                        for handled_fields in handled_fields_tuples:
-                            handled_together[handled_fields].append(index)
-                    for handled_fields, indexes in handled_together.items():
-                        for index in indexes:
-                            index.check_uniqueness_at_init({
-                                field_name: passed_fields[field_name]
-                                for field_name in dict(handled_fields)
-                            })
+            self._check_multi_fields_uniqueness_at_init(kwargs)
 
             # Do instanciate, starting by the pk and respecting fields order
             if kwargs_pk_field_name:
@@ -278,9 +344,65 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
         # --- Instanciate from DB
         if len(args) == 1:
-            self._pk = self.pk.normalize(args[0])
+            self._pk = self._redis_attr_pk.normalize(args[0])
             self.connect()
 
+    @classmethod
+    def _check_multi_fields_uniqueness_at_init(cls, kwargs):
+        """
+        Check, for the unique multi-fields indexes, that the values in `kwargs`
+        can be used to create a new instance.
+        """
+        for index, values in cls._get_multi_fields_uniqueness_values(kwargs):
+            index.check_uniqueness_at_init(values)
+
+    @classmethod
+    def _check_multi_fields_uniqueness_at_init_many(cls, all_kwargs):
+        """
+        Check, for the unique multi-fields indexes, that the values of each
+        dict of `all_kwargs` can be used to create a new instance, and that
+        they are not used twice in `all_kwargs`, with one round trip to redis
+        for each index.
+        """
+        values_by_index = defaultdict(list)
+        for kwargs in all_kwargs:
+            for index, values in cls._get_multi_fields_uniqueness_values(kwargs):
+                values_by_index[index].append(values)
+        for index, values_list in values_by_index.items():
+            index.check_uniqueness_at_init_many(values_list)
+
+    @classmethod
+    def _get_multi_fields_uniqueness_values(cls, kwargs):
+        """
+        Return a list of tuples, with a unique multi-fields index, and the
+        values of `kwargs` it has to check for uniqueness when creating a new
+        instance.
+        """
+        if not cls._multi_fields_index_for_filtering or not any(index.unique for index in cls._multi_fields_index_for_filtering):
+            return []
+        passed_fields = {
+            field.name: kwargs[field.name]
+            for field in cls.get_class_fields()
+            if field.name in kwargs and not cls._field_is_pk(field.name)
+        }
+        if not passed_fields:
+            return []
+        handled_together = defaultdict(list)
+        for index in cls._multi_fields_index_for_filtering:
+            if not index.unique:
+                continue
+            handled_fields_tuples = index.can_filter_fields([(field_name, None) for field_name in passed_fields])
+            for handled_fields in handled_fields_tuples:
+                handled_together[handled_fields].append(index)
+        return [
+            (index, {
+                field_name: passed_fields[field_name]
+                for field_name in dict(handled_fields)
+            })
+            for handled_fields, indexes in handled_together.items()
+            for index in indexes
+        ]
+
     @classmethod
     def get_default_indexes(cls):
         if cls.default_indexes is not None:
@@ -308,9 +430,16 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         Create an object, setting its primary key without testing it. So the
         instance is not connected
         """
+        identity_map = cls.database.current_identity_map
+        if identity_map is not None:
+            instance = identity_map.get_instance(cls, cls.get_field('pk').normalize(pk))
+            if instance is not None:
+                return instance
         instance = cls()
-        instance._pk = instance.pk.normalize(pk)
+        instance._pk = cls.get_field('pk').normalize(pk)
         instance._connected = False
+        if identity_map is not None:
+            identity_map.add_instance(instance)
         return instance
 
     @property
@@ -414,14 +543,505 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         return cls.collection(**filters).instances(lazy=lazy)
 
     @classmethod
-    def from_pks(cls, pks, lazy=False):
-        """Returns a generator with one instance for each pk that exist"""
-        meth = cls.lazy_connect if lazy else cls
+    def from_pks(cls, pks, lazy=False, chunk_size=1000):
+        """
+        Returns a generator with one instance for each pk that exist.
+        If not `lazy`, the existence of the pks is checked by chunks of
+        `chunk_size` pks, with only one call to redis for each chunk.
+        """
+        if lazy:
+            for pk in pks:
+                yield cls.lazy_connect(pk)
+            return
+
+        pk_field = cls.get_field('pk')
+        chunk = []
         for pk in pks:
-            try:
-                yield meth(pk)
-            except DoesNotExist:
+            chunk.append(pk)
+            if len(chunk) >= chunk_size:
+                for instance in cls._from_existing_pks(chunk, pk_field.exists_many(chunk)):
+                    yield instance
+                chunk = []
+        if chunk:
+            for instance in cls._from_existing_pks(chunk, pk_field.exists_many(chunk)):
+                yield instance
+
+    @classmethod
+    def _from_existing_pks(cls, pks, exist):
+        """
+        Yield a connected instance for each pk of `pks` for which the entry in
+        `exist` is True, without checking again their existence.
+        """
+        for pk, exists in zip(pks, exist):
+            if exists:
+                instance = cls.lazy_connect(pk)
+                instance._connected = True
+                yield instance
+
+    @classmethod
+    def bulk_create(cls, iterable_of_kwargs, chunk_size=1000):
+        """
+        Create one instance for each dict of fields values of `iterable_of_kwargs`
+        (the same as the ones passed to the constructor) and return the list of
+        their pks.
+        Instances are created by chunks of `chunk_size`. For each chunk, the
+        pks are reserved in one call, the uniqueness of all the values is
+        checked at once (in redis and in the chunk itself), then the values and
+        the indexes are written using pipelines, without one round trip to
+        redis for each field of each instance.
+        If a uniqueness check fails, a `UniquenessError` is raised and no
+        instance of the current chunk is created (but the ones of the previous
+        chunks are kept).
+        """
+        pks = []
+        chunk = []
+        for kwargs in iterable_of_kwargs:
+            chunk.append(kwargs)
+            if len(chunk) >= chunk_size:
+                pks.extend(cls._bulk_create_chunk(chunk))
+                chunk = []
+        if chunk:
+            pks.extend(cls._bulk_create_chunk(chunk))
+        return pks
+
+    @classmethod
+    def _bulk_create_chunk(cls, chunk):
+        """
+        Create all the instances for the given list of kwargs, and return their
+        pks. See `bulk_create`.
+        """
+        pk_field = cls.get_field('pk')
+        connection = cls.get_connection()
+
+        # check fields names and extract the pks
+        given_pks = []
+        all_values = []
+        for kwargs in chunk:
+            pk = None
+            kwargs_pk_field_name = None
+            values = {}
+            for field_name, value in iteritems(kwargs):
+                if cls._field_is_pk(field_name):
+                    if kwargs_pk_field_name:
+                        raise ValueError(u'You cannot pass two values for the '
+                                           'primary key (pk and %s)' % pk_field.name)
+                    kwargs_pk_field_name = field_name
+                    pk = value
+                    continue
+                if not cls.has_field(field_name):
+                    raise ValueError(u"`%s` is not a valid field name "
+                                      "for `%s`." % (field_name, cls.__name__))
+                values[field_name] = value
+            given_pks.append(pk)
+            all_values.append(values)
+
+        # get the pks to use
+        if pk_field._auto_increment:
+            if any(pk is not None for pk in given_pks):
+                raise ValueError('The pk for %s is "auto-increment", you must not fill it' %
+                                 cls.__name__)
+            last_pk = connection.incrby(make_key(cls._name, 'max_pk'), len(chunk))
+            pks = [pk_field.normalize(pk) for pk in range(last_pk - len(chunk) + 1, last_pk + 1)]
+        else:
+            if any(pk is None for pk in given_pks):
+                raise ValueError('The pk for %s is not "auto-increment", you must fill it' %
+                                 cls.__name__)
+            pks = [pk_field.normalize(pk) for pk in given_pks]
+            if len(set(pks)) != len(pks):
+                raise UniquenessError('PKField used many times for model %s' % cls.__name__)
+            with connection.pipeline(transaction=False) as pipeline:
+                for pk in pks:
+                    pipeline.sismember(pk_field.collection_key, pk)
+                for pk, exists in zip(pks, pipeline.execute()):
+                    if exists:
+                        raise UniquenessError('PKField %s already exists for model %s)' %
+                                              (pk, cls))
+
+        instances = [cls.lazy_connect(pk) for pk in pks]
+
+        # add default values
+        for field in cls.get_class_fields():
+            if hasattr(field, 'default'):
+                for values in all_values:
+                    values.setdefault(field.name, field.default)
+
+        locks = []
+        try:
+            # lock unique fields to avoid a value to be used in the meantime
+            for field in cls.get_class_fields():
+                if field.unique and not cls._field_is_pk(field.name):
+                    lock = FieldLock(instances[0].get_field(field.name))
+                    lock.acquire()
+                    locks.append(lock)
+
+            # prepare the writes, and get the values to index
+            to_index = []
+            deferred = []
+            with connection.pipeline(transaction=False) as pipeline:
+                for instance, values in zip(instances, all_values):
+                    pipeline.sadd(pk_field.collection_key, instance._pk)
+                    instance_to_index = []
+                    for field in instance.fields:
+                        if field.name not in values:
+                            continue
+                        field_values = field._bulk_set(pipeline, values[field.name])
+                        if field.deferred_indexing:
+                            deferred.append((instance._pk, field.name))
+                        elif field.indexable:
+                            instance_to_index.append((field, field_values))
+                    to_index.append((instance, instance_to_index))
+
+                # check uniqueness before writing anything
+                for field in cls.get_class_fields():
+                    if not field.unique or cls._field_is_pk(field.name):
+                        continue
+                    field.get_unique_index().check_uniqueness_many([
+                        (instance._pk, parts)
+                        for instance, instance_to_index in to_index
+                        for index_field, field_values in instance_to_index
+                        if index_field.name == field.name
+                        for parts in field._prepare_index_data(instance._pk, field_values)
+                        if parts[-1] is not None
+                    ])
+                cls._check_multi_fields_uniqueness_at_init_many(chunk)
+
+                pipeline.execute()
+
+            if deferred:
+                cls._defer_indexing(deferred)
+
+            # and finally index all the values
+            with cls.database.index_pipeline():
+                for instance, instance_to_index in to_index:
+                    for field, field_values in instance_to_index:
+                        field._add_to_indexes(field._indexes, instance._pk,
+                                              field._prepare_index_data(instance._pk, field_values), False)
+            for instance, instance_to_index in to_index:
+                for field, __ in instance_to_index:
+                    field._reset_indexes_rollback_caches(instance._pk)
+
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        return pks
+
+    @classmethod
+    @contextmanager
+    def _lock_fields(cls, field_names):
+        """
+        Lock the given fields, for all the instances, in the `with` block.
+        Used by the bulk operations on collections, with one lock by field
+        for each chunk of instances.
+        """
+        locks = []
+        try:
+            for field_name in field_names:
+                lock = FieldLock(cls.get_class_field(field_name))
+                lock.acquire()
+                locks.append(lock)
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @classmethod
+    def _bulk_delete(cls, pks):
+        """
+        Delete the instances with the given pks without calling `delete` on
+        each of them (used by `CollectionManager.delete`): with the indexable
+        fields locked, the existence of the instances and the values of these
+        fields are read in one pipeline, then all the values are deindexed, and
+        the keys deleted, in another one. Return the number of existing
+        instances deleted.
+        """
+        if not pks:
+            return 0
+        instances = [cls.lazy_connect(pk) for pk in pks]
+        pk_field = cls.get_field('pk')
+
+        indexed = []
+        deferred = []
+        for field in cls.get_class_fields():
+            if field is pk_field or not field.indexable:
                 continue
+            if field.deferred_indexing:
+                deferred.extend((instance._pk, field.name) for instance in instances)
+            else:
+                indexed.append(field.name)
+
+        count = 0
+        with cls._lock_fields(indexed):
+            # read the existence of the instances and the values to deindex at once
+            with cls.get_connection().pipeline(transaction=False) as pipeline:
+                for instance in instances:
+                    pipeline.sismember(pk_field.collection_key, instance._pk)
+                    for field_name in indexed:
+                        instance.get_field(field_name)._bulk_get(pipeline)
+                results = iter(pipeline.execute())
+
+            try:
+                # deindex the values and delete the keys in the same pipeline
+                with cls.database.index_pipeline():
+                    for instance in instances:
+                        count += bool(next(results))
+                        for field_name in indexed:
+                            field = instance.get_field(field_name)
+                            value = next(results)
+                            field._deindex([value] if isinstance(field, SingleValueField) else value)
+
+                    pipeline = cls.database.index_write_connection
+                    for instance in instances:
+                        keys = [field.key for field in instance.fields
+                                if field is not instance.pk and not isinstance(field, InstanceHashField)]
+                        if cls._instancehash_fields:
+                            keys.append(instance.key)
+                        if keys:
+                            pipeline.delete(*keys)
+                    pipeline.srem(pk_field.collection_key, *[instance._pk for instance in instances])
+            finally:
+                for instance in instances:
+                    for field_name in indexed:
+                        instance.get_field(field_name)._reset_indexes_rollback_caches(instance._pk)
+
+        if deferred:
+            cls._defer_indexing(deferred)
+
+        identity_map = cls.database.current_identity_map
+        for instance in instances:
+            if identity_map is not None:
+                for field in instance.fields:
+                    if field is not instance.pk:
+                        identity_map.invalidate(field.key)
+                identity_map.discard_instance(cls, instance._pk)
+            # Deactivate the instance
+            delattr(instance, "_pk")
+
+        return count
+
+    @classmethod
+    def _bulk_update(cls, pks, values):
+        """
+        Set the given values (a dict with field names as keys) on the instances
+        with the given pks without locking each field of each instance (used
+        by `CollectionManager.update`): with the updated fields locked, the
+        existence of the instances and the current values of the indexable
+        fields are read in one pipeline, then the indexes are updated, and the
+        values written, in another one.
+        Return the number of existing instances updated.
+        """
+        if not pks:
+            return 0
+        instances = [cls.lazy_connect(pk) for pk in pks]
+        pk_field = cls.get_field('pk')
+
+        indexed = []
+        deferred = []
+        for field_name in values:
+            field = cls.get_class_field(field_name)
+            if field.deferred_indexing:
+                deferred.append(field_name)
+            elif field.indexable:
+                indexed.append(field_name)
+
+        with cls._lock_fields(values):
+            # read the existence of the instances and the values to deindex at once
+            with cls.get_connection().pipeline(transaction=False) as pipeline:
+                for instance in instances:
+                    pipeline.sismember(pk_field.collection_key, instance._pk)
+                    for field_name in indexed:
+                        instance.get_field(field_name)._bulk_get(pipeline)
+                results = iter(pipeline.execute())
+
+            existing = []
+            for instance in instances:
+                exists = next(results)
+                currents = [next(results) for field_name in indexed]
+                if exists:
+                    existing.append((instance, currents))
+            if not existing:
+                return 0
+
+            try:
+                # update the indexes and write the values in the same pipeline
+                with cls.database.index_pipeline():
+                    for instance, currents in existing:
+                        for field_name, current in zip(indexed, currents):
+                            field = instance.get_field(field_name)
+                            value = values[field_name]
+                            if normalize(current) != normalize(value):
+                                if current is not None:
+                                    field.deindex(current)
+                                if value is not None:
+                                    field.index(value)
+
+                    pipeline = cls.database.index_write_connection
+                    for instance, currents in existing:
+                        hash_values = {}
+                        for field_name, value in iteritems(values):
+                            field = instance.get_field(field_name)
+                            if isinstance(field, InstanceHashField):
+                                hash_values[field_name] = field.from_python(value)
+                            else:
+                                field._bulk_set(pipeline, value)
+                        if hash_values:
+                            pipeline.hmset(instance.key, hash_values)
+            except:
+                # We revert indexes previously set if we have an exception, then
+                # really raise the error
+                for instance, currents in existing:
+                    for field_name in indexed:
+                        instance.get_field(field_name)._rollback_indexes()
+                raise
+            finally:
+                for instance, currents in existing:
+                    for field_name in indexed:
+                        instance.get_field(field_name)._reset_indexes_rollback_caches(instance._pk)
+
+        cls._after_bulk_update([instance for instance, currents in existing], values, deferred)
+
+        return len(existing)
+
+    bulk_update_script = {
+        # KEYS are the keys of the hashes of the instances, ARGV are, in this order: the
+        # key of the set of all the pks, the key of the hash of the index versions (empty
+        # if the model doesn't cache its collections), the number of fields, then for each
+        # field its name, its new value, its number of indexes and five entries for each
+        # index, as returned by `BaseIndex.get_lockfree_write_args`, and finally the pks
+        # of the instances, in the same order as KEYS
+        # Returns, for each instance, 1 if it exists (and so was updated), else 0
+        'lua': """
+            local collection_key, versions_key = ARGV[1], ARGV[2]
+            local fields = {}
+            local position = 4
+            for f = 1, tonumber(ARGV[3]) do
+                local field = {name = ARGV[position], value = ARGV[position + 1], indexes = {}}
+                local nb_indexes = tonumber(ARGV[position + 2])
+                position = position + 3
+                for i = 1, nb_indexes do
+                    field.indexes[i] = {
+                        kind = ARGV[position], key = ARGV[position + 1],
+                        extra = ARGV[position + 2], value = ARGV[position + 4]
+                    }
+                    position = position + 5
+                end
+                fields[f] = field
+            end
+            -- increment the version of an index (see `BaseIndex.get_version_entry`)
+            local function bump_version(key)
+                if versions_key ~= '' then
+                    redis.call('hincrby', versions_key, key, 1)
+                end
+            end
+            local updated = {}
+            for k, data_key in ipairs(KEYS) do
+                local pk = ARGV[position + k - 1]
+                updated[k] = redis.call('sismember', collection_key, pk)
+                if updated[k] == 1 then
+                    for _, field in ipairs(fields) do
+                        local old_value = redis.call('hget', data_key, field.name)
+                        if old_value ~= field.value then
+                            for _, index in ipairs(field.indexes) do
+                                if index.kind == 'equal' then
+                                    if old_value then
+                                        redis.call('srem', index.key .. old_value, pk)
+                                    end
+                                    redis.call('sadd', index.key .. index.value, pk)
+                                elseif index.kind == 'text' then
+                                    if old_value then
+                                        redis.call('zrem', index.key, old_value .. index.extra .. pk)
+                                    end
+                                    redis.call('zadd', index.key, 0, index.value .. index.extra .. pk)
+                                else
+                                    redis.call('zadd', index.key, index.value, pk)
+                                end
+                                bump_version(index.key)
+                            end
+                            redis.call('hset', data_key, field.name, field.value)
+                        end
+                    end
+                end
+            end
+            return updated
+        """
+    }
+
+    @classmethod
+    def _bulk_update_lua(cls, pks, values):
+        """
+        Do the same as `_bulk_update`, but in one lua script, so without
+        reading anything before (the updated fields are still locked, for the
+        writes of other threads that read the values before updating indexes).
+        Only for InstanceHashField whose indexes can be updated by lua (see
+        `BaseIndex.get_lockfree_write_args`).
+        """
+        if not pks:
+            return 0
+        instances = [cls.lazy_connect(pk) for pk in pks]
+
+        deferred = []
+        script_args = [
+            cls.get_field('pk').collection_key,
+            cls._index_versions_key() if cls.cache_collections else '',
+            len(values),
+        ]
+        for field_name, value in iteritems(values):
+            field = instances[0].get_field(field_name)
+            indexes_args = []
+            if field.deferred_indexing:
+                deferred.append(field_name)
+            elif field.indexable:
+                indexes_args = [index.get_lockfree_write_args(value) for index in field._indexes]
+                building = field._get_index_version_being_built()
+                if building:
+                    # during a shadow rebuild, the version being built gets the writes too
+                    with field._index_versions.force(building):
+                        indexes_args.extend(index.get_lockfree_write_args(value) for index in field._indexes)
+            script_args.extend([field_name, field.from_python(value), len(indexes_args)])
+            for index_args in indexes_args:
+                script_args.extend(index_args)
+        script_args.extend(instance._pk for instance in instances)
+
+        with cls._lock_fields(values):
+            updated = cls.database.call_script(
+                cls.bulk_update_script,
+                keys=[instance.key for instance in instances],
+                args=script_args,
+            )
+        instances = [instance for instance, exists in zip(instances, updated) if exists]
+
+        cls._after_bulk_update(instances, values, deferred)
+
+        return len(instances)
+
+    @classmethod
+    def _after_bulk_update(cls, instances, values, deferred):
+        """
+        Add the deferred indexing events of the given updated instances, and
+        invalidate the keys written in the identity map.
+        """
+        if deferred:
+            cls._defer_indexing([(instance._pk, field_name)
+                                 for instance in instances for field_name in deferred])
+
+        identity_map = cls.database.current_identity_map
+        if identity_map is not None:
+            for instance in instances:
+                for field_name in values:
+                    identity_map.invalidate(instance.get_field(field_name).key)
+
+    @classmethod
+    def verify_indexes(cls, chunk_size=1000, repair=False):
+        """
+        Check, and repair if `repair` is True, the indexes of all the indexable
+        fields of the model (see `RedisField.verify_indexes`). Return a dict
+        with, for each field name, the number of missing and stale entries.
+        """
+        return {
+            field.name: field.verify_indexes(chunk_size=chunk_size, repair=repair)
+            for field in cls.get_class_fields()
+            if field.indexable and field is not cls.get_field('pk')
+        }
 
     @classmethod
     def _field_is_pk(cls, name):
@@ -518,9 +1138,17 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
     # --- Hash management
     @property
     def key(self):
-        return self.make_key(
-            self._name,
-            self.pk.get(),
+        return self.get_hash_key(self.pk.get())
+
+    @classmethod
+    def get_hash_key(cls, pk):
+        """
+        Return the key of the hash holding the InstanceHashField of the
+        instance with the given pk.
+        """
+        return cls.make_key(
+            cls._name,
+            pk,
             "hash",
         )
 
@@ -554,22 +1182,31 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         if kwargs and not any(kwarg in self._instancehash_fields for kwarg in iterkeys(kwargs)):
             raise ValueError("Only InstanceHashField can be used here.")
 
+        self._discard_prefetched(kwargs)
+
         indexed = []
+        deferred = []
 
         # main try block to revert indexes if something fail
         try:
 
-            # Set indexes for indexable fields.
-            for field_name, value in iteritems(kwargs):
-                field = self.get_field(field_name)
-                if field.indexable:
-                    indexed.append(field)
-                    field.deindex()
-                    field.index(value)
+            # Set indexes for indexable fields, sending all index writes at once.
+            with self.database.index_pipeline():
+                for field_name, value in iteritems(kwargs):
+                    field = self.get_field(field_name)
+                    if field.deferred_indexing:
+                        deferred.append((self._pk, field.name))
+                    elif field.indexable:
+                        indexed.append(field)
+                        field.deindex()
+                        field.index(value)
 
             # Call redis (waits for a dict)
             result = self._call_command('hmset', kwargs)
 
+            if deferred:
+                self._defer_indexing(deferred)
+
             return result
 
         except:
@@ -583,6 +1220,118 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
             for field in indexed:
                 field._reset_indexes_rollback_caches(self.pk.get())
 
+    @contextmanager
+    def batch(self):
+        """
+        Buffer the values set on the `StringField` and `InstanceHashField` of the
+        instance in the `with` block, and write them when the block ends: the
+        current values of the indexed fields are read in one pipeline, then all
+        the values and the changes in the indexes are sent in another one, with
+        one `hmset` for all the `InstanceHashField`.
+        Only plain calls to the setter (`set`, `hset`) are buffered. Any other
+        command on a field having a buffered value (including the getter) first
+        writes all the buffered values. Lock-free fields are not buffered.
+        Nothing is written if an exception is raised in the block.
+
+        >>> with instance.batch():
+        ...     instance.name.hset('foo')
+        ...     instance.status.set('bar')
+        """
+        if self._batch is not None:
+            # already in a batch, the values will be written by it
+            yield self
+            return
+
+        self._batch = {}
+        try:
+            yield self
+            self._flush_batch()
+        finally:
+            self._batch = None
+
+    def _flush_batch(self):
+        """
+        Write the values buffered by `batch`, and update the indexes.
+        """
+        values, self._batch = self._batch, {}
+        if not values:
+            return
+
+        if self._pk and not self.connected:
+            self.connect()
+
+        fields = [self.get_field(field_name) for field_name in values]
+        indexed = [field for field in fields if field.indexable and not field.deferred_indexing]
+        deferred = [(self.pk.get(), field.name) for field in fields if field.deferred_indexing]
+
+        locks = []
+        try:
+            # lock indexed fields to avoid their values (and indexes) to be updated in the meantime
+            for field in indexed:
+                lock = FieldLock(field)
+                lock.acquire()
+                locks.append(lock)
+
+            # read all the current values to deindex at once
+            currents = []
+            if indexed:
+                with self.connection.pipeline(transaction=False) as pipeline:
+                    for field in indexed:
+                        field._bulk_get(pipeline)
+                    currents = pipeline.execute()
+
+            try:
+                # update the indexes and write the values in the same pipeline
+                with self.database.index_pipeline():
+                    for field, current in zip(indexed, currents):
+                        value = values[field.name]
+                        if normalize(current) != normalize(value):
+                            if current is not None:
+                                field.deindex(current)
+                            if value is not None:
+                                field.index(value)
+
+                    pipeline = self.database.index_write_connection
+                    hash_values = {}
+                    for field in fields:
+                        if isinstance(field, InstanceHashField):
+                            hash_values[field.name] = field.from_python(values[field.name])
+                        else:
+                            field._bulk_set(pipeline, values[field.name])
+                    if hash_values:
+                        pipeline.hmset(self.key, hash_values)
+            except:
+                # We revert indexes previously set if we have an exception, then
+                # really raise the error
+                if self.connected:
+                    for field in indexed:
+                        field._rollback_indexes()
+                raise
+            finally:
+                for field in indexed:
+                    field._reset_indexes_rollback_caches(self.pk.get())
+
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+            identity_map = self.database.current_identity_map
+            if identity_map is not None:
+                for field in fields:
+                    identity_map.invalidate(field.key)
+
+        if deferred:
+            self._defer_indexing(deferred)
+
+    def _discard_prefetched(self, field_names):
+        """
+        Forget the prefetched values of the given InstanceHashField, as they
+        will be updated.
+        """
+        if self._prefetched:
+            for field_name in field_names:
+                self._prefetched.pop(field_name, None)
+
     def hdel(self, *args):
         """
         This command on the model allow deleting many instancehash fields with
@@ -591,14 +1340,26 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         if args and not any(arg in self._instancehash_fields for arg in args):
             raise ValueError("Only InstanceHashField can be used here.")
 
-        # Set indexes for indexable fields.
-        for field_name in args:
-            field = self.get_field(field_name)
-            if field.indexable:
-                field.deindex()
+        self._discard_prefetched(args)
+
+        deferred = []
+
+        # Set indexes for indexable fields, sending all index writes at once.
+        with self.database.index_pipeline():
+            for field_name in args:
+                field = self.get_field(field_name)
+                if field.deferred_indexing:
+                    deferred.append((self._pk, field.name))
+                elif field.indexable:
+                    field.deindex()
 
         # Return the number of fields really deleted
-        return self._call_command('hdel', *args)
+        result = self._call_command('hdel', *args)
+
+        if deferred:
+            self._defer_indexing(deferred)
+
+        return result
 
     def delete(self):
         """
@@ -611,14 +1372,242 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
                 field.delete()
         # Remove the pk from the model collection
         self.connection.srem(self.get_field('pk').collection_key, self._pk)
+        # Remove the instance from the identity map
+        identity_map = self.database.current_identity_map
+        if identity_map is not None:
+            identity_map.discard_instance(self.__class__, self._pk)
         # Deactivate the instance
         delattr(self, "_pk")
 
+    @classmethod
+    def _index_versions_key(cls):
+        """
+        Return the key of the hash holding, when `cache_collections` is True, a
+        version for each index key, incremented at each write in this key (and,
+        for the empty entry, when an index is cleared), used to invalidate the
+        cached collections.
+        """
+        return make_key(cls._name, 'index-versions')
+
+    @classmethod
+    def _deferred_indexing_keys(cls):
+        """
+        Return the keys used for the deferred indexing: the list of events, and
+        the counter of events not yet fully processed.
+        """
+        queue_key = make_key(cls._name, 'deferred-indexing')
+        return queue_key, make_key(queue_key, 'pending')
+
+    @classmethod
+    def _deferred_indexing_in_flight_key(cls):
+        """
+        Return the key of the sorted set of the "in-flight" lists of the
+        deferred indexing, with, as score, the time (in milliseconds) after
+        which the events of a list are put back in the queue.
+        """
+        return make_key(cls._deferred_indexing_keys()[0], 'in-flight')
+
+    @classmethod
+    def _deferred_indexed_key(cls, field_name):
+        """
+        Return the key of the hash storing, for each pk, the values of the given
+        field actually in the indexes, when its indexing is deferred.
+        """
+        return make_key(cls._name, field_name, 'deferred-indexed')
+
+    @classmethod
+    def _defer_indexing(cls, entries):
+        """
+        Add one event in the deferred indexing queue for each (pk, field name)
+        couple in `entries`, in one call to redis.
+        """
+        queue_key, pending_key = cls._deferred_indexing_keys()
+        with cls.get_connection().pipeline(transaction=True) as pipeline:
+            pipeline.rpush(queue_key, *[json.dumps([pk, field_name]) for pk, field_name in entries])
+            pipeline.incrby(pending_key, len(entries))
+            pipeline.execute()
+
+    # lua function to put back the events of the in-flight list `key` at the head of
+    # the queue, in the same order
+    deferred_indexing_requeue_lua = """
+            local function requeue(queue_key, key)
+                local events = redis.call('lrange', key, 0, -1)
+                -- by blocks, to not pass too many arguments to unpack
+                for stop = #events, 1, -1000 do
+                    local block = {}
+                    for i = stop, math.max(stop - 999, 1), -1 do
+                        block[#block + 1] = events[i]
+                    end
+                    redis.call('lpush', queue_key, unpack(block))
+                end
+                redis.call('del', key)
+            end
+    """
+
+    deferred_indexing_take_script = {
+        # KEYS[1] is the queue, KEYS[2] a new "in-flight" list, and KEYS[3] the sorted
+        # set of the in-flight lists. First put back in the queue the events of the
+        # in-flight lists that expired (their worker was stopped or is too slow), then
+        # move at most ARGV[1] events from the head of the queue to the new in-flight
+        # list, expiring in ARGV[2] milliseconds, and return them
+        'lua': """
+            if redis.replicate_commands then
+                redis.replicate_commands()
+            end
+            local queue_key, in_flight_key, in_flight_lists_key = KEYS[1], KEYS[2], KEYS[3]
+        """ + deferred_indexing_requeue_lua + """
+            local now = redis.call('time')
+            now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+            for _, key in ipairs(redis.call('zrangebyscore', in_flight_lists_key, '-inf', now)) do
+                requeue(queue_key, key)
+                redis.call('zrem', in_flight_lists_key, key)
+            end
+            local events = redis.call('lrange', queue_key, 0, tonumber(ARGV[1]) - 1)
+            if events[1] == nil then
+                return events
+            end
+            redis.call('ltrim', queue_key, #events, -1)
+            -- by blocks, to not pass too many arguments to unpack
+            for start = 1, #events, 1000 do
+                redis.call('rpush', in_flight_key, unpack(events, start, math.min(start + 999, #events)))
+            end
+            redis.call('zadd', in_flight_lists_key, now + tonumber(ARGV[2]), in_flight_key)
+            return events
+        """
+    }
+
+    deferred_indexing_done_script = {
+        # KEYS[1] is the queue, KEYS[2] the "in-flight" list, KEYS[3] the sorted set of
+        # the in-flight lists and KEYS[4] the counter of pending events. If ARGV[1] is
+        # "1", the events were processed: drop them and decrement the counter, else put
+        # them back in the queue. Nothing is done if the in-flight list expired (the
+        # events were already put back in the queue), and 0 is returned
+        'lua': """
+            local queue_key, in_flight_key, in_flight_lists_key, pending_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+        """ + deferred_indexing_requeue_lua + """
+            if redis.call('zrem', in_flight_lists_key, in_flight_key) == 0 then
+                return 0
+            end
+            if ARGV[1] == '1' then
+                redis.call('decrby', pending_key, redis.call('llen', in_flight_key))
+                redis.call('del', in_flight_key)
+            else
+                requeue(queue_key, in_flight_key)
+            end
+            return 1
+        """
+    }
+
+    @classmethod
+    def process_deferred_indexing(cls, batch_size=1000, timeout=300):
+        """
+        Take at most `batch_size` events from the deferred indexing queue and
+        update the indexes accordingly, sending all the index writes at once.
+        For each pk/field, the values actually indexed are stored in redis, to
+        know what to deindex: the values currently in the field are indexed,
+        the ones not here anymore (or all if the instance was deleted) are
+        deindexed. So many events for the same pk/field are processed once.
+        The events are atomically moved to an "in-flight" list while they are
+        processed, and are only dropped (and the counter of pending events
+        decremented) once processed. If an error occurs, they are put back at
+        the head of the queue before the error is raised. If they are not
+        processed after `timeout` seconds (for example if the worker was
+        killed), they are put back at the head of the queue by the next call.
+        Return the number of events processed.
+        """
+        queue_key, pending_key = cls._deferred_indexing_keys()
+        in_flight_lists_key = cls._deferred_indexing_in_flight_key()
+        in_flight_key = unique_key(prefix=in_flight_lists_key)
+        keys = [queue_key, in_flight_key, in_flight_lists_key, pending_key]
+
+        events = cls.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=RedisModel.deferred_indexing_take_script,
+            keys=keys[:3],
+            args=[batch_size, int(timeout * 1000)],
+        )
+        if not events:
+            return 0
+
+        try:
+            cls._process_deferred_indexing_events(events)
+        except:
+            cls.database.call_script(RedisModel.deferred_indexing_done_script, keys=keys, args=[0])
+            raise
+
+        cls.database.call_script(RedisModel.deferred_indexing_done_script, keys=keys, args=[1])
+        return len(events)
+
+    @classmethod
+    def _process_deferred_indexing_events(cls, events):
+        """
+        Update the indexes for the given events taken from the deferred
+        indexing queue. See `process_deferred_indexing`.
+        The existence of the instances, the values actually indexed and the
+        current values of the fields are read in one pipeline.
+        """
+        connection = cls.get_connection()
+        pk_field = cls.get_field('pk')
+
+        entries = []
+        for event in events:
+            pk, field_name = json.loads(event)
+            if (pk, field_name) not in entries:
+                entries.append((pk, field_name))
+
+        with connection.pipeline(transaction=False) as pipeline:
+            for pk, field_name in entries:
+                pipeline.sismember(pk_field.collection_key, pk)
+                pipeline.hget(cls._deferred_indexed_key(field_name), pk)
+                cls.get_field(field_name).get_for_instance(pk)._bulk_get(pipeline)
+            results = iter(pipeline.execute())
+
+        try:
+            with cls.database.index_pipeline():
+                for pk, field_name in entries:
+                    exists, indexed, value = next(results), next(results), next(results)
+                    field = cls.get_field(field_name)
+                    old_values = set(tuple(parts) for parts in json.loads(indexed or '[]'))
+                    new_values = set()
+                    if exists:
+                        new_values = set(tuple(parts) for parts in field._prepare_bulk_index_data(pk, value)
+                                         if parts[-1] is not None)
+                    field._remove_from_indexes(field._indexes, pk, old_values - new_values)
+                    field._add_to_indexes(field._indexes, pk, new_values - old_values, False)
+                    write_connection = cls.database.index_write_connection
+                    if new_values:
+                        write_connection.hset(cls._deferred_indexed_key(field_name), pk,
+                                              json.dumps(sorted(new_values)))
+                    else:
+                        write_connection.hdel(cls._deferred_indexed_key(field_name), pk)
+        finally:
+            for pk, field_name in entries:
+                cls.get_field(field_name)._reset_indexes_rollback_caches(pk)
+
+    @classmethod
+    def wait_for_deferred_indexing(cls, timeout=None, interval=0.05):
+        """
+        Wait until all the events of the deferred indexing queue are processed,
+        checking every `interval` seconds, for at most `timeout` seconds if
+        given. Return True if the queue is drained, False if the timeout is
+        reached. Useful to read its own writes, in tests or batch jobs.
+        """
+        __, pending_key = cls._deferred_indexing_keys()
+        connection = cls.get_connection()
+        start = time.time()
+        while int(connection.get(pending_key) or 0) > 0:
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            time.sleep(interval)
+        return True
+
     @classmethod
     def _thread_lock_storage(cls):
         """
-        We mark each locked field in a thread, to allow other operations in the
-        same thread on the same field (for the same instance or others). This
+        We mark each acquired lock (by its name) in a thread, to allow other
+        operations in the same thread using the same lock (on the same field for
+        the same instance or others, depending on the scope of the lock). This
         way, operations within the lock, in the same thread, can bypass it (the
         whole set of operations must be locked)
         """
@@ -629,17 +1618,17 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         return threadlocal.limpyd_locked_fields[cls._name]
 
     @classmethod
-    def _mark_field_as_locked(cls, field):
-        cls._thread_lock_storage().add(field.name)
+    def _mark_lock_as_acquired(cls, name):
+        cls._thread_lock_storage().add(name)
 
     @classmethod
-    def _unmark_field_as_locked(cls, field):
-        if field.name in cls._thread_lock_storage():
-            cls._thread_lock_storage().remove(field.name)
+    def _unmark_lock_as_acquired(cls, name):
+        if name in cls._thread_lock_storage():
+            cls._thread_lock_storage().remove(name)
 
     @classmethod
-    def _is_field_locked(cls, field):
-        return field.name in cls._thread_lock_storage()
+    def _is_lock_acquired(cls, name):
+        return name in cls._thread_lock_storage()
 
     def scan_keys(self, count=None):
         """Iter on all the key related to the current instance fields, using redis SCAN command
@@ -26,13 +26,21 @@ def make_key(*args):
     return u":".join(str(arg) for arg in args)
 
 
-def unique_key(connection, prefix=None):
-    """Generate a unique key that does not exists is the connection key space.
+# time to live, in seconds, set on temporary keys when they are created, so
+# they don't stay forever in redis if the process is killed before deleting them
+TMP_KEY_TTL = 300
+
+
+def unique_key(connection=None, prefix=None):
+    """Generate a unique key, without any call to redis.
+
+    The key is made of 128 random bits, so there is no need to check that it
+    does not already exist in the key space.
 
     Parameters
     ----------
-    connection : Redis
-        The redis connection on which to ensure the key does not exist
+    connection : Optional[Redis]
+        Not used anymore, kept for compatibility
     prefix : Optional[str]
         If set, the key will be prefixed with this prefix (separated from the generated part with
         a `:`
@@ -40,15 +48,12 @@ def unique_key(connection, prefix=None):
     Returns
     -------
     str
-        A key that is, at the moment, guaranteed not to exist
+        A key that is guaranteed, for all practical purposes, not to exist
 
     """
-    while 1:
-        key = str(uuid.uuid4().hex)
-        if prefix:
-            key = make_key(prefix, key)
-        if not connection.exists(key):
-            break
+    key = str(uuid.uuid4().hex)
+    if prefix:
+        key = make_key(prefix, key)
     return key
 
 
@@ -50,6 +50,26 @@ class LimpydBaseTest(unittest.TestCase):
         """
         return self.connection.dbsize()
 
+    def get_round_trips(self, func):
+        """
+        Helper method to return the names of the commands sent directly by the
+        connection while calling `func`, ie not in a pipeline
+        """
+        connection = self.connection
+        commands = []
+        original = connection.execute_command
+
+        def execute_command(*args, **kwargs):
+            commands.append(args[0])
+            return original(*args, **kwargs)
+
+        connection.execute_command = execute_command
+        try:
+            func()
+        finally:
+            del connection.execute_command
+        return commands
+
     def assertNumCommands(self, num=None, func=None, *args, **kwargs):
         """
         A context assert, to use with "with":
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from sys import version_info
+import time
 import unittest
 
 from redis.exceptions import ResponseError
@@ -10,6 +11,7 @@ from redis.exceptions import ResponseError
 from limpyd import fields
 from limpyd.collection import CollectionManager, CollectionResults
 from limpyd.exceptions import *
+from limpyd.indexes import EqualIndex, NumberRangeIndex, TextRangeIndex
 
 from .base import LimpydBaseTest, TEST_CONNECTION_SETTINGS
 from .model import Boat, Bike, Email, TestRedisModel
@@ -492,8 +494,8 @@ class InstancesTest(CollectionBaseTest):
     def test_lazy_should_not_test_pk_existence(self):
         # allow a scard (call to __len__) to be included in the commands
 
-        with self.assertNumCommands(min_num=5, max_num=6):
-            # 1 command for the collection, one to test each PKs (4 objects)
+        with self.assertNumCommands(min_num=2, max_num=3):
+            # 1 command for the collection, one to test all the PKs at once (4 objects)
             list(Boat.collection().instances())
         with self.assertNumCommands(min_num=1, max_num=2):
             # 1 command for the collection, none to test PKs
@@ -507,6 +509,15 @@ class InstancesTest(CollectionBaseTest):
         # all entries with lazy
         self.assertEqual(len(list(Boat.collection(name='Pen Duick I').instances(lazy=True))), 2)
 
+    def test_pks_existence_should_be_checked_by_chunks(self):
+        collection = Boat.collection().instances()
+        collection.INSTANCES_CHUNK_SIZE = 3
+        with self.assertNumCommands(min_num=3, max_num=4):
+            # 1 command for the collection, one for each chunk of PKs (4 objects)
+            boats = list(collection)
+        self.assertEqual(len(boats), 4)
+        self.assertTrue(all(boat.connected for boat in boats))
+
     def test_instances_should_work_if_filtering_on_only_a_pk(self):
         boats = list(Boat.collection(pk=1).instances())
         self.assertEqual(len(boats), 1)
@@ -561,8 +572,8 @@ class LenTest(CollectionBaseTest):
             collection = Boat.collection(power="sail", launched=1898).sort(by='launched')
 
         with self.assertNumCommands(4):
-            # EXISTS tmp_key
             # SINTERSTORE tmp_key index_key1 index_key2
+            # EXPIRE tmp_key (at creation)
             # SCARD tmp_key
             # EXPIRE tmp_key
             self.assertEqual(len(collection), 1)
@@ -598,8 +609,8 @@ class LenTest(CollectionBaseTest):
         if is_pypy:
             with self.assertNumCommands(7):
                 # PyPy always starts by a __len__
-                #   EXISTS tmp_key
                 #   SINTERSTORE tmp_key index_key1 index_key2
+                #   EXPIRE tmp_key (at creation)
                 #   SCARD tmp_key
                 #   EXPIRE tmp_key
                 # Then will retrieve the collection
@@ -610,8 +621,8 @@ class LenTest(CollectionBaseTest):
                 self.assertSetEqual(set(collection), {'1'})
         else:
             with self.assertNumCommands(4):
-                # EXISTS tmp_key
                 # SINTERSTORE tmp_key index_key1 index_key2
+                # EXPIRE tmp_key (at creation)
                 # SORT tmp_key
                 # DEL tmp_key
                 self.assertSetEqual(set(collection), {'1'})
@@ -643,5 +654,510 @@ class LenTest(CollectionBaseTest):
             self.assertEqual(len(list(collection)), 3)
 
 
+class IteratorTest(CollectionBaseTest):
+
+    def test_iterator_should_return_all_results(self):
+        self.assertEqual(set(Boat.collection().iterator()),
+                         {self.boat1._pk, self.boat2._pk, self.boat3._pk, self.boat4._pk})
+        self.assertEqual(set(Boat.collection(power='sail').iterator(chunk_size=1)),
+                         {self.boat1._pk, self.boat2._pk, self.boat3._pk})
+        self.assertEqual(set(Boat.collection(power='sail', launched=1966).iterator()), {self.boat3._pk})
+        self.assertEqual(list(Boat.collection(pk=self.boat2._pk).iterator()), [self.boat2._pk])
+        self.assertEqual(list(Boat.collection(pk=self.boat4._pk, power='sail').iterator()), [])
+        self.assertEqual(list(Boat.collection(pk=100).iterator()), [])
+
+    def test_iterator_should_return_instances(self):
+        instances = list(Boat.collection(power='sail').instances().iterator())
+        self.assertEqual(len(instances), 3)
+        self.assertIsInstance(instances[0], Boat)
+        self.assertEqual({instance.name.get() for instance in instances},
+                         {'Pen Duick I', 'Pen Duick II', 'Pen Duick III'})
+
+        # a pk in the index but not in the collection is ignored if not lazy
+        self.connection.srem(Boat.get_field('pk').collection_key, self.boat1._pk)
+        self.assertEqual({instance._pk for instance in Boat.collection(power='sail').instances().iterator()},
+                         {self.boat2._pk, self.boat3._pk})
+        self.assertEqual(len(list(Boat.collection(power='sail').instances(lazy=True).iterator())), 3)
+
+    def test_iterator_should_be_lazy(self):
+        with self.assertNumCommands(0):
+            iterator = Boat.collection(power='sail', launched=1966).iterator()
+        self.assertEqual(next(iterator), self.boat3._pk)
+
+    def test_temporary_final_set_should_be_deleted(self):
+        iterator = Boat.collection(power='sail', launched__in=[1898, 1964]).iterator(chunk_size=1)
+        next(iterator)
+        # the final set and the `in` union are kept while iterating
+        self.assertEqual(len(self.connection.keys('*__collection__*')), 1)
+        list(iterator)
+        self.assertEqual(self.connection.keys('*__collection__*'), [])
+
+    def test_iterator_should_not_be_used_on_sorted_or_sliced_collections(self):
+        with self.assertRaises(ImplementationError):
+            Boat.collection().sort(by='name', alpha=True).iterator()
+        collection = Boat.collection()
+        collection[:2]
+        with self.assertRaises(ImplementationError):
+            collection.iterator()
+
+
+class Yacht(TestRedisModel):
+    name = fields.InstanceHashField(indexable=True, indexes=[TextRangeIndex])
+    power = fields.InstanceHashField(indexable=True, default="sail")
+    length = fields.InstanceHashField(indexable=True, indexes=[EqualIndex, NumberRangeIndex])
+
+
+class SingleCallTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(SingleCallTest, self).setUp()
+        for i in range(10):
+            Yacht(name='yacht%d' % i, power=['sail', 'engine'][i % 2], length=10 + i)
+
+    def assertSameResults(self, **filters):
+        normal = Yacht.collection(**filters)
+        single = Yacht.collection(**filters).single_call()
+        self.assertEqual(set(single), set(normal))
+        self.assertEqual(len(single), len(normal))
+        self.assertEqual(list(single.sort(by='-length')[1:3]), list(normal.sort(by='-length')[1:3]))
+        self.assertEqual(list(single.sort(by='name', alpha=True)[-2:]),
+                         list(normal.sort(by='name', alpha=True)[-2:]))
+        self.assertEqual([yacht.pk.get() for yacht in single.sort(by='length').instances()],
+                         [yacht.pk.get() for yacht in normal.sort(by='length').instances()])
+
+    def test_results_should_be_the_same_as_without_single_call(self):
+        self.assertSameResults()
+        self.assertSameResults(power='engine')
+        self.assertSameResults(power='sail', length__gte=13)
+        self.assertSameResults(length=14)
+        self.assertSameResults(length__in=[11, 12, 100], power='engine')
+        self.assertSameResults(name__startswith='yacht')
+        self.assertSameResults(name__gt='yacht3', name__lt='yacht8')
+        self.assertSameResults(name__in=['yacht1', 'yacht2', 'foo'])
+        self.assertSameResults(pk=3, power='sail')
+        self.assertSameResults(pk=4, power='sail')
+
+    def test_collection_should_be_computed_in_one_call(self):
+        collection = Yacht.collection(power='sail', length__gt=11, name__gte='yacht').single_call()
+        collection = collection.sort(by='-length').instances()
+        commands = self.get_round_trips(lambda: self.assertEqual(
+            [yacht.pk.get() for yacht in collection[:2]], ['9', '7']))
+        self.assertEqual(len(commands), 1)
+        self.assertIn(commands[0], ('EVALSHA', 'EVAL'))
+
+        commands = self.get_round_trips(lambda: self.assertEqual(
+            len(Yacht.collection(power='sail', length__gt=11).single_call()), 4))
+        self.assertEqual(len(commands), 1)
+
+        # no temporary keys left
+        self.assertEqual(self.connection.keys('*__collection__*'), [])
+
+    def test_non_existing_pks_should_be_ignored(self):
+        self.assertEqual(list(Yacht.collection(pk=100, power='sail').single_call()), [])
+        self.assertEqual(list(Yacht.collection(pk=[1, 2]).single_call()), [])
+        # pk in the index but not in the collection
+        self.connection.srem(Yacht.get_field('pk').collection_key, 1)
+        self.assertEqual(set(Yacht.collection(power='engine').single_call().instances()),
+                         set(Yacht.collection(power='engine').instances()))
+
+    def test_empty_in_filter_should_return_nothing(self):
+        self.assertEqual(list(Yacht.collection(length__in=[]).single_call()), [])
+
+    def test_default_should_be_defined_by_the_manager(self):
+        class SingleCallCollectionManager(CollectionManager):
+            SINGLE_CALL = True
+
+        collection = Yacht.collection(manager=SingleCallCollectionManager, power='sail', length__gte=12)
+        self.assertEqual(len(self.get_round_trips(lambda: list(collection))), 1)
+        collection = collection.single_call(False)
+        self.assertGreater(len(self.get_round_trips(lambda: list(collection))), 1)
+
+
+class KeysetPaginationTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(KeysetPaginationTest, self).setUp()
+        # lengths: 10, 11, 11, 12, 12, ... to have ties
+        self.yachts = [Yacht(name='yacht%d' % i, power=['sail', 'engine'][i % 2], length=10 + (i + 1) // 2)
+                       for i in range(10)]
+
+    def paginate(self, collection, size):
+        pages = [list(collection.limit(size))]
+        while len(pages[-1]) == size:
+            pages.append(list(collection.after(pages[-1][-1]).limit(size)))
+        return pages
+
+    def test_number_range_index(self):
+        expected = list(Yacht.collection().sort(by='length'))
+        pages = self.paginate(Yacht.collection().sort(by='length'), 3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_number_range_index_desc(self):
+        expected = list(Yacht.collection().sort(by='-length'))
+        pages = self.paginate(Yacht.collection().sort(by='-length'), 4)
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_text_range_index(self):
+        expected = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']
+        self.assertEqual(sum(self.paginate(Yacht.collection().sort(by='name', alpha=True), 3), []), expected)
+        self.assertEqual(sum(self.paginate(Yacht.collection().sort(by='-name', alpha=True), 3), []),
+                         expected[::-1])
+
+    def test_text_range_index_follows_the_order_of_its_members(self):
+        Yacht(name='yacht1x')
+        Yacht(name='yacht10')
+        # "yacht10:..." is before "yacht1:..." in the index, but after "yacht1" with SORT ALPHA
+        self.assertEqual(list(Yacht.collection(name__startswith='yacht1').sort(by='name', alpha=True)),
+                         ['2', '12', '11'])
+        self.assertEqual(sum(self.paginate(Yacht.collection().sort(by='name', alpha=True), 3), [])[:4],
+                         ['1', '12', '2', '11'])
+
+    def test_filters_are_applied(self):
+        collection = Yacht.collection(power='engine').sort(by='length')
+        self.assertEqual(sum(self.paginate(collection, 2), []), list(collection))
+        self.assertEqual(list(collection.after('4').limit(2)), ['6', '8'])
+
+    def test_filters_are_applied_on_text_index_in_many_calls(self):
+        collection = Yacht.collection(power='engine').sort(by='name', alpha=True)
+        collection.KEYSET_SCAN_SIZE = 2
+        self.assertEqual(sum(self.paginate(collection, 2), []), ['2', '4', '6', '8', '10'])
+        self.assertEqual(list(collection.after('4').limit(3)), ['6', '8', '10'])
+        self.assertEqual(self.connection.keys('*keyset*'), [])
+
+    def test_cursor_as_tuple_for_updated_or_deleted_instance(self):
+        collection = Yacht.collection().sort(by='length')
+        page = list(collection.limit(3))
+        self.assertEqual(page, ['1', '2', '3'])
+        self.yachts[2].delete()
+        self.assertEqual(list(collection.after((11, '3')).limit(3)), ['4', '5', '6'])
+        with self.assertRaises(ValueError):
+            list(collection.after('3'))
+        self.assertEqual(list(Yacht.collection().sort(by='name', alpha=True).after(('yacht2', '3'))),
+                         ['4', '5', '6', '7', '8', '9', '10'])
+
+    def test_instances_and_len(self):
+        collection = Yacht.collection().sort(by='length').instances().after('8')
+        self.assertEqual([yacht.pk.get() for yacht in collection], ['9', '10'])
+        self.assertEqual(len(collection), 2)
+        self.assertEqual(collection[1].pk.get(), '10')
+
+    def test_needs_a_sort_on_a_range_index(self):
+        with self.assertRaises(ImplementationError):
+            list(Yacht.collection().limit(2))
+        with self.assertRaises(ImplementationError):
+            list(Yacht.collection().sort(by='power', alpha=True).limit(2))
+        with self.assertRaises(ImplementationError):
+            list(Yacht.collection(pk=1).sort(by='length').limit(2))
+
+
+class Liner(TestRedisModel):
+    kind = fields.InstanceHashField(indexable=True)
+    launched = fields.InstanceHashField(indexable=True, indexes=[NumberRangeIndex.configure(sortable=True)])
+    tonnage = fields.InstanceHashField(indexable=True, indexes=[NumberRangeIndex])
+
+
+class SortedIndexTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(SortedIndexTest, self).setUp()
+        for i, launched in enumerate([1911, 1936, 1969, 1907, 2003, 1912, 1959, 1938]):
+            Liner(kind=['cruise', 'ocean'][i % 2], launched=launched, tonnage=1000 * (8 - i))
+
+    def count_sort_commands(self, func):
+        def get_count():
+            return self.connection.info('commandstats').get('cmdstat_sort', {}).get('calls', 0)
+        count = get_count()
+        func()
+        return get_count() - count
+
+    def test_sortable_index_is_used_to_sort(self):
+        expected = ['4', '1', '6', '2', '8', '7', '3', '5']
+        collection = Liner.collection().sort(by='launched')
+        self.assertEqual(self.count_sort_commands(lambda: self.assertEqual(list(collection), expected)), 0)
+        self.assertEqual(list(Liner.collection().sort(by='-launched')), expected[::-1])
+        self.assertEqual(list(collection[2:5]), expected[2:5])
+        self.assertEqual(list(collection[-3:]), expected[-3:])
+        self.assertEqual(collection[1], '1')
+        self.assertEqual(list(collection[3:3]), [])
+        self.assertEqual(list(Liner.collection().sort(by='-launched')[1:3]), expected[::-1][1:3])
+
+    def test_sortable_index_is_used_with_filters(self):
+        collection = Liner.collection(kind='ocean').sort(by='launched')
+        self.assertEqual(self.count_sort_commands(lambda: self.assertEqual(list(collection), ['4', '6', '2', '8'])), 0)
+        self.assertEqual(list(collection.sort(by='-launched')[:2]), ['8', '2'])
+        self.assertEqual(list(Liner.collection(kind='cruise', launched__gt=1910).sort(by='launched')), ['1', '7', '3', '5'])
+        self.assertEqual(self.connection.keys('*__collection__*'), [])
+
+    def test_sort_command_is_used_without_sortable_index(self):
+        collection = Liner.collection().sort(by='tonnage')
+        self.assertEqual(self.count_sort_commands(lambda: list(collection)), 1)
+        self.assertEqual(list(collection), ['8', '7', '6', '5', '4', '3', '2', '1'])
+
+
+class Schooner(TestRedisModel):
+    cache_collections = True
+    kind = fields.InstanceHashField(indexable=True)
+    masts = fields.InstanceHashField(indexable=True, lockfree=True)
+    length = fields.InstanceHashField(indexable=True, indexes=[NumberRangeIndex])
+
+
+class CacheTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        self.schooners = [Schooner(kind=['gaff', 'staysail'][i % 2], masts=2 + i % 3, length=20 + i)
+                          for i in range(10)]
+
+    def count_computations(self, func):
+        def get_count():
+            stats = self.connection.info('commandstats')
+            return sum(stats.get('cmdstat_%s' % command, {}).get('calls', 0)
+                       for command in ('sinterstore', 'evalsha'))
+        count = get_count()
+        func()
+        return get_count() - count
+
+    def test_cached_final_set_is_reused(self):
+        collection = Schooner.collection(kind='gaff', length__gte=24).cache()
+        self.assertEqual(set(collection), {'5', '7', '9'})
+        # one evalsha to get the cache key, nothing to compute
+        self.assertEqual(self.count_computations(lambda: self.assertEqual(
+            set(Schooner.collection(length__gte=24, kind='gaff').cache()), {'5', '7', '9'})), 1)
+        self.assertEqual(len(Schooner.collection(kind='gaff', length__gte=24).cache()), 3)
+        self.assertEqual(list(Schooner.collection(kind='gaff', length__gte=24).cache().sort(by='-length')[:2]),
+                         ['9', '7'])
+        # not cached if not asked
+        self.assertEqual(self.count_computations(lambda: set(Schooner.collection(kind='gaff', length__gte=24))), 2)
+
+    def test_write_in_read_index_keys_invalidates_the_cache(self):
+        def collection():
+            return Schooner.collection(kind='gaff', length__gte=24).cache()
+        self.assertEqual(set(collection()), {'5', '7', '9'})
+        self.schooners[0].length.hset(30)
+        self.assertEqual(set(collection()), {'1', '5', '7', '9'})
+        self.schooners[8].kind.hset('staysail')
+        self.assertEqual(set(collection()), {'1', '5', '7'})
+        self.schooners[6].delete()
+        self.assertEqual(set(collection()), {'1', '5'})
+        # a write in an index not read by the filters doesn't invalidate the cache
+        self.schooners[0].masts.hset(4)
+        self.assertEqual(self.count_computations(lambda: self.assertEqual(set(collection()), {'1', '5'})), 1)
+        # but a write in another key of a read index does
+        self.schooners[0].kind.hset('bermuda')
+        self.assertEqual(set(collection()), {'5'})
+
+    def test_versions_are_kept_by_index(self):
+        for i, schooner in enumerate(self.schooners):
+            schooner.kind.hset('kind-%s' % i)
+            schooner.masts.hset(10 + i)
+        # one entry for each index, not for each value
+        self.assertEqual(self.connection.hlen(Schooner._index_versions_key()), 3)
+
+    def test_lockfree_writes_invalidate_the_cache(self):
+        def collection():
+            return Schooner.collection(kind='gaff', masts=2).cache()
+        self.assertEqual(set(collection()), {'1', '7'})
+        self.schooners[2].masts.hset(2)
+        self.assertEqual(set(collection()), {'1', '3', '7'})
+        self.schooners[6].masts.hdel()
+        self.assertEqual(set(collection()), {'1', '3'})
+
+    def test_cached_empty_result(self):
+        def collection():
+            return Schooner.collection(kind='gaff', length__gt=100).cache()
+        self.assertEqual(set(collection()), set())
+        self.assertEqual(self.count_computations(lambda: self.assertEqual(set(collection()), set())), 1)
+        self.schooners[0].length.hset(101)
+        self.assertEqual(set(collection()), {'1'})
+
+    def test_cache_needs_cache_collections_on_the_model(self):
+        with self.assertRaises(ImplementationError):
+            Yacht.collection(power='sail').cache()
+        self.assertEqual(set(Yacht.collection().cache(False)), set())
+
+
+class Barge(TestRedisModel):
+    kind = fields.InstanceHashField(indexable=True)
+
+    @classmethod
+    def get_hash_key(cls, pk):
+        return cls.make_key(cls._name, pk, 'values')
+
+
+class PrefetchTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        for i in range(5):
+            Liner(kind=['steamer', 'sailer'][i % 2], launched=1900 + i, tonnage=1000 * i)
+
+    def test_values_are_read_with_the_instances(self):
+        collection = Liner.collection(kind='steamer').instances().prefetch('launched', 'tonnage')
+        # the collection, the existence of the instances, then one HMGET by
+        # instance, all in one pipeline
+        with self.assertNumCommands(1 + 1 + 3):
+            liners = list(collection)
+        with self.assertNumCommands(0):
+            self.assertEqual(sorted((liner.launched.hget(), liner.tonnage.hget()) for liner in liners),
+                             [('1900', '0'), ('1902', '2000'), ('1904', '4000')])
+        # not prefetched
+        with self.assertNumCommands(1):
+            self.assertEqual(liners[0].kind.hget(), 'steamer')
+
+    def test_all_instancehash_fields_are_prefetched_by_default(self):
+        liners = list(Liner.collection(pk=2).instances(lazy=True).prefetch())
+        with self.assertNumCommands(0):
+            self.assertEqual(liners[0].kind.hget(), 'sailer')
+            self.assertEqual(liners[0].launched.hget(), '1901')
+
+    def test_values_are_prefetched_by_chunks(self):
+        collection = Liner.collection().instances().prefetch('kind')
+        collection.INSTANCES_CHUNK_SIZE = 2
+        with self.assertNumCommands(1 + 3 + 5):
+            liners = list(collection)
+        with self.assertNumCommands(0):
+            self.assertEqual(sorted(liner.kind.hget() for liner in liners), ['sailer'] * 2 + ['steamer'] * 3)
+        liners = list(collection.iterator(chunk_size=2))
+        with self.assertNumCommands(0):
+            self.assertEqual(sorted(liner.kind.hget() for liner in liners), ['sailer'] * 2 + ['steamer'] * 3)
+
+    def test_writes_discard_the_prefetched_value(self):
+        liner = Liner.collection(pk=1).instances().prefetch()[0]
+        liner.tonnage.hset(500)
+        self.assertEqual(liner.tonnage.hget(), '500')
+        liner.hmset(launched=1850)
+        self.assertEqual(liner.launched.hget(), '1850')
+        with self.assertNumCommands(0):
+            self.assertEqual(liner.kind.hget(), 'steamer')
+
+    def test_only_instancehash_fields_can_be_prefetched(self):
+        with self.assertRaises(ValueError):
+            Liner.collection().instances().prefetch('pk')
+
+    def test_hash_key_is_the_one_of_the_model(self):
+        barge = Barge(kind='river')
+        self.assertEqual(barge.key, 'tests:barge:1:values')
+        barges = list(Barge.collection().instances().prefetch())
+        with self.assertNumCommands(0):
+            self.assertEqual(barges[0].kind.hget(), 'river')
+
+
+class Tanker(TestRedisModel):
+    name = fields.StringField(indexable=True)
+    kind = fields.InstanceHashField(indexable=True)
+    capacity = fields.InstanceHashField()
+    ports = fields.SetField(indexable=True)
+    flag = fields.StringField()
+
+
+class DeleteTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(DeleteTest, self).setUp()
+        for i in range(6):
+            Tanker(name='tanker %d' % i, kind=['oil', 'gas'][i % 2], capacity=i * 100,
+                   ports=['Le Havre', 'Rotterdam' if i % 3 else 'Antwerp'], flag='fr')
+
+    def test_matching_instances_are_deleted(self):
+        self.assertEqual(Tanker.collection(kind='oil').delete(), 3)
+        self.assertEqual(set(Tanker.collection()), {'2', '4', '6'})
+        self.assertEqual(set(Tanker.collection(kind='oil')), set())
+        self.assertEqual(set(Tanker.collection(name='tanker 0')), set())
+        self.assertEqual(set(Tanker.collection(ports='Antwerp')), {'4'})
+        self.assertEqual(set(Tanker.collection(ports='Le Havre')), {'2', '4', '6'})
+        for pk in ('1', '3', '5'):
+            self.assertEqual(self.connection.keys('*:tanker:%s:*' % pk), [])
+        self.assertEqual(Tanker(2).hmget('kind', 'capacity'), ['gas', '100'])
+
+    def test_instances_are_deleted_by_chunks(self):
+        self.assertEqual(Tanker.collection(ports='Le Havre').delete(chunk_size=2), 6)
+        self.assertEqual(set(Tanker.collection()), set())
+        self.assertEqual(self.count_keys(), 1)  # the max pk used
+
+    def test_indexed_fields_are_locked(self):
+        # simulate a lock held by another process on an indexed field
+        self.connection.set(fields.FieldLock.get_lock_name(Tanker.get_field('ports')), 'other', px=300)
+        start = time.time()
+        self.assertEqual(Tanker.collection(kind='oil').delete(), 3)
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+    def test_sorted_collection_cannot_be_deleted(self):
+        with self.assertRaises(ImplementationError):
+            Tanker.collection().sort(by='name').delete()
+        self.assertEqual(Tanker.collection().sort(by='nosort').delete(), 6)
+
+
+class UpdateTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(UpdateTest, self).setUp()
+        for i in range(6):
+            Tanker(name='tanker %d' % i, kind=['oil', 'gas'][i % 2], capacity=i * 100,
+                   ports=['Le Havre'], flag='fr')
+
+    def test_matching_instances_are_updated(self):
+        self.assertEqual(Tanker.collection(kind='oil').update(kind='chemicals', flag='nl', name='x'), 3)
+        self.assertEqual(set(Tanker.collection(kind='oil')), set())
+        self.assertEqual(set(Tanker.collection(kind='chemicals')), {'1', '3', '5'})
+        self.assertEqual(set(Tanker.collection(name='x')), {'1', '3', '5'})
+        self.assertEqual(set(Tanker.collection(name='tanker 0')), set())
+        self.assertEqual(set(Tanker.collection(name='tanker 1')), {'2'})
+        self.assertEqual(Tanker(1).flag.get(), 'nl')
+        self.assertEqual(Tanker(2).flag.get(), 'fr')
+        self.assertEqual(Tanker(1).hmget('kind', 'capacity'), ['chemicals', '0'])
+
+    def test_instances_are_updated_by_chunks(self):
+        self.assertEqual(Tanker.collection(kind='oil').update(chunk_size=2, kind='gas'), 3)
+        self.assertEqual(set(Tanker.collection(kind='gas')), {'1', '2', '3', '4', '5', '6'})
+
+    def test_lua_update_needs_one_call_by_chunk(self):
+        self.assertEqual(Tanker.collection(pk=2).update(lua=True, kind='oil', capacity=1), 1)
+        calls = self.connection.info('commandstats')['cmdstat_evalsha']['calls']
+        self.assertEqual(Tanker.collection(kind='gas').update(lua=True, kind='chemicals'), 2)
+        # the update script, and the release of the lock of the field
+        self.assertEqual(self.connection.info('commandstats')['cmdstat_evalsha']['calls'], calls + 2)
+        self.assertEqual(set(Tanker.collection(kind='oil')), {'1', '2', '3', '5'})
+        self.assertEqual(set(Tanker.collection(kind='chemicals')), {'4', '6'})
+        self.assertEqual(Tanker(2).capacity.hget(), '1')
+        with self.assertRaises(ValueError):
+            Tanker.collection().update(lua=True, name='x')
+
+    def test_non_existing_instances_are_not_updated(self):
+        self.assertEqual(Tanker.collection(pk=10).update(kind='chemicals'), 0)
+        self.assertEqual(Tanker.collection(pk=10).update(lua=True, kind='chemicals'), 0)
+        self.assertEqual(self.connection.keys('*:tanker:10*'), [])
+        self.assertEqual(set(Tanker.collection(kind='chemicals')), set())
+
+    def test_only_single_value_fields_can_be_updated(self):
+        with self.assertRaises(ValueError):
+            Tanker.collection().update(ports=['Antwerp'])
+        with self.assertRaises(ValueError):
+            Tanker.collection().update(pk=10)
+        with self.assertRaises(ImplementationError):
+            Tanker.collection().sort(by='name').update(flag='nl')
+
+    def test_none_cannot_be_set(self):
+        with self.assertRaises(ValueError):
+            Tanker.collection().update(name=None)
+        with self.assertRaises(ValueError):
+            Tanker.collection().update(lua=True, kind=None)
+        self.assertEqual(set(Tanker.collection(name='tanker 0')), {'1'})
+        self.assertEqual(set(Tanker.collection(kind='oil')), {'1', '3', '5'})
+
+    def test_updated_fields_are_locked(self):
+        # simulate a lock held by another process on an updated field
+        self.connection.set(fields.FieldLock.get_lock_name(Tanker.get_field('flag')), 'other', px=300)
+        start = time.time()
+        self.assertEqual(Tanker.collection(kind='oil').update(flag='nl'), 3)
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+        # also with lua
+        self.connection.set(fields.FieldLock.get_lock_name(Tanker.get_field('kind')), 'other', px=300)
+        start = time.time()
+        self.assertEqual(Tanker.collection(kind='oil').update(lua=True, kind='gas'), 3)
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -279,51 +279,38 @@ class FilterTest(BaseTest):
 
 class IntersectTest(BaseTest):
 
-    redis_zinterstore = None
-    redis_sinterstore = None
+    redis_store_tmp_key = None
 
     @staticmethod
-    def zinterstore(*args, **kwargs):
+    def store_tmp_key(self, command, key, *args):
         """
-        Store arguments and call the real zinterstore command
+        Store arguments of zinterstore and sinterstore commands, and call the
+        real _store_tmp_key method
         """
-        IntersectTest.last_interstore_call = {
-            'command': 'zinterstore',
-            'sets': args[1]
-        }
-        return IntersectTest.redis_zinterstore(*args, **kwargs)
-
-    @staticmethod
-    def sinterstore(*args, **kwargs):
-        """
-        Store arguments and call the real sinterstore command
-        """
-        IntersectTest.last_interstore_call = {
-            'command': 'sinterstore',
-            'sets': args[1]
-        }
-        return IntersectTest.redis_sinterstore(*args, **kwargs)
+        if command in ('zinterstore', 'sinterstore'):
+            IntersectTest.last_interstore_call = {
+                'command': command,
+                'sets': args[0]
+            }
+        return IntersectTest.redis_store_tmp_key(self, command, key, *args)
 
     def setUp(self):
         """
-        Update the redis zinterstore and sinterstore commands to be able to
-        store locally arguments for testing them just after the commands are
-        called. Store the original command to call it after logging, and to
-        restore it in tearDown.
+        Update the method used by the collection to call the redis zinterstore
+        and sinterstore commands to be able to store locally arguments for
+        testing them just after the commands are called. Store the original
+        method to call it after logging, and to restore it in tearDown.
         """
         super(IntersectTest, self).setUp()
         IntersectTest.last_interstore_call = {'command': None, 'sets': [], }
-        IntersectTest.redis_zinterstore = self.connection.zinterstore
-        self.connection.zinterstore = IntersectTest.zinterstore
-        IntersectTest.redis_sinterstore = self.connection.sinterstore
-        self.connection.sinterstore = IntersectTest.sinterstore
+        IntersectTest.redis_store_tmp_key = ExtendedCollectionManager._store_tmp_key
+        ExtendedCollectionManager._store_tmp_key = IntersectTest.store_tmp_key
 
     def tearDown(self):
         """
-        Restore the zinterstore and sinterstore previously updated in setUp.
+        Restore the _store_tmp_key method previously updated in setUp.
         """
-        self.connection.zinterstore = IntersectTest.redis_zinterstore
-        self.connection.sinterstore = IntersectTest.redis_sinterstore
+        ExtendedCollectionManager._store_tmp_key = IntersectTest.redis_store_tmp_key
         super(IntersectTest, self).tearDown()
 
     def test_intersect_should_accept_set_key_as_string(self):
@@ -985,3 +972,50 @@ class ValuesListTest(BaseValuesTest):
         self.assertEqual(boats, {'1', '2', '3', '4'})
         boats = set(Boat.collection().values_list('name', flat=True).primary_keys())
         self.assertEqual(boats, {'1', '2', '3', '4'})
+
+
+class IteratorTest(BaseValuesTest):
+
+    def test_iterator_should_return_values(self):
+        boats = list(Boat.collection(power='sail').values('pk', 'name').iterator(chunk_size=1))
+        self.assertEqual(sorted(boats, key=lambda boat: boat['pk']), [
+            {'pk': self.boat1._pk, 'name': 'Pen Duick I'},
+            {'pk': self.boat2._pk, 'name': 'Pen Duick II'},
+            {'pk': self.boat3._pk, 'name': 'Pen Duick III'},
+        ])
+        boats = set(Boat.collection(power='sail').values_list('pk', 'launched').iterator())
+        self.assertEqual(boats, {(self.boat1._pk, '1898'), (self.boat2._pk, '1964'),
+                                 (self.boat3._pk, '1966')})
+        boats = set(Boat.collection().values_list('name', flat=True).iterator())
+        self.assertEqual(boats, {'Pen Duick I', 'Pen Duick II', 'Pen Duick III', 'Rainbow Warrior I'})
+        self.assertEqual(self.connection.keys('*__collection__*'), [])
+
+    def test_iterator_should_work_with_sorted_sets_and_stored_collections(self):
+        zset_key = unique_key(self.connection)
+        self.connection.zadd(zset_key, {self.boat1._pk: 2.0, self.boat4._pk: 1.0, '10': 3.0})
+        self.assertEqual(set(Boat.collection().intersect(zset_key).iterator()),
+                         {self.boat1._pk, self.boat4._pk})
+        self.assertEqual(set(Boat.collection(power='sail').intersect(zset_key).iterator()),
+                         {self.boat1._pk})
+
+        stored_collection = Boat.collection(power='sail').store()
+        self.assertEqual(set(Boat.collection().from_stored(stored_collection.stored_key).iterator(chunk_size=2)),
+                         {self.boat1._pk, self.boat2._pk, self.boat3._pk})
+
+    def test_iterator_should_not_be_used_on_collections_sorted_by_score(self):
+        zset_key = unique_key(self.connection)
+        with self.assertRaises(ImplementationError):
+            Boat.collection().sort(by_score=zset_key).iterator()
+
+
+class KeysetPaginationTest(BaseValuesTest):
+
+    def test_keyset_pagination_cannot_be_used_with_values_or_sorted_sets(self):
+        with self.assertRaises(ImplementationError):
+            list(Boat.collection().values('pk', 'name').limit(2))
+        zset_key = unique_key(self.connection)
+        self.connection.zadd(zset_key, {self.boat1._pk: 2.0})
+        with self.assertRaises(ImplementationError):
+            list(Boat.collection().sort(by_score=zset_key).limit(2))
+        with self.assertRaises(ImplementationError):
+            list(Boat.collection().intersect(zset_key).limit(2))
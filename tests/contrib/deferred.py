@@ -0,0 +1,233 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from limpyd import fields
+from limpyd.contrib.deferred import DeferredIndexingWorker
+from limpyd.exceptions import UniquenessError
+from limpyd.indexes import EqualIndex, NumberRangeIndex
+from limpyd.utils import make_key
+
+from ..base import LimpydBaseTest
+from ..model import TestRedisModel
+
+
+class Truck(TestRedisModel):
+    namespace = 'deferred-indexing'
+    deferred_indexing = True
+
+    name = fields.InstanceHashField(indexable=True)
+    plate = fields.StringField(unique=True)
+    weight = fields.StringField(indexable=True, indexes=[EqualIndex, NumberRangeIndex])
+    colors = fields.SetField(indexable=True)
+    wheels = fields.InstanceHashField(indexable=True, default=6)
+
+
+class DeferredIndexingTest(LimpydBaseTest):
+
+    def test_indexable_fields_should_be_deferred_but_not_unique_ones(self):
+        self.assertTrue(Truck.get_field('name').deferred_indexing)
+        self.assertTrue(Truck.get_field('colors').deferred_indexing)
+        self.assertFalse(Truck.get_field('plate').deferred_indexing)
+        self.assertFalse(Truck.get_field('pk').deferred_indexing)
+
+    def test_writes_should_not_update_indexes_until_processed(self):
+        truck = Truck(name='volvo', plate='AB-123', weight=10, colors=['red', 'blue'])
+        # unique field is indexed right away
+        self.assertEqual(Truck.collection(plate='AB-123'), {truck.pk.get()})
+        self.assertEqual(Truck.collection(name='volvo'), set())
+        self.assertEqual(Truck.collection(colors='red'), set())
+
+        # 1 event for each deferred field (including the default one)
+        self.assertEqual(Truck.process_deferred_indexing(), 4)
+        self.assertEqual(Truck.process_deferred_indexing(), 0)
+        self.assertEqual(Truck.collection(name='volvo'), {truck.pk.get()})
+        self.assertEqual(Truck.collection(weight__gt=5), {truck.pk.get()})
+        self.assertEqual(Truck.collection(colors='blue'), {truck.pk.get()})
+        self.assertEqual(Truck.collection(wheels=6), {truck.pk.get()})
+
+    def test_old_values_should_be_deindexed(self):
+        truck = Truck(name='volvo', weight=10, colors=['red', 'blue'])
+        Truck.process_deferred_indexing()
+
+        truck.name.hset('scania')
+        truck.weight.set(20)
+        truck.weight.set(30)  # only the last value is indexed
+        truck.colors.srem('red')
+        truck.hmset(wheels=8)
+        Truck.process_deferred_indexing()
+
+        self.assertEqual(Truck.collection(name='volvo'), set())
+        self.assertEqual(Truck.collection(name='scania'), {truck.pk.get()})
+        self.assertEqual(Truck.collection(weight=10), set())
+        self.assertEqual(Truck.collection(weight=20), set())
+        self.assertEqual(Truck.collection(weight__gte=30), {truck.pk.get()})
+        self.assertEqual(Truck.collection(colors='red'), set())
+        self.assertEqual(Truck.collection(colors='blue'), {truck.pk.get()})
+        self.assertEqual(Truck.collection(wheels=6), set())
+        self.assertEqual(Truck.collection(wheels=8), {truck.pk.get()})
+
+        truck.hdel('name')
+        Truck.process_deferred_indexing()
+        self.assertEqual(Truck.collection(name='scania'), set())
+
+    def test_deleted_instances_should_be_deindexed(self):
+        truck = Truck(name='volvo', weight=10, colors=['red'])
+        Truck.process_deferred_indexing()
+        truck.delete()
+        Truck.process_deferred_indexing()
+        self.assertEqual(Truck.collection(name='volvo'), set())
+        self.assertEqual(Truck.collection(weight=10), set())
+        self.assertEqual(Truck.collection(colors='red'), set())
+        self.assertFalse(self.connection.exists(Truck._deferred_indexed_key('name')))
+
+    def test_bulk_create_should_defer_indexing(self):
+        pks = Truck.bulk_create([{'name': 'volvo', 'plate': 'AB-1'}, {'name': 'man', 'plate': 'AB-2'}])
+        self.assertEqual(Truck.collection(plate='AB-2'), {pks[1]})
+        self.assertEqual(Truck.collection(name='volvo'), set())
+        with self.assertRaises(UniquenessError):
+            Truck.bulk_create([{'name': 'volvo', 'plate': 'AB-1'}])
+        Truck.process_deferred_indexing()
+        self.assertEqual(Truck.collection(name='volvo'), {pks[0]})
+        self.assertEqual(Truck.collection(wheels=6), set(pks))
+
+    def test_events_should_be_processed_by_batches(self):
+        for i in range(5):
+            Truck(name='truck%d' % i)
+        # 2 events per instance: name and wheels
+        self.assertEqual(Truck.process_deferred_indexing(batch_size=3), 3)
+        self.assertFalse(Truck.wait_for_deferred_indexing(timeout=0.01))
+        self.assertEqual(Truck.process_deferred_indexing(batch_size=3), 3)
+        self.assertEqual(Truck.process_deferred_indexing(batch_size=10), 4)
+        self.assertTrue(Truck.wait_for_deferred_indexing(timeout=0.01))
+        self.assertEqual(len(Truck.collection(wheels=6)), 5)
+
+    def test_events_should_be_requeued_if_the_processing_fails(self):
+        for i in range(3):
+            Truck(name='truck%d' % i)
+        queue_key, pending_key = Truck._deferred_indexing_keys()
+        events = self.connection.lrange(queue_key, 0, -1)
+
+        def fail(*args, **kwargs):
+            raise RuntimeError('failure')
+
+        field = Truck.get_field('name')
+        field._add_to_indexes = fail
+        try:
+            with self.assertRaises(RuntimeError):
+                Truck.process_deferred_indexing(batch_size=4)
+        finally:
+            del field._add_to_indexes
+
+        # the events are back in the queue, in the same order, and still pending
+        self.assertEqual(self.connection.lrange(queue_key, 0, -1), events)
+        self.assertEqual(self.connection.get(pending_key), '6')
+        self.assertEqual(self.connection.keys(queue_key + ':in-flight:*'), [])
+        self.assertEqual(Truck.collection(name='truck0'), set())
+
+        self.assertEqual(Truck.process_deferred_indexing(), 6)
+        self.assertTrue(Truck.wait_for_deferred_indexing(timeout=0.01))
+        self.assertEqual(self.connection.keys(queue_key + ':in-flight:*'), [])
+        self.assertEqual(len(Truck.collection(wheels=6)), 3)
+        self.assertEqual(len(Truck.collection(name='truck0')), 1)
+
+    def test_events_of_a_killed_worker_should_be_requeued(self):
+        for i in range(3):
+            Truck(name='truck%d' % i)
+        queue_key, pending_key = Truck._deferred_indexing_keys()
+        in_flight_lists_key = Truck._deferred_indexing_in_flight_key()
+
+        # a worker takes a batch and is killed before processing it
+        Truck.database.call_script(
+            Truck.deferred_indexing_take_script,
+            keys=[queue_key, make_key(in_flight_lists_key, 'killed'), in_flight_lists_key],
+            args=[4, 100],
+        )
+        self.assertEqual(self.connection.llen(queue_key), 2)
+        self.assertEqual(Truck.process_deferred_indexing(), 2)
+        self.assertFalse(Truck.wait_for_deferred_indexing(timeout=0.01))
+
+        # once expired, the events are put back at the head of the queue
+        time.sleep(0.15)
+        self.assertEqual(Truck.process_deferred_indexing(batch_size=4), 4)
+        self.assertTrue(Truck.wait_for_deferred_indexing(timeout=0.01))
+        self.assertEqual(self.connection.keys(queue_key + ':in-flight*'), [])
+        self.assertEqual(len(Truck.collection(wheels=6)), 3)
+        self.assertEqual(self.connection.llen(queue_key), 0)
+
+    def test_events_of_a_too_slow_worker_should_not_be_counted_twice(self):
+        truck = Truck(name='volvo')
+        __, pending_key = Truck._deferred_indexing_keys()
+        original = Truck._process_deferred_indexing_events
+        calls = []
+
+        def slow(events):
+            if not calls:
+                calls.append(events)
+                time.sleep(0.1)
+                # another worker takes the expired events meanwhile, and processes them
+                self.assertEqual(Truck.process_deferred_indexing(), 2)
+            original(events)
+
+        Truck._process_deferred_indexing_events = staticmethod(slow)
+        try:
+            self.assertEqual(Truck.process_deferred_indexing(timeout=0.05), 2)
+        finally:
+            del Truck._process_deferred_indexing_events
+
+        self.assertEqual(self.connection.get(pending_key), '0')
+        self.assertEqual(self.connection.keys(Truck._deferred_indexing_in_flight_key() + '*'), [])
+        self.assertEqual(Truck.collection(name='volvo'), {truck.pk.get()})
+
+    def test_values_should_be_read_in_one_pipeline(self):
+        for i in range(5):
+            Truck(name='truck%d' % i, weight=i, colors=['red'])
+        # only the two scripts to take and drop the events
+        self.assertEqual(self.get_round_trips(Truck.process_deferred_indexing), ['EVALSHA', 'EVALSHA'])
+        self.assertEqual(len(Truck.collection(colors='red', weight__gte=3)), 2)
+
+    def test_verify_indexes_should_use_the_indexed_values(self):
+        truck = Truck(name='volvo', weight=10)
+        Truck.process_deferred_indexing()
+        field = Truck.get_field('name')
+
+        # events still in the queue are not reported
+        truck.name.hset('scania')
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+
+        # the repaired entry is the one the worker will deindex
+        self.connection.srem(field._indexes[0].get_storage_key('volvo'), truck.pk.get())
+        self.assertEqual(field.verify_indexes(repair=True), {'missing': 1, 'stale': 0})
+        self.assertEqual(Truck.collection(name='volvo'), {truck.pk.get()})
+        Truck.process_deferred_indexing()
+        self.assertEqual(Truck.collection(name='volvo'), set())
+        self.assertEqual(Truck.collection(name='scania'), {truck.pk.get()})
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+
+        # and the entries of deleted instances are kept until processed
+        truck.delete()
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+        Truck.process_deferred_indexing()
+        self.assertEqual(Truck.verify_indexes()['weight'], {'missing': 0, 'stale': 0})
+
+    def test_worker_should_drain_the_queues(self):
+        for i in range(5):
+            Truck(name='truck%d' % i)
+        worker = DeferredIndexingWorker([Truck], batch_size=2, interval=0.01)
+        worker.run(stop_when_empty=True)
+        self.assertTrue(Truck.wait_for_deferred_indexing(timeout=0))
+        self.assertEqual(len(Truck.collection(wheels=6)), 5)
+
+    def test_wait_should_return_when_a_worker_drained_the_queue(self):
+        worker = DeferredIndexingWorker([Truck], interval=0.01)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        try:
+            truck = Truck(name='volvo')
+            self.assertTrue(Truck.wait_for_deferred_indexing(timeout=5, interval=0.01))
+            self.assertEqual(Truck.collection(name='volvo'), {truck.pk.get()})
+        finally:
+            worker.stop()
+            thread.join()
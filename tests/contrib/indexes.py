@@ -806,6 +806,22 @@ class ScoredEqualIndexTestCase(LimpydBaseTest):
             'tests-scored:job:queue:equal-scored:1'
         )
 
+    def test_verify_indexes(self):
+        for i in range(4):
+            ScoredEqualIndexModel(queue_name='q%d' % (i % 2), priority=i)
+        field = ScoredEqualIndexModel.get_field('queue_name')
+        # the scores are read with the values, in the same pipeline
+        self.assertEqual(self.get_round_trips(lambda: field._get_index_entries(['1', '2', '3', '4'])), [])
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+
+        # a wrong score, and a stale entry
+        self.connection.zadd('tests:scoredequalindexmodel:queue_name:equal-scored:q0', {'3': 10})
+        self.connection.zadd('tests:scoredequalindexmodel:queue_name:equal-scored:q1', {'1': 0})
+        self.assertEqual(field.verify_indexes(repair=True), {'missing': 1, 'stale': 1})
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+        self.assertEqual(self.connection.zrange('tests:scoredequalindexmodel:queue_name:equal-scored:q0',
+                                                0, -1, withscores=True), [('1', 0.0), ('3', 2.0)])
+
 
 class EqualIndexWithOneFieldModel(TestRedisModel):
     collection_manager = ExtendedCollectionManager
@@ -1210,6 +1226,61 @@ class EqualIndexWithTestCase(LimpydBaseTest):
         self.assertSetEqual(set(collection(priority=2, name='foo')), set())
         self.assertSetEqual(set(collection(priority=3, name='foo')), {pk1})
 
+    def test_verify_indexes(self):
+        for i in range(4):
+            EqualIndexWithOneFieldModel(name='n%d' % (i % 2), priority=i % 3)
+        field = EqualIndexWithOneFieldModel.get_field('name')
+        # the other fields are read with the values, in the same pipeline
+        self.assertEqual(self.get_round_trips(lambda: field._get_index_entries(['1', '2', '3', '4'])), [])
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+
+        # a missing entry, and a stale one
+        self.connection.srem('tests:equalindexwithonefieldmodel:name:equal-with:n0:0', 1)
+        self.connection.sadd('tests:equalindexwithonefieldmodel:name:equal-with:n0:1', 3)
+        self.assertEqual(field.verify_indexes(repair=True), {'missing': 1, 'stale': 1})
+        self.assertEqual(field.verify_indexes(), {'missing': 0, 'stale': 0})
+        self.assertEqual(set(EqualIndexWithOneFieldModel.collection(name='n0', priority=0)), {'1'})
+        self.assertEqual(set(EqualIndexWithOneFieldModel.collection(name='n0', priority=1)), set())
+
+    def test_uniqueness_with_bulk_create(self):
+        class EqualIndexWithBulkCreateModel(TestRedisModel):
+            priority = fields.InstanceHashField(indexable=True)
+            name = fields.InstanceHashField(
+                indexable=True,
+                indexes=[
+                    EqualIndexWith.configure(other_fields=['priority'], unique=True),
+                    EqualIndex,
+                ]
+            )
+        collection = EqualIndexWithBulkCreateModel.collection
+        pk1, pk2 = EqualIndexWithBulkCreateModel.bulk_create([
+            {'name': 'foo', 'priority': 1},
+            {'name': 'foo', 'priority': 2},
+        ])
+        self.assertSetEqual(set(collection(name='foo', priority=1)), {pk1})
+
+        # used in redis
+        with self.assertRaises(UniquenessError):
+            EqualIndexWithBulkCreateModel.bulk_create([
+                {'name': 'bar', 'priority': 1},
+                {'name': 'foo', 'priority': 2},
+            ])
+        # used twice in the chunk
+        with self.assertRaises(UniquenessError):
+            EqualIndexWithBulkCreateModel.bulk_create([
+                {'name': 'bar', 'priority': 1},
+                {'name': 'bar', 'priority': 1},
+            ])
+        self.assertSetEqual(set(collection()), {pk1, pk2})
+
+        # the uniqueness of all the instances is checked in one pipeline
+        all_values = [{'name': 'bar', 'priority': i} for i in range(10)]
+        commands = self.get_round_trips(
+            lambda: EqualIndexWithBulkCreateModel._check_multi_fields_uniqueness_at_init_many(all_values))
+        self.assertEqual(commands, [])
+        EqualIndexWithBulkCreateModel.bulk_create(all_values)
+        self.assertEqual(len(collection(name='bar')), 10)
+
     def test_with_listfield(self):
         class EqualIndexWithListFieldModel(TestRedisModel):
             foo = fields.InstanceHashField(
@@ -1364,3 +1435,37 @@ class EqualIndexWithTestCase(LimpydBaseTest):
         queue = Queue(name='foo', priority=1)
         Queue(name='foo', priority=2)
         list
+
+
+class VersionedRelatedIndexesModel(TestRedisModel):
+    namespace = 'tests-versioned'
+    versioned_indexes = True
+    collection_manager = ExtendedCollectionManager
+    priority = fields.InstanceHashField()
+    status = fields.InstanceHashField(indexable=True)
+    queue = fields.InstanceHashField(indexable=True, indexes=[ScoredEqualIndex.configure(score_field='priority')])
+    name = fields.InstanceHashField(indexable=True, indexes=[EqualIndexWith.configure(other_fields=['status'])])
+
+
+class VersionedRelatedIndexesTestCase(LimpydBaseTest):
+
+    def test_version_being_built_gets_the_writes_of_the_other_fields(self):
+        model = VersionedRelatedIndexesModel
+        obj = model(queue='q', name='n', status='a')
+        for field_name in ('queue', 'name'):
+            versions = model.get_field(field_name)._index_versions
+            versions.cache_ttl = 0  # no need to wait in tests
+            self.connection.hset(versions.key, 'building', '7')
+
+        obj.priority.hset(3)
+        obj.status.hset('b')
+        prefix = 'tests-versioned:versionedrelatedindexesmodel:'
+        self.assertEqual(self.connection.zrange(prefix + '__index__:queue:v7:' + prefix + 'queue:equal-scored:q',
+                                                0, -1, withscores=True), [('1', 3.0)])
+        self.assertEqual(self.connection.smembers(prefix + '__index__:name:v7:' + prefix + 'name:equal-with:n:b'),
+                         {'1'})
+        self.assertEqual(self.connection.keys(prefix + '__index__:name:v7:*:a'), [])
+
+        obj.priority.hdel()
+        self.assertEqual(self.connection.keys(prefix + '__index__:queue:v7:*'), [])
+        self.assertEqual(set(model.collection(name='n', status='b')), {'1'})
@@ -402,6 +402,87 @@ class FKTest(LimpydBaseTest):
         self.assertIsNone(core_devs.parent.get())
         self.assertIsNone(fan_boys.parent.get())
 
+    def test_related_instances_are_cleaned_by_chunks(self):
+        core_devs = Group(name='limpyd core devs')
+        persons = [Person(name='person %d' % num, prefered_group=core_devs) for num in range(5)]
+        self.assertEqual(len(core_devs.person_set()), 5)
+
+        def count(command):
+            return self.connection.info('commandstats').get('cmdstat_%s' % command, {}).get('calls', 0)
+
+        core_devs.person_set.REMOVE_CHUNK_SIZE = 2
+        sismember = count('sismember')
+        core_devs.delete()
+        # the existence of the related instances is not checked
+        self.assertEqual(count('sismember'), sismember)
+        for person in persons:
+            self.assertIsNone(person.prefered_group.get())
+        self.assertEqual(set(Person.collection(prefered_group='limpyd core devs')), set())
+
+    def test_fk_changed_after_reading_the_related_instances_must_not_be_cleared(self):
+        core_devs = Group(name='limpyd core devs')
+        fan_boys = Group(name='limpyd fan boys')
+        ybon = Person(name='ybon', prefered_group=core_devs)
+        twidi = Person(name='twidi', prefered_group=core_devs)
+
+        read_collection = Person.collection
+
+        def collection(**filters):
+            pks = list(read_collection(**filters))
+            # another process changes the FK before the lock is taken
+            ybon.prefered_group.set(fan_boys)
+            return pks
+
+        Person.collection = collection
+        try:
+            core_devs.delete()
+        finally:
+            del Person.collection
+
+        self.assertEqual(ybon.prefered_group.get(), 'limpyd fan boys')
+        self.assertEqual(set(Person.collection(prefered_group='limpyd fan boys')), {'ybon'})
+        self.assertIsNone(twidi.prefered_group.get())
+        self.assertEqual(set(Person.collection(prefered_group='limpyd core devs')), set())
+
+    def test_deleting_a_collection_must_clear_the_fk(self):
+        core_devs = Group(name='limpyd core devs')
+        ybon = Person(name='ybon', age=30)
+        twidi = Person(name='twidi', age=30)
+        core_devs.owner.hset(ybon)
+        ybon.prefered_group.set(core_devs)
+        twidi.prefered_group.set(core_devs)
+
+        self.assertEqual(Person.collection(age=30).delete(), 2)
+        self.assertIsNone(core_devs.owner.hget())
+        self.assertSetEqual(set(core_devs.person_set()), set())
+        self.assertSetEqual(set(Person.collection()), set())
+
+    def test_deleting_a_collection_must_clean_all_the_related_fields_at_once(self):
+        persons = [Person(name='person %d' % num, age=num % 2) for num in range(8)]
+        groups = [Group(name='group %d' % num) for num in range(3)]
+        for num, person in enumerate(persons):
+            groups[num % 2].members.sadd(person)
+            person.following.sadd(persons[num - 1])
+        groups[0].owner.hset(persons[6])
+        groups[1].owner.hset(persons[3])
+        groups[2].owner.hset(persons[0])
+
+        # the same number of round trips for 2 or 4 deleted persons
+        round_trips = self.get_round_trips(lambda: Person._bulk_delete(['person 6', 'person 7']))
+        self.assertEqual(len(self.get_round_trips(
+            lambda: Person._bulk_delete(['person 2', 'person 3', 'person 4', 'person 5']))), len(round_trips))
+
+        self.assertEqual(set(groups[0].members.smembers()), {'person 0'})
+        self.assertEqual(set(groups[1].members.smembers()), {'person 1'})
+        self.assertEqual(set(Group.collection(members='person 2')), set())
+        self.assertIsNone(groups[0].owner.hget())
+        self.assertIsNone(groups[1].owner.hget())
+        self.assertEqual(groups[2].owner.hget(), 'person 0')
+        self.assertEqual(set(Group.collection(owner='person 3')), set())
+        self.assertEqual(set(persons[1].following.smembers()), {'person 0'})
+        self.assertEqual(set(persons[0].following.smembers()), set())
+        self.assertEqual(set(Person.collection(following='person 7')), set())
+
     def test_deleting_a_fk_must_clean_the_collection(self):
         core_devs = Group(name='limpyd core devs')
         ybon = Person(name='ybon')
@@ -411,6 +492,52 @@ class FKTest(LimpydBaseTest):
         self.assertSetEqual(set(ybon.owned_groups()), set())
 
 
+class SelectRelatedTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(SelectRelatedTest, self).setUp()
+        self.ybon = Person(name='ybon')
+        self.twidi = Person(name='twidi')
+        self.sue = Person(name='sue')
+        self.core_devs = Group(name='limpyd core devs', owner=self.twidi)
+        self.fan_boys = Group(name='limpyd fan boys', owner=self.ybon)
+        self.ybon.prefered_group.set(self.core_devs)
+        self.twidi.prefered_group.set(self.fan_boys)
+
+    def test_related_instances_are_got_in_bulk(self):
+        collection = Person.collection().instances().select_related('prefered_group__owner')
+        # the collection and the existence of the persons, 1 GET by person, the
+        # existence of the groups, 1 HGET by group, the existence of the owners
+        with self.assertNumCommands(1 + 1 + 3 + 1 + 2 + 1):
+            persons = {person._pk: person for person in collection}
+        with self.assertNumCommands(0):
+            self.assertEqual(persons['ybon'].prefered_group.instance()._pk, 'limpyd core devs')
+            self.assertEqual(persons['ybon'].prefered_group.instance().owner.instance()._pk, 'twidi')
+            self.assertEqual(persons['twidi'].prefered_group.instance().owner.instance()._pk, 'ybon')
+        self.assertIsNone(persons['sue'].prefered_group.get())
+
+    def test_related_instances_are_shared(self):
+        Person(name='ned', prefered_group=self.core_devs)
+        persons = list(Person.collection(prefered_group=self.core_devs).instances().select_related('prefered_group'))
+        self.assertEqual(len(persons), 2)
+        self.assertIs(persons[0].prefered_group.instance(), persons[1].prefered_group.instance())
+
+    def test_updating_the_fk_forgets_the_related_instance(self):
+        person = Person.collection(pk='ybon').instances().select_related('prefered_group')[0]
+        self.assertEqual(person.prefered_group.instance()._pk, 'limpyd core devs')
+        person.prefered_group.set(self.fan_boys)
+        self.assertEqual(person.prefered_group.instance()._pk, 'limpyd fan boys')
+        group = Group.collection(pk='limpyd core devs').instances().select_related('owner')[0]
+        group.hmset(owner=self.sue._pk)
+        self.assertEqual(group.owner.instance()._pk, 'sue')
+
+    def test_only_fk_fields_can_be_selected(self):
+        with self.assertRaises(ValueError):
+            Person.collection().select_related('age')
+        with self.assertRaises(ValueError):
+            Person.collection().select_related('prefered_group__members')
+
+
 class M2MSetTest(LimpydBaseTest):
 
     def test_set_m2m_values_can_be_given_as_object(self):
@@ -493,6 +620,17 @@ class M2MListTest(LimpydBaseTest):
         self.assertSetEqual(set(ybon.members_set2()), {core_devs._pk})
         self.assertSetEqual(set(twidi.members_set2()), {core_devs._pk})
 
+    def test_deleting_an_object_must_clean_list_m2m(self):
+        core_devs = M2MListTest.Group2(name='limpyd core devs')
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+
+        core_devs.members.rpush(ybon._pk, twidi, ybon)
+        ybon.delete()
+
+        self.assertEqual(core_devs.members.lrange(0, -1), [twidi._pk])
+        self.assertSetEqual(set(twidi.members_set2()), {core_devs._pk})
+
 
 class M2MSortedSetTest(LimpydBaseTest):
 
@@ -525,6 +663,17 @@ class M2MSortedSetTest(LimpydBaseTest):
         self.assertEqual(core_devs.members.zscore(twidi), 10.0)
         self.assertEqual(core_devs.members.zrevrangebyscore(25, 15), [ybon._pk])
 
+    def test_deleting_an_object_must_clean_zset_m2m(self):
+        core_devs = M2MSortedSetTest.Group3(name='limpyd core devs')
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+
+        core_devs.members.zadd({ybon: 20, twidi: 10})
+        ybon.delete()
+
+        self.assertEqual(core_devs.members.zrange(0, -1), [twidi._pk])
+        self.assertSetEqual(set(twidi.members_set3()), {core_devs._pk})
+
 
 class DatabaseTest(LimpydBaseTest):
     def test_database_could_transfer_its_models_and_relations_to_another(self):
@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import time
 import unittest
 
 from limpyd import fields
@@ -288,6 +289,7 @@ class TextRangeIndexTestCase(LimpydBaseTest):
         self.assertEqual(self.connection.type(index_key), 'set')
         self.assertEqual(key_type, 'set')
         self.assertTrue(is_tmp)
+        self.assertGreater(self.connection.ttl(index_key), 0)
         data = self.connection.smembers(index_key)
         self.assertEqual(data, {
             self.pk1,  # foo gt bar
@@ -306,6 +308,30 @@ class TextRangeIndexTestCase(LimpydBaseTest):
             (self.pk1, 1.0),  # foo lte foo
         ])
 
+    def test_filter_on_many_members(self):
+        # many members, to be read by many blocks
+        pks = RangeIndexTestModel.bulk_create({'name': 'name%d' % (i % 10)} for i in range(300))
+        names = dict(zip(pks, ('name%d' % (i % 10) for i in range(300))))
+        others = {self.pk1, self.pk2, self.pk3, self.pk4, self.pk5}
+
+        for filters, test in (
+            ({'name__gte': 'name3', 'name__lt': 'name7'}, lambda name: 'name3' <= name < 'name7'),
+            ({'name__gt': 'name3'}, lambda name: name > 'name3'),
+            ({'name__lte': 'name8'}, lambda name: name <= 'name8'),
+            ({'name': 'name5'}, lambda name: name == 'name5'),
+        ):
+            collection = RangeIndexTestModel.collection(**filters)
+            expected = {pk for pk, name in names.items() if test(name)}
+            self.assertEqual(set(collection) - others, expected)
+            self.assertEqual(set(collection.single_call()), set(collection))
+
+        # the positions continue from one block to the next
+        index = RangeIndexTestModel.get_field('name').get_index()
+        index_key = index.get_filtered_keys('gte', 'name', accepted_key_types={'zset'})[0][0]
+        data = self.connection.zrange(index_key, 0, -1, withscores=True)
+        self.assertEqual(len(data), 301)  # with "qux"
+        self.assertEqual([score for member, score in data], [float(i) for i in range(301)])
+
     def test_eq(self):
         # without suffix
         data = set(RangeIndexTestModel.collection(name='foo'))
@@ -524,6 +550,7 @@ class NumberRangeIndexTestCase(LimpydBaseTest):
         self.assertEqual(self.connection.type(index_key), 'set')
         self.assertEqual(key_type, 'set')
         self.assertTrue(is_tmp)
+        self.assertGreater(self.connection.ttl(index_key), 0)
         data = self.connection.smembers(index_key)
         self.assertEqual(data, {
             self.pk1,  # -15 > -25
@@ -542,6 +569,28 @@ class NumberRangeIndexTestCase(LimpydBaseTest):
             (self.pk1, 1.0),  # -15 <= -15
         ])
 
+    def test_filter_on_many_members(self):
+        # many members with the same score, to be read by many blocks
+        pks = RangeIndexTestModel.bulk_create({'value': i % 10} for i in range(300))
+        values = dict(zip(pks, (i % 10 for i in range(300))))
+        others = {self.pk1, self.pk2, self.pk3, self.pk4, self.pk5}
+
+        for filters, test in (
+            ({'value__gte': 3, 'value__lt': 7}, lambda value: 3 <= value < 7),
+            ({'value__gt': 3}, lambda value: value > 3),
+            ({'value__lte': 8}, lambda value: value <= 8),
+            ({'value': 5}, lambda value: value == 5),
+        ):
+            collection = RangeIndexTestModel.collection(**filters)
+            expected = {pk for pk, value in values.items() if test(value)}
+            self.assertEqual(set(collection) - others, expected)
+            self.assertEqual(set(collection.single_call()), set(collection))
+
+        index = RangeIndexTestModel.get_field('value').get_index()
+        index_key = index.get_filtered_keys('gt', 3, accepted_key_types={'zset'})[0][0]
+        self.assertEqual(self.connection.zrange(index_key, 0, -1),
+                         self.connection.zrangebyscore(index.get_storage_key(3), '(3', '+inf'))
+
     def test_eq(self):
         # without suffix
         data = set(RangeIndexTestModel.collection(value=-15))
@@ -1085,6 +1134,235 @@ class CleanTestCase(LimpydBaseTest):
         with self.assertRaises(AssertionError):
             CleanModel3().two_indexes_field.rebuild_indexes()
 
+    def test_rebuild_by_chunks_with_progress(self):
+
+        class CleanModel4(TestRedisModel):
+            field = fields.InstanceHashField(indexable=True)
+            set_field = fields.SetField(indexable=True)
+
+        # enough instances for the set of pks to be scanned by chunks
+        CleanModel4.bulk_create({'field': str(i % 3), 'set_field': ['x', str(i)]} for i in range(600))
+
+        index = CleanModel4.get_field('field').get_index()
+        steps = []
+        index.rebuild(chunk_size=100, progress=lambda cursor, count: steps.append((cursor, count)))
+        self.assertEqual(len(set(CleanModel4.collection(field='0'))), 200)
+        # the last call of progress is done with a cursor at 0 and all instances processed
+        self.assertGreater(len(steps), 1)
+        self.assertEqual(steps[-1][0], 0)
+        self.assertGreaterEqual(steps[-1][1], 600)
+
+        # resume an interrupted rebuild from a saved cursor: the first chunk is not indexed
+        index = CleanModel4.get_field('set_field').get_index()
+        index.clear(aggressive=True)
+        index.rebuild(chunk_size=100, cursor=steps[0][0])
+        nb_indexed = len(set(CleanModel4.collection(set_field='x')))
+        self.assertGreater(nb_indexed, 0)
+        self.assertLess(nb_indexed, 600)
+        index.rebuild(chunk_size=100)
+        self.assertEqual(len(set(CleanModel4.collection(set_field='x'))), 600)
+
+    def test_parallel_rebuild(self):
+
+        class CleanModel5(TestRedisModel):
+            field = fields.InstanceHashField(indexable=True)
+            range_field = fields.StringField(indexable=True, indexes=[NumberRangeIndex])
+
+        CleanModel5.bulk_create({'field': str(i % 3), 'range_field': i} for i in range(600))
+        # a stale and a missing entries, to be fixed by the rebuild
+        self.connection.sadd('tests:cleanmodel5:field:3', 1)
+        self.connection.srem('tests:cleanmodel5:field:0', 4)
+
+        def count_sscan():
+            return self.connection.info('commandstats').get('cmdstat_sscan', {}).get('calls', 0)
+
+        # the pks are scanned only once, not by each worker
+        start = count_sscan()
+        list(CleanModel5.get_field('field').get_index()._iterate_pks(100))
+        nb_calls = count_sscan() - start
+        start = count_sscan()
+        CleanModel5.get_field('field').rebuild_indexes(chunk_size=100, workers=3)
+        self.assertEqual(count_sscan() - start, nb_calls)
+        self.assertEqual(len(set(CleanModel5.collection(field='0'))), 200)
+        self.assertEqual(set(CleanModel5.collection(field='3')), set())
+        self.assertIn('4', set(CleanModel5.collection(field='0')))
+
+        index = CleanModel5.get_field('range_field').get_index()
+        self.connection.delete(index.get_storage_key(None))
+        index.rebuild(workers=2)
+        self.assertEqual(len(set(CleanModel5.collection(range_field__lt=100))), 100)
+
+        # no temporary keys left
+        self.assertEqual(self.connection.keys('*__index__*'), [])
+
+    def test_shadow_rebuild(self):
+
+        class CleanModel6(TestRedisModel):
+            versioned_indexes = True
+            field = fields.InstanceHashField(indexable=True, indexes=[EqualIndex, TextRangeIndex])
+
+        CleanModel6.get_field('field')._index_versions.cache_ttl = 0  # no need to wait in tests
+        for i in range(10):
+            CleanModel6(field=str(i % 2))
+        # a stale entry, that must not survive the rebuild
+        self.connection.sadd('tests:cleanmodel6:field:2', 1)
+        self.assertEqual(set(CleanModel6.collection(field='2')), {'1'})
+
+        CleanModel6.get_field('field').rebuild_indexes(shadow=True)
+        self.assertEqual(set(CleanModel6.collection(field='0')), {'1', '3', '5', '7', '9'})
+        self.assertEqual(set(CleanModel6.collection(field__gt='0')), {'2', '4', '6', '8', '10'})
+        self.assertEqual(set(CleanModel6.collection(field='2')), set())
+        # the keys of the old version are deleted, the new ones are versioned
+        self.assertEqual(self.connection.keys('tests:cleanmodel6:field:*'), [])
+        self.assertIn('tests:cleanmodel6:__index__:field:v1:tests:cleanmodel6:field:0',
+                      self.connection.keys('tests:cleanmodel6:__index__:field:v1:*'))
+
+        # writes go to the new version
+        CleanModel6(1).field.hset('2')
+        self.assertEqual(set(CleanModel6.collection(field='2')), {'1'})
+
+        # while a version is being built, writes go to both versions
+        versions = CleanModel6.get_field('field')._index_versions
+        self.connection.hset(versions.key, 'building', '5')
+        CleanModel6(3).field.hset('2')
+        self.connection.hdel(versions.key, 'building')
+        self.assertEqual(self.connection.smembers('tests:cleanmodel6:__index__:field:v1:tests:cleanmodel6:field:2'), {'1', '3'})
+        self.assertEqual(self.connection.smembers('tests:cleanmodel6:__index__:field:v5:tests:cleanmodel6:field:2'), {'3'})
+        self.assertEqual(self.connection.smembers('tests:cleanmodel6:__index__:field:v5:tests:cleanmodel6:field:0'), set())
+        self.connection.delete(*self.connection.keys('tests:cleanmodel6:__index__:field:v5:*'))
+
+        CleanModel6.get_field('field').rebuild_indexes(shadow=True)
+        self.assertEqual(set(CleanModel6.collection(field='2')), {'1', '3'})
+        self.assertEqual(self.connection.keys('tests:cleanmodel6:__index__:field:v1:*'), [])
+
+        # a parallel rebuild rebuilds the active version
+        CleanModel6.get_field('field').rebuild_indexes(workers=2)
+        self.assertEqual(set(CleanModel6.collection(field='0')), {'5', '7', '9'})
+        self.assertEqual(set(CleanModel6.collection(field='2')), {'1', '3'})
+        self.assertEqual(set(CleanModel6.collection(field__gt='0')), {'1', '2', '3', '4', '6', '8', '10'})
+        self.assertEqual(self.connection.keys('tests:cleanmodel6:field:*'), [])
+        self.assertEqual(self.connection.keys('*__index__:*:rebuild*'), [])
+
+        # only for models with versioned indexes
+        class CleanModel7(TestRedisModel):
+            field = fields.InstanceHashField(indexable=True)
+
+        with self.assertRaises(ImplementationError):
+            CleanModel7.get_field('field').rebuild_indexes(shadow=True)
+
+    def test_version_being_built_gets_all_the_writes(self):
+
+        class CleanModel9(TestRedisModel):
+            versioned_indexes = True
+            status = fields.InstanceHashField(indexable=True)
+
+        versions = CleanModel9.get_field('status')._index_versions
+        versions.cache_ttl = 0  # no need to wait in tests
+        for i in range(3):
+            CleanModel9(status='a')
+        self.connection.hset(versions.key, 'building', '7')
+
+        def members(value):
+            return self.connection.smembers('tests:cleanmodel9:__index__:status:v7:tests:cleanmodel9:status:%s' % value)
+
+        # lua updates
+        self.assertEqual(CleanModel9.collection(pk=2).update(lua=True, status='c'), 1)
+        self.assertEqual(set(CleanModel9.collection(status='c')), {'2'})
+        self.assertEqual(members('c'), {'2'})
+        self.assertEqual(members('a'), set())
+
+        # rollbacks
+        field = CleanModel9(1).status
+        field.index('d')
+        self.assertEqual(members('d'), {'1'})
+        field._rollback_indexes()
+        field._reset_indexes_rollback_caches('1')
+        self.assertEqual(members('d'), set())
+        self.assertEqual(set(CleanModel9.collection(status='d')), set())
+
+    def test_shadow_rebuild_waits_twice_the_cache_ttl(self):
+
+        class CleanModel11(TestRedisModel):
+            versioned_indexes = True
+            field = fields.InstanceHashField(indexable=True)
+
+        CleanModel11.get_field('field')._index_versions.cache_ttl = 0.1
+        CleanModel11(field='a')
+        start = time.time()
+        CleanModel11.get_field('field').rebuild_indexes(shadow=True)
+        # before building the new version, and before deleting the old one
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        self.assertEqual(set(CleanModel11.collection(field='a')), {'1'})
+
+    def test_walk_locks_the_field(self):
+
+        class CleanModel10(TestRedisModel):
+            field = fields.InstanceHashField(indexable=True)
+
+        for i in range(3):
+            CleanModel10(field=str(i))
+        # simulate a lock held by another process on the field
+        self.connection.set(fields.FieldLock.get_lock_name(CleanModel10.get_field('field')), 'other', px=300)
+        start = time.time()
+        CleanModel10.get_field('field').rebuild_indexes()
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertEqual(set(CleanModel10.collection(field='1')), {'2'})
+
+    def test_verify_indexes(self):
+
+        class CleanModel8(TestRedisModel):
+            name = fields.InstanceHashField(indexable=True, indexes=[EqualIndex, TextRangeIndex])
+            number = fields.StringField(indexable=True, indexes=[NumberRangeIndex])
+            tags = fields.SetField(indexable=True)
+
+        for i in range(10):
+            CleanModel8(name='n%d' % i, number=i, tags=['t%d' % (i % 2)])
+        self.assertEqual(CleanModel8.verify_indexes(),
+                         {'name': {'missing': 0, 'stale': 0},
+                          'number': {'missing': 0, 'stale': 0},
+                          'tags': {'missing': 0, 'stale': 0}})
+
+        # a missing entry, and stale ones in an existing and a new key
+        self.connection.srem('tests:cleanmodel8:name:n0', 1)
+        self.connection.sadd('tests:cleanmodel8:name:n1', 3)
+        self.connection.sadd('tests:cleanmodel8:name:foo', 4)
+        # a missing entry in a text range index
+        self.connection.zrem('tests:cleanmodel8:name:text-range', 'n4:TEXT-RANGE-SEPARATOR:5')
+        # an entry with a wrong score is a missing one
+        self.connection.zadd('tests:cleanmodel8:number:number-range', {'5': 50})
+        # a stale entry for a pk that doesn't exist
+        self.connection.sadd('tests:cleanmodel8:tags:t0', 20)
+
+        expected = {'name': {'missing': 2, 'stale': 2},
+                    'number': {'missing': 1, 'stale': 0},
+                    'tags': {'missing': 0, 'stale': 1}}
+        self.assertEqual(CleanModel8.verify_indexes(chunk_size=3), expected)
+        # nothing was repaired
+        self.assertEqual(CleanModel8.verify_indexes(chunk_size=3), expected)
+
+        self.assertEqual(CleanModel8.verify_indexes(chunk_size=3, repair=True), expected)
+        self.assertEqual(set(CleanModel8.collection(name='n0')), {'1'})
+        self.assertEqual(set(CleanModel8.collection(name='n1')), {'2'})
+        self.assertEqual(set(CleanModel8.collection(name='foo')), set())
+        self.assertEqual(set(CleanModel8.collection(name__gte='n4', name__lte='n4')), {'5'})
+        self.assertEqual(set(CleanModel8.collection(number__gt=8)), {'10'})
+        self.assertEqual(set(CleanModel8.collection(tags='t0')), {'1', '3', '5', '7', '9'})
+
+        # the key with only stale entries is now empty so it's gone
+        self.assertEqual(self.connection.exists('tests:cleanmodel8:name:foo'), 0)
+
+        self.assertEqual(CleanModel8.get_field('name').verify_indexes(), {'missing': 0, 'stale': 0})
+
+        # when repairing, the field is locked
+        self.connection.set(fields.FieldLock.get_lock_name(CleanModel8.get_field('tags')), 'other', px=300)
+        start = time.time()
+        self.assertEqual(CleanModel8.get_field('tags').verify_indexes(repair=True), {'missing': 0, 'stale': 0})
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertEqual(CleanModel8.verify_indexes(),
+                         {'name': {'missing': 0, 'stale': 0},
+                          'number': {'missing': 0, 'stale': 0},
+                          'tags': {'missing': 0, 'stale': 0}})
+
 
 class InSuffixTestCase(LimpydBaseTest):
 
@@ -1230,3 +1508,33 @@ class GetIndexTestCase(LimpydBaseTest):
         self.assertIs(instance_field.get_index(prefix='reverse').__class__, ReverseEqualIndex2)
         self.assertIs(model_field.get_index(index_class=EqualIndex, key='reverse-equal2', prefix='reverse').__class__, ReverseEqualIndex2)
         self.assertIs(instance_field.get_index(index_class=EqualIndex, key='reverse-equal2', prefix='reverse').__class__, ReverseEqualIndex2)
+
+
+class IndexWritesCoalescingTestCase(LimpydBaseTest):
+
+    class CoalescedModel(TestRedisModel):
+        tags = fields.SetField(indexable=True, indexes=[EqualIndex, ReverseEqualIndex, TextRangeIndex])
+        codes = fields.SetField(unique=True)
+
+    def test_index_writes_of_one_command_are_sent_in_one_pipeline(self):
+        obj = self.CoalescedModel()
+        obj.pk.get()  # create the pk before counting
+        values = ['tag%s' % i for i in range(50)]
+        commands = self.get_round_trips(lambda: obj.tags.sadd(*values))
+        # only the SADD of the values is sent alone, not the index writes
+        self.assertEqual(commands.count('SADD'), 1)
+        self.assertNotIn('ZADD', commands)
+        self.assertLess(len(commands), 10)
+        # but all were done
+        self.assertEqual(set(self.CoalescedModel.collection(tags='tag12')), {obj._pk})
+        self.assertEqual(set(self.CoalescedModel.collection(tags__reverse_eq='21gat')), {obj._pk})
+        self.assertEqual(set(self.CoalescedModel.collection(tags__startswith='tag4')), {obj._pk})
+
+    def test_index_writes_are_discarded_and_rollbacked_on_error(self):
+        obj1 = self.CoalescedModel(codes=['a', 'b'])
+        obj2 = self.CoalescedModel(codes=['c'])
+        with self.assertRaises(UniquenessError):
+            obj2.codes.sadd('d', 'b')
+        self.assertEqual(set(self.CoalescedModel.collection(codes='b')), {obj1._pk})
+        self.assertEqual(set(self.CoalescedModel.collection(codes='c')), {obj2._pk})
+        self.assertEqual(set(self.CoalescedModel.collection(codes='d')), set())
@@ -10,6 +10,8 @@ import unittest
 
 from limpyd.utils import make_key
 from limpyd import fields
+from limpyd.exceptions import ImplementationError, UniquenessError
+from limpyd.indexes import EqualIndex, NumberRangeIndex, TextRangeIndex
 
 from .base import LimpydBaseTest
 from .model import TestRedisModel
@@ -258,5 +260,191 @@ class LockTest(LimpydBaseTest):
         self.assertEqual(len(UnlockableBike.collection()), 2)
 
 
+class LockScopeTest(LimpydBaseTest):
+
+    class ScopedBike(TestRedisModel):
+        namespace = "test-lock"
+        lock_scope = 'instance'
+        name = fields.StringField(indexable=True)
+        serial = fields.StringField(unique=True)
+        color = fields.StringField(indexable=True, lock_scope='field')
+
+    def test_lock_names_should_depend_on_the_scope(self):
+        bike = self.ScopedBike(name="rosalie")
+        name = make_key(self.ScopedBike._name, bike._pk, 'lock')
+        self.assertEqual(fields.FieldLock(bike.name).name, name)
+        # the model scope is overridden by the field one
+        self.assertEqual(fields.FieldLock(bike.color).name,
+                         make_key(self.ScopedBike._name, 'lock-for-update', 'color'))
+        # unique field use the value scope if the value is known...
+        self.assertEqual(fields.FieldLock(bike.serial, value='XYZ').name,
+                         make_key(self.ScopedBike._name, 'lock-for-update', 'serial', 'XYZ'))
+        # ... else the field scope
+        self.assertEqual(fields.FieldLock(bike.serial).name,
+                         make_key(self.ScopedBike._name, 'lock-for-update', 'serial'))
+        # not attached to an instance: field scope
+        self.assertEqual(fields.FieldLock(self.ScopedBike.get_field('name')).name,
+                         make_key(self.ScopedBike._name, 'lock-for-update', 'name'))
+
+    def test_instance_scope_should_not_block_other_instances(self):
+        bike1 = self.ScopedBike(name="rosalie")
+        bike2 = self.ScopedBike(name="velocipede")
+        # simulate a lock on the first instance held by another process
+        lock_name = fields.FieldLock(bike1.name).name
+        self.connection.set(lock_name, 'token', px=5000)
+        bike2.name.set("tandem")
+        bike2.serial.set("XYZ")
+        self.assertEqual(set(self.ScopedBike.collection(name="tandem")), {bike2._pk})
+        self.assertEqual(self.connection.get(lock_name), 'token')
+
+    def test_value_scope_should_also_lock_the_instance(self):
+        bike = self.ScopedBike(name="rosalie")
+        lock = fields.FieldLock(bike.serial, value='XYZ')
+        self.assertEqual(lock.instance_lock.name, make_key(self.ScopedBike._name, bike._pk, 'lock'))
+        # simulate a lock on the instance held by another process writing another value
+        self.connection.set(lock.instance_lock.name, 'token', px=5000)
+        self.assertFalse(fields.FieldLock(bike.serial, value='ABC', blocking_timeout=0.1).acquire())
+        self.assertIsNone(self.connection.get(lock.name))
+        self.connection.delete(lock.instance_lock.name)
+        with lock:
+            self.assertIsNotNone(self.connection.get(lock.name))
+            self.assertIsNotNone(self.connection.get(lock.instance_lock.name))
+        self.assertIsNone(self.connection.get(lock.name))
+        self.assertIsNone(self.connection.get(lock.instance_lock.name))
+
+    def test_field_scope_should_wait_for_the_instance_scope(self):
+        bike = self.ScopedBike(name="rosalie")
+        # simulate a write on an instance done by another process
+        shared_lock = fields.SharedFieldLock(bike.name, timeout=0.3)
+        self.assertTrue(shared_lock.acquire())
+        lock = fields.FieldLock(self.ScopedBike.get_field('name'), blocking_timeout=0.1)
+        self.assertFalse(lock.acquire())
+        # the lock taken to block new shared locks is released on failure
+        self.assertIsNone(self.connection.get(lock.name))
+        start = time.time()
+        with self.ScopedBike._lock_fields(['name']):
+            self.assertGreaterEqual(time.time() - start, 0.15)
+            # new shared locks are refused while the lock is held
+            self.assertFalse(fields.SharedFieldLock(bike.name).acquire(blocking=False))
+        self.assertTrue(fields.SharedFieldLock(bike.name).acquire(blocking=False))
+
+    def test_instance_and_value_scopes_should_wait_for_the_field_scope(self):
+        bike = self.ScopedBike(name="rosalie")
+        for field_name, value in (('name', 'tandem'), ('serial', 'XYZ')):
+            # simulate a bulk write on the field done by another process
+            class_field = self.ScopedBike.get_field(field_name)
+            self.connection.set(fields.FieldLock.get_lock_name(class_field), 'other', px=300)
+            start = time.time()
+            getattr(bike, field_name).set(value)
+            self.assertGreaterEqual(time.time() - start, 0.25)
+            self.assertEqual(set(self.ScopedBike.collection(**{field_name: value})), {bike._pk})
+            self.assertEqual(self.connection.zcard(fields.SharedFieldLock.get_lock_name(class_field)), 0)
+
+    def test_field_scope_should_not_wait_for_the_shared_lock_of_its_thread(self):
+        bike = self.ScopedBike(name="rosalie")
+        start = time.time()
+        with fields.FieldLock(bike.serial, value='XYZ'):
+            with fields.FieldLock(bike.serial):
+                pass
+        self.assertLess(time.time() - start, 1)
+
+    def test_value_scope_should_use_the_normalized_value(self):
+        class TransformedBike(TestRedisModel):
+            namespace = "test-lock"
+            lock_scope = 'value'
+            serial = fields.StringField(unique=True, indexes=[EqualIndex.configure(transform=lambda value: value.lower())])
+
+        bike = TransformedBike()
+        self.assertEqual(fields.FieldLock(bike.serial, value='ABC').name,
+                         fields.FieldLock(bike.serial, value='abc').name)
+        bike.serial.set('ABC')
+        with self.assertRaises(UniquenessError):
+            TransformedBike(serial='abc')
+
+    def test_invalid_scope_should_raise(self):
+        with self.assertRaises(ImplementationError):
+            fields.StringField(indexable=True, lock_scope='foo')
+
+
+class LockFreeBoat(TestRedisModel):
+    namespace = "test-lock"
+    name = fields.StringField(unique=True, lockfree=True)
+    power = fields.InstanceHashField(indexable=True, lockfree=True, indexes=[EqualIndex, TextRangeIndex])
+    length = fields.InstanceHashField(unique=True, lockfree=True, indexes=[NumberRangeIndex])
+    launched = fields.StringField(indexable=True)
+
+
+class LockFreeTest(LimpydBaseTest):
+
+    def test_lockfree_writes_should_not_use_a_lock(self):
+        boat = LockFreeBoat(name="Pen Duick I")
+        with self.assertNumCommands(6):
+            # one EVALSHA, then in the script: a get, a smembers for the uniqueness,
+            # a srem and a sadd for the index, and a set
+            boat.name.set("Pen Duick II")
+        with self.assertNumCommands(3 + self.COUNT_LOCK_COMMANDS):
+            # without lock-free: a get, a set, the sadd in the index, and the lock
+            boat.launched.set(1898)
+
+    def test_values_should_be_indexed(self):
+        boat1 = LockFreeBoat(name="Pen Duick I", power="sail", length=15.1)
+        boat2 = LockFreeBoat(name="Pen Duick II", power="sail", length=13.6)
+        self.assertEqual(set(LockFreeBoat.collection(name="Pen Duick I")), {boat1._pk})
+        self.assertEqual(set(LockFreeBoat.collection(power="sail")), {boat1._pk, boat2._pk})
+        self.assertEqual(set(LockFreeBoat.collection(power__startswith="sa")), {boat1._pk, boat2._pk})
+        self.assertEqual(set(LockFreeBoat.collection(length__gt=14)), {boat1._pk})
+
+        boat2.power.hset("engine")
+        boat2.length.hset(17.45)
+        self.assertEqual(boat2.power.hget(), "engine")
+        self.assertEqual(set(LockFreeBoat.collection(power="sail")), {boat1._pk})
+        self.assertEqual(set(LockFreeBoat.collection(power__startswith="eng")), {boat2._pk})
+        self.assertEqual(set(LockFreeBoat.collection(length__gt=14)), {boat1._pk, boat2._pk})
+
+        self.assertEqual(boat1.name.getset("Pen Duick"), "Pen Duick I")
+        self.assertEqual(set(LockFreeBoat.collection(name="Pen Duick I")), set())
+        self.assertEqual(set(LockFreeBoat.collection(name="Pen Duick")), {boat1._pk})
+
+        boat1.name.delete()
+        boat1.power.hdel()
+        self.assertIsNone(boat1.name.get())
+        self.assertEqual(set(LockFreeBoat.collection(name="Pen Duick")), set())
+        self.assertEqual(set(LockFreeBoat.collection(power="sail")), set())
+        self.assertEqual(set(LockFreeBoat.collection(power__startswith="sa")), set())
+
+    def test_uniqueness_should_be_checked(self):
+        boat1 = LockFreeBoat(name="Pen Duick I", length=15.1)
+        boat2 = LockFreeBoat(name="Pen Duick II", length=13.6)
+        with self.assertRaises(UniquenessError):
+            boat2.name.set("Pen Duick I")
+        with self.assertRaises(UniquenessError):
+            boat2.length.hset(15.1)
+        # nothing was updated
+        self.assertEqual(boat2.name.get(), "Pen Duick II")
+        self.assertEqual(boat2.length.hget(), "13.6")
+        self.assertEqual(set(LockFreeBoat.collection(name="Pen Duick II")), {boat2._pk})
+        self.assertEqual(set(LockFreeBoat.collection(length__gt=14)), {boat1._pk})
+        # setting the same value is allowed
+        boat1.name.set("Pen Duick I")
+        boat1.length.hset(15.1)
+        self.assertEqual(set(LockFreeBoat.collection(name="Pen Duick I")), {boat1._pk})
+
+    def test_unsupported_commands_or_fields_should_raise(self):
+        boat = LockFreeBoat(name="Pen Duick I")
+        with self.assertRaises(ImplementationError):
+            boat.name.append("I")
+        with self.assertRaises(ImplementationError):
+            fields.SetField(indexable=True, lockfree=True)
+
+        class TransformedLockFreeBoat(TestRedisModel):
+            namespace = "test-lock"
+            name = fields.StringField(lockfree=True, indexable=True, indexes=[
+                EqualIndex.configure(transform=lambda value: value.lower())
+            ])
+
+        with self.assertRaises(ImplementationError):
+            TransformedLockFreeBoat(name="Pen Duick I")
+
+
 if __name__ == '__main__':
     unittest.main()
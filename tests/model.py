@@ -420,6 +420,22 @@ class Bike4(TestRedisModel, metaclass=TestMetaClass):
 
         self.assertSetEqual(set(db.scan_keys('fo*', count=1)), keys)
 
+    def test_index_pipeline(self):
+        bike = Bike(name="rosalie")
+        with self.database.index_pipeline():
+            bike.name.set("velocipede")
+            # not yet indexed
+            self.assertEqual(set(Bike.collection(name="velocipede")), set())
+        self.assertEqual(set(Bike.collection(name="velocipede")), {bike._pk})
+        self.assertEqual(set(Bike.collection(name="rosalie")), set())
+
+        # writes are discarded if an exception is raised
+        with self.assertRaises(ValueError):
+            with self.database.index_pipeline():
+                bike.name.set("rosalie")
+                raise ValueError
+        self.assertEqual(set(Bike.collection(name="rosalie")), set())
+
 
 class GetAttrTest(LimpydBaseTest):
 
@@ -538,6 +554,103 @@ class UniquenessTest(LimpydBaseTest):
         self.assertEqual(boat1.length.get(), "15.1")
 
 
+class FromPksTest(LimpydBaseTest):
+
+    def test_only_existing_pks_should_be_returned(self):
+        Bike(name="rosalie")
+        Bike(name="velocipede")
+        Bike(name="tandem")
+        with self.assertNumCommands(2):
+            # one call for each chunk of pks
+            bikes = list(Bike.from_pks([1, 1000, 2, 3], chunk_size=2))
+        self.assertEqual([bike._pk for bike in bikes], ['1', '2', '3'])
+        self.assertTrue(all(bike.connected for bike in bikes))
+
+    def test_lazy_should_not_check_existence(self):
+        Bike(name="rosalie")
+        with self.assertNumCommands(0):
+            bikes = list(Bike.from_pks([1, 1000], lazy=True))
+        self.assertEqual([bike._pk for bike in bikes], ['1', '1000'])
+        self.assertFalse(any(bike.connected for bike in bikes))
+
+
+class BulkCreateTest(LimpydBaseTest):
+
+    def test_instances_should_be_created_with_values_and_defaults(self):
+        pks = Boat.bulk_create([
+            {'name': "Pen Duick I", 'length': 15.1, 'launched': 1898},
+            {'name': "Pen Duick II", 'power': "engine", 'launched': 1964},
+        ])
+        self.assertEqual(pks, ['1', '2'])
+        boat1, boat2 = Boat(pks[0]), Boat(pks[1])
+        self.assertEqual(boat1.name.get(), "Pen Duick I")
+        self.assertEqual(boat1.length.get(), "15.1")
+        self.assertEqual(boat1.power.hget(), "sail")  # default value
+        self.assertEqual(boat2.power.hget(), "engine")
+        self.assertIsNone(boat2.length.get())
+        # next pk is the one after the reserved ones
+        self.assertEqual(Boat(name="Pen Duick III").pk.get(), '3')
+
+    def test_values_should_be_indexed(self):
+        Boat.bulk_create([
+            {'name': "Pen Duick I", 'launched': 1898},
+            {'name': "Pen Duick II", 'power': "engine", 'launched': 1964},
+            {'name': "Pen Duick III", 'power': "engine", 'launched': 1964},
+        ], chunk_size=2)
+        self.assertEqual(set(Boat.collection()), {'1', '2', '3'})
+        self.assertEqual(set(Boat.collection(launched=1964)), {'2', '3'})
+        self.assertEqual(set(Boat.collection(power="sail")), {'1'})
+        self.assertEqual(set(Boat.collection(name="Pen Duick II")), {'2'})
+
+    def test_uniqueness_should_be_checked_in_redis_and_in_the_chunk(self):
+        Boat(name="Pen Duick I")
+        with self.assertRaises(UniquenessError):
+            Boat.bulk_create([{'name': "Pen Duick II"}, {'name': "Pen Duick I"}])
+        with self.assertRaises(UniquenessError):
+            Boat.bulk_create([{'name': "Pen Duick II"}, {'name': "Pen Duick II"}])
+        # nothing was created
+        self.assertEqual(set(Boat.collection()), {'1'})
+        self.assertFalse(Boat.exists(name="Pen Duick II"))
+
+    def test_given_pks_should_be_used_and_checked(self):
+
+        class Glider(TestRedisModel):
+            code = fields.PKField()
+            name = fields.StringField(indexable=True)
+
+        pks = Glider.bulk_create([{'code': 'f-gzcp', 'name': "A330"}, {'pk': 'f-hbnb', 'name': "A320"}])
+        self.assertEqual(pks, ['f-gzcp', 'f-hbnb'])
+        self.assertEqual(set(Glider.collection(name="A320")), {'f-hbnb'})
+        with self.assertRaises(UniquenessError):
+            Glider.bulk_create([{'code': 'f-abcd'}, {'code': 'f-gzcp'}])
+        with self.assertRaises(UniquenessError):
+            Glider.bulk_create([{'code': 'f-abcd'}, {'code': 'f-abcd'}])
+        with self.assertRaises(ValueError):
+            Glider.bulk_create([{'name': "A380"}])
+        with self.assertRaises(ValueError):
+            Boat.bulk_create([{'pk': 10, 'name': "Pen Duick I"}])
+        with self.assertRaises(ValueError):
+            Boat.bulk_create([{'foo': "bar"}])
+        self.assertEqual(set(Glider.collection()), {'f-gzcp', 'f-hbnb'})
+
+    def test_multi_values_fields_should_be_set_and_indexed(self):
+
+        class BulkCar(TestRedisModel):
+            tags = fields.SetField(indexable=True)
+            scores = fields.SortedSetField(indexable=True)
+            infos = fields.HashField(indexable=True)
+
+        pks = BulkCar.bulk_create([
+            {'tags': ['red', 'fast'], 'scores': {'a': 1, 'b': 2}, 'infos': {'brand': 'x'}},
+            {'tags': ['red'], 'infos': {'brand': 'y'}},
+        ])
+        self.assertEqual(BulkCar(pks[0]).tags.smembers(), {'red', 'fast'})
+        self.assertEqual(BulkCar(pks[0]).scores.zrange(0, -1, withscores=True), [('a', 1.0), ('b', 2.0)])
+        self.assertEqual(set(BulkCar.collection(tags='red')), set(pks))
+        self.assertEqual(set(BulkCar.collection(scores='b')), {pks[0]})
+        self.assertEqual(set(BulkCar.collection(infos__brand='y')), {pks[1]})
+
+
 class ExistsTest(LimpydBaseTest):
 
     def test_generic_exists_test(self):
@@ -587,6 +700,41 @@ class MetaRedisProxyTest(LimpydBaseTest):
         check_available_commands(fields.HashField)
 
 
+class LazyFieldsTest(LimpydBaseTest):
+
+    def test_fields_are_created_when_accessed(self):
+        bike = Bike.lazy_connect(1)
+        self.assertNotIn('name', bike.__dict__)
+        name = bike.name
+        self.assertIs(bike.__dict__['name'], name)
+        self.assertIs(bike.name, name)
+        self.assertIs(name._instance, bike)
+        self.assertIsNot(name, Bike.get_field('name'))
+        self.assertIsNot(name, Bike.lazy_connect(1).name)
+        self.assertNotIn('wheels', bike.__dict__)
+
+    def test_pk_alias_is_the_real_pk_field(self):
+
+        class Kite(TestRedisModel):
+            code = fields.PKField()
+            name = fields.StringField()
+
+        kite = Kite(code='f-gzcp', name='A330')
+        self.assertIs(kite.pk, kite.code)
+        self.assertEqual(Kite('f-gzcp').pk.get(), 'f-gzcp')
+
+    def test_fields_are_not_visible_on_the_class(self):
+
+        class Truck(TestRedisModel):
+            instances = fields.StringField()
+
+        self.assertFalse(hasattr(Bike, 'name'))
+        # the classmethod overridden by the field is still available
+        truck = Truck(instances='yes')
+        self.assertEqual(Truck.instances(), [truck])
+        self.assertEqual(Truck(1).instances.get(), 'yes')
+
+
 class PostCommandTest(LimpydBaseTest):
 
     class MyModel(TestRedisModel):
@@ -916,5 +1064,155 @@ class ScanTest(LimpydBaseTest):
         })
 
 
+class IdentityMapTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(IdentityMapTest, self).setUp()
+        self.boat = Boat(name='Pen Duick', power='sail', launched=1898)
+
+    def test_same_pk_returns_the_same_instance(self):
+        pk = self.boat.pk.get()
+        with self.database.identity_map():
+            boat = Boat(pk)
+            with self.assertNumCommands(0):
+                self.assertIs(Boat(pk), boat)
+                self.assertIs(Boat.lazy_connect(pk), boat)
+            self.assertIs(list(Boat.collection().instances(lazy=True))[0], boat)
+            self.assertIs(list(Boat.from_pks([pk]))[0], boat)
+        self.assertIsNot(Boat(pk), boat)
+
+    def test_values_are_read_once(self):
+        pk = self.boat.pk.get()
+        with self.database.identity_map():
+            boat = Boat(pk)
+            self.assertEqual(boat.name.get(), 'Pen Duick')
+            self.assertEqual(boat.hmget('power'), ['sail'])
+            with self.assertNumCommands(0):
+                self.assertEqual(Boat(pk).name.get(), 'Pen Duick')
+                self.assertEqual(boat.hmget('power'), ['sail'])
+
+    def test_hash_fields_of_an_instance_are_read_separately(self):
+
+        class Sailboat(TestRedisModel):
+            namespace = "test_hash_fields_of_an_instance_are_read_separately"
+            name = fields.InstanceHashField()
+            power = fields.InstanceHashField()
+
+        pk = Sailboat(name='Joshua', power='sail').pk.get()
+        with self.database.identity_map():
+            sailboat = Sailboat(pk)
+            self.assertEqual(sailboat.name.hget(), 'Joshua')
+            self.assertEqual(sailboat.power.hget(), 'sail')
+            with self.assertNumCommands(0):
+                self.assertEqual(sailboat.name.hget(), 'Joshua')
+                self.assertEqual(sailboat.power.hget(), 'sail')
+            sailboat.hmset(name='Tamata')
+            self.assertEqual(sailboat.name.hget(), 'Tamata')
+            self.assertEqual(sailboat.power.hget(), 'sail')
+
+    def test_local_writes_invalidate_the_values(self):
+        pk = self.boat.pk.get()
+        with self.database.identity_map():
+            boat = Boat(pk)
+            self.assertEqual(boat.power.hget(), 'sail')
+            self.assertEqual(boat.hmget('power'), ['sail'])
+            Boat(pk).power.hset('engine')
+            self.assertEqual(boat.power.hget(), 'engine')
+            self.assertEqual(boat.hmget('power'), ['engine'])
+            boat.hmset(power='oars')
+            self.assertEqual(boat.power.hget(), 'oars')
+            self.assertEqual(Boat.collection(power='oars').instances()[0], boat)
+
+    def test_deleted_instance_is_removed(self):
+        pk = self.boat.pk.get()
+        with self.database.identity_map():
+            Boat(pk).delete()
+            with self.assertRaises(DoesNotExist):
+                Boat(pk)
+            new_boat = Boat(name='Kurun')
+            self.assertIs(Boat(new_boat.pk.get()), new_boat)
+
+    def test_nested_identity_maps_are_the_same(self):
+        with self.database.identity_map() as identity_map:
+            with self.database.identity_map() as nested_identity_map:
+                self.assertIs(nested_identity_map, identity_map)
+            self.assertIs(self.database.current_identity_map, identity_map)
+        self.assertIsNone(self.database.current_identity_map)
+
+
+class BatchTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.boat = Boat(name='Pen Duick', power='sail', launched=1898)
+
+    def test_values_are_written_at_the_end_of_the_block(self):
+        with self.boat.batch():
+            with self.assertNumCommands(0):
+                self.boat.name.set('Pen Duick II')
+                self.boat.power.hset('engine')
+                self.boat.launched.set(1964)
+                self.boat.length.set(13)
+            self.assertEqual(Boat(self.boat.pk.get()).name.get(), 'Pen Duick')
+        self.assertEqual(self.boat.name.get(), 'Pen Duick II')
+        self.assertEqual(self.boat.hmget('power'), ['engine'])
+        self.assertEqual(self.boat.launched.get(), '1964')
+        self.assertEqual(self.boat.length.get(), '13')
+        self.assertEqual(set(Boat.collection(power='engine', launched=1964)), {self.boat.pk.get()})
+        self.assertEqual(set(Boat.collection(power='sail')), set())
+        self.assertEqual(set(Boat.collection(launched=1898)), set())
+
+    def test_all_values_are_written_in_one_pipeline(self):
+        boat = Boat(self.boat.pk.get())
+        boat.connect()
+        # the 2 indexed fields are locked (set, and get + del in a script to
+        # release), their current values are read, then the 2 indexes are
+        # updated (srem + sadd), with 1 set for each StringField and 1 hmset
+        # for all the InstanceHashField
+        with self.assertNumCommands(2 * 4 + 2 + 4 + 3):
+            with boat.batch():
+                boat.power.hset('engine')
+                boat.launched.set(1964)
+                boat.length.set(13)
+
+    def test_nothing_is_written_if_the_block_fails(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.boat.batch():
+                self.boat.power.hset('engine')
+                1 / 0
+        self.assertEqual(self.boat.power.hget(), 'sail')
+        self.assertEqual(set(Boat.collection(power='sail')), {self.boat.pk.get()})
+
+    def test_uniqueness_is_checked(self):
+        other = Boat(name='Tabarly')
+        with self.assertRaises(UniquenessError):
+            with other.batch():
+                other.launched.set(1970)
+                other.name.set('Pen Duick')
+        self.assertEqual(other.name.get(), 'Tabarly')
+        self.assertIsNone(other.launched.get())
+        self.assertEqual(set(Boat.collection(launched=1970)), set())
+
+    def test_indexed_fields_are_locked(self):
+        # simulate a lock held by another process on a non-unique indexed field
+        lock_name = fields.FieldLock.get_lock_name(self.boat.power)
+        self.connection.set(lock_name, 'other', px=300)
+        start = time.time()
+        with self.boat.batch():
+            self.boat.power.hset('engine')
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertEqual(set(Boat.collection(power='engine')), {self.boat.pk.get()})
+
+    def test_other_commands_write_the_buffered_values_first(self):
+        with self.boat.batch():
+            self.boat.power.hset('engine')
+            self.boat.length.set(13)
+            self.assertEqual(self.boat.power.hget(), 'engine')
+            self.assertEqual(self.boat.length.get(), '13')
+            self.boat.length.set(14)
+        self.assertEqual(self.boat.length.get(), '14')
+        self.assertEqual(set(Boat.collection(power='engine')), {self.boat.pk.get()})
+
+
 if __name__ == '__main__':
     unittest.main()
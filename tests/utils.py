@@ -44,6 +44,11 @@ class UniqueKeyTest(LimpydBaseTest):
         key2 = unique_key(self.connection)
         self.assertNotEqual(key1, key2)
 
+    def test_generated_key_must_not_need_redis(self):
+        with self.assertNumCommands(0):
+            key = unique_key(prefix='foo')
+        self.assertTrue(key.startswith('foo:'))
+
 
 class LimpydBaseTestTest(LimpydBaseTest):
     """